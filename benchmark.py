@@ -0,0 +1,888 @@
+from __future__ import annotations
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import argparse
+import time
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from typing import Callable
+import data.utils as data_utils
+from data.utils import DatasetPreprocessor, SequenceBatchCollater, BucketBatchSampler
+from torch.utils.data import DataLoader
+from utils.utils import prep_batch, update_ema, FlatParameters
+from data.transforms import YeoJohnsond, SoftClipOutliersd
+from utils.transforms import transforms, batch_transforms, channel_stats, dino_transforms
+from data.nifti import read_header, load_nifti, transcode
+from data.store import VolumeStore, export_store
+from data.engine import BatchedCompose
+from monai.data import MetaTensor
+from monai.transforms import (
+    Compose, ConcatItemsd, CopyItemsd, DeleteItemsd, EnsureTyped, Flip, NormalizeIntensityd, RandSpatialCropd,
+    RandomizableTrait, Rotate90
+)
+from models.convnext3d import convnext3d_femto, convnext3d_tiny
+from models.mednet import MedNet
+from models.dinohead import DINOHead, MultiCropWrapper
+from torch.nn.parallel import DistributedDataParallel as DDP
+from losses.dinoloss import DINOLoss
+from tests.reference import (
+    masked_yeo_johnson, reference_soft_clip, reference_prep_transforms, create_exams, reference_dino_loss,
+    reference_multi_crop_forward, reference_update_teacher, reference_shuffle_sequence
+)
+
+def time_fn(
+        fn: Callable,
+        device: torch.device,
+        num_repeats: int = 10,
+        num_warmup: int = 2
+    ) -> float:
+
+    '''
+    Args:
+        fn (Callable): Function to time.
+        device (torch.device): Pytorch device the function runs on.
+        num_repeats (int): Number of timed repetitions. Defaults to 10.
+        num_warmup (int): Number of untimed warm-up repetitions. Defaults to 2.
+
+    Returns:
+        float: Median run time in milliseconds.
+    '''
+
+    for _ in range(num_warmup):
+        fn()
+    times = []
+    for _ in range(num_repeats):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start_time = time.perf_counter()
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append((time.perf_counter() - start_time) * 1000)
+    return float(np.median(times))
+
+def benchmark_packed_features(
+        args: argparse.Namespace,
+        device: torch.device
+    ) -> None:
+
+    '''
+    Compares the padded and packed feature extraction of MedNet as a function of the padding ratio.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        device (torch.device): Pytorch device.
+    '''
+
+    model = MedNet(convnext3d_femto(in_chans=4), num_classes=1, num_layers=4).to(device).eval()
+    B, S = args.batch_size, args.seq_length
+    x = torch.randn(B, S, 4, args.image_size, args.image_size, args.image_size, device=device)
+    print(f'{"padding":>8} {"padded (ms)":>12} {"packed (ms)":>12} {"speedup":>8}')
+    for num_real in range(S, 0, -1):
+        pad_mask = torch.zeros(B, S, device=device)
+        pad_mask[:, num_real:] = 1
+        with torch.no_grad():
+            model.packed = False
+            padded = time_fn(lambda: model.extract_features(x, pad_mask), device, args.num_repeats)
+            model.packed = True
+            packed = time_fn(lambda: model.extract_features(x, pad_mask), device, args.num_repeats)
+        print(f'{1 - num_real / S:>8.2f} {padded:>12.1f} {packed:>12.1f} {padded / packed:>7.2f}x')
+
+def create_observation_tree(
+        data_dir: str,
+        num_observations: int,
+        modalities: list,
+        max_observations: int = 12
+    ) -> None:
+
+    '''
+    Creates a synthetic directory tree of observations with empty image files and a matching label file.
+
+    Args:
+        data_dir (str): Path to the data directory.
+        num_observations (int): Number of observations to create.
+        modalities (list): List of image modalities per observation.
+        max_observations (int): Maximum number of observations per patient. Defaults to 12.
+    '''
+
+    rng = np.random.default_rng(0)
+    rows = []
+    patient, observation = 0, 1
+    for _ in range(num_observations):
+        uid = f'ID_{patient:06d}_{observation:03d}'
+        os.makedirs(os.path.join(data_dir, 'nifti', uid))
+        for modality in modalities:
+            open(os.path.join(data_dir, 'nifti', uid, modality + '.nii.gz'), 'wb').close()
+        rows.append({'id': f'ID_{patient:06d}', 'observation': observation, 'label': int(rng.random() < 0.3), 'delta': float(rng.integers(0, 36))})
+        if rng.integers(1, max_observations + 1) <= observation:
+            patient, observation = patient + 1, 1
+        else:
+            observation += 1
+    os.makedirs(os.path.join(data_dir, 'labels'))
+    pd.DataFrame(rows).to_csv(os.path.join(data_dir, 'labels', 'labels.csv'), index=False)
+
+def benchmark_load_data(
+        args: argparse.Namespace,
+        device: torch.device
+    ) -> None:
+
+    '''
+    Times the stages of DatasetPreprocessor.load_data on a synthetic directory tree.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        device (torch.device): Pytorch device (unused).
+    '''
+
+    modalities = ['DWI_b0','DWI_b150','DWI_b400','DWI_b800']
+    keys = ['label','delta']
+    with tempfile.TemporaryDirectory() as data_dir:
+        start_time = time.perf_counter()
+        # every observation also holds a T2 weighted image, as in the real data
+        create_observation_tree(data_dir, args.num_observations, modalities + ['T2W_TES'])
+        print(f'Created {args.num_observations} observations in {time.perf_counter() - start_time:.1f}s')
+
+        stages = {}
+        manifest_path = os.path.join(data_dir, 'manifest.pkl')
+        start_time = time.perf_counter()
+        DatasetPreprocessor(data_dir=data_dir, manifest_path=manifest_path)
+        stages['cold scan'] = time.perf_counter() - start_time
+        # drop the in-process manifest to time a restart that revalidates the manifest on disk
+        data_utils._manifests.clear()
+        start_time = time.perf_counter()
+        preprocessor = DatasetPreprocessor(data_dir=data_dir, manifest_path=manifest_path)
+        stages['warm scan'] = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        observation_list = preprocessor.assert_observation_completeness(modalities, verbose=False)
+        stages['completeness'] = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        {modality: preprocessor.split_observations_by_modality(observation_list, modality) for modality in modalities}
+        stages['modalities'] = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        preprocessor.create_label_dict(observation_list, keys, os.path.join(preprocessor.label_dir, 'labels.csv'))
+        stages['labels'] = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        data_dict, _ = preprocessor.load_data(modalities, keys, verbose=False)
+        stages['load_data'] = time.perf_counter() - start_time
+        for stage, seconds in stages.items():
+            print(f'{stage:>14} {seconds:>8.2f}s')
+        print(f'{len(data_dict)} labelled observations')
+
+def benchmark_bucketing(
+        args: argparse.Namespace,
+        device: torch.device
+    ) -> None:
+
+    '''
+    Compares the training throughput of MedNet with randomly batched sequences that are padded to the maximum sequence
+    length and length-bucketed batches that are only padded to the longest sequence in the batch.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        device (torch.device): Pytorch device.
+    '''
+
+    rng = np.random.default_rng(0)
+    # most patients only have a few exams, few have many
+    lengths = np.minimum(rng.geometric(0.35, size=args.num_sequences), 12)
+    images = [torch.randn(4, args.image_size, args.image_size, args.image_size) for _ in range(lengths.max())]
+    data = [[{'image': images[t], 'label': int(t == 0), 'delta': float(t + 1)} for t in range(length)] for length in lengths]
+    model = MedNet(convnext3d_femto(in_chans=4), num_classes=1, num_layers=4).to(device)
+    optimizer = torch.optim.AdamW(model.parameters())
+    loaders = {
+        'padded': DataLoader(
+            data, 
+            batch_size=args.batch_size, 
+            shuffle=True, 
+            drop_last=True,
+            collate_fn=SequenceBatchCollater(keys=['image','label','delta'], seq_length=args.seq_length)),
+        'bucketed': DataLoader(
+            data,
+            batch_sampler=BucketBatchSampler(lengths, batch_size=args.batch_size, max_length=args.seq_length),
+            collate_fn=SequenceBatchCollater(keys=['image','label','delta'], seq_length=args.seq_length, pad_to_max=True))
+    }
+    print(f'{"loader":>10} {"steps":>6} {"images/step":>12} {"padding":>8} {"epoch (s)":>10} {"seq/s":>8}')
+    for name, loader in loaders.items():
+        num_images, num_padded = 0, 0
+        start_time = time.perf_counter()
+        for batch in loader:
+            inputs, labels, delta, padding_mask = prep_batch(batch, batch_size=args.batch_size, device=device)
+            logits = model(inputs, pad_mask=padding_mask, pos=delta)
+            loss = torch.nn.functional.binary_cross_entropy_with_logits(logits.squeeze(-1), labels.float())
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+            num_images += padding_mask.numel()
+            num_padded += padding_mask.sum().item()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        epoch_time = time.perf_counter() - start_time
+        num_sequences = len(loader) * args.batch_size
+        print(f'{name:>10} {len(loader):>6} {num_images / len(loader):>12.1f} {num_padded / num_images:>8.2f} {epoch_time:>10.1f} {num_sequences / epoch_time:>8.2f}')
+
+def benchmark_yeo_johnson(
+        args: argparse.Namespace,
+        device: torch.device
+    ) -> None:
+
+    '''
+    Compares the fused YeoJohnsond transform with the masked reference implementation (see tests/test_equivalence.py
+    for their agreement).
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        device (torch.device): Pytorch device.
+    '''
+
+    image = torch.randn(4, args.image_size, args.image_size, args.image_size, device=device) * 2
+    print(f'{"lambda":>22} {"masked (ms)":>12} {"fused (ms)":>12} {"speedup":>8}')
+    for lmbda in [0.5, 0, [0.5, 1.0, 1.5, 0.25], [0.5, 2, 0, 1.5]]:
+        transform = YeoJohnsond(keys='image', lmbda=lmbda, channel_wise=True)
+        masked = time_fn(lambda: masked_yeo_johnson(image.clone(), lmbda), device, args.num_repeats)
+        fused = time_fn(lambda: transform({'image': image.clone()}), device, args.num_repeats)
+        print(f'{str(lmbda):>22} {masked:>12.1f} {fused:>12.1f} {masked / fused:>7.2f}x')
+
+def benchmark_soft_clip(
+        args: argparse.Namespace,
+        device: torch.device
+    ) -> None:
+
+    '''
+    Compares the exact and histogram based SoftClipOutliersd with the unfused reference implementation (see
+    tests/test_equivalence.py for their agreement).
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        device (torch.device): Pytorch device.
+    '''
+
+    # MRI-like intensities: skewed tissue intensities next to a large background
+    size = args.image_size
+    image = torch.distributions.Gamma(2.0, 0.02).sample((4, size, size, size)).to(device)
+    image[:, :, :size // 4] = 0
+    image = YeoJohnsond(keys='image', lmbda=0.5)({'image': image})['image']
+    reference = time_fn(lambda: reference_soft_clip(image.clone(), 3.5), device, args.num_repeats)
+    print(f'{"mode":>16} {"time (ms)":>10} {"speedup":>8}')
+    print(f'{"reference":>16} {reference:>10.1f} {1:>7.2f}x')
+    for rel_error in [None, 1e-2, 1e-3, 1e-4]:
+        transform = SoftClipOutliersd(keys='image', scale_factor=3.5, channel_wise=True, approximate=rel_error is not None, rel_error=rel_error or 1e-3)
+        timed = time_fn(lambda: transform({'image': image.clone()}), device, args.num_repeats)
+        print(f'{"exact" if rel_error is None else f"rel_error={rel_error:g}":>16} {timed:>10.1f} {reference / timed:>7.2f}x')
+
+def benchmark_batched_prep(
+        args: argparse.Namespace,
+        device: torch.device
+    ) -> None:
+
+    '''
+    Compares the intensity transforms of the preprocessing applied per observation with the batched engine on
+    same-shaped observations (see tests/test_equivalence.py for their agreement).
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        device (torch.device): Pytorch device.
+    '''
+    modalities = ['DWI_b0', 'DWI_b150', 'DWI_b400', 'DWI_b800']
+    size = args.image_size
+    images = torch.distributions.Gamma(2.0, 0.02).sample((args.batch_size, len(modalities), 1, size, size, size))
+    transform = Compose([
+        YeoJohnsond(keys=modalities, lmbda=0.5),
+        ConcatItemsd(keys=modalities, name='image'),
+        SoftClipOutliersd(keys='image', scale_factor=3.5, channel_wise=True),
+        NormalizeIntensityd(keys='image', channel_wise=True)])
+    engine = BatchedCompose(transform, device=device)
+
+    def observations():
+        return [{mod: MetaTensor(image[idx].clone()) for idx, mod in enumerate(modalities)} for image in images]
+
+    per_item = time_fn(lambda: [transform(item) for item in observations()], device, args.num_repeats)
+    batched = time_fn(lambda: engine(observations()), device, args.num_repeats)
+    print(f'{"observations":>12} {"per item (ms)":>14} {"batched (ms)":>13} {"speedup":>8}')
+    print(f'{args.batch_size:>12} {per_item:>14.1f} {batched:>13.1f} {per_item / batched:>7.2f}x')
+
+def compare_prep(
+        reference: Compose,
+        candidate: Compose,
+        exams: list,
+        device: torch.device,
+        num_repeats: int
+    ) -> None:
+
+    '''
+    Reports the run times of two preprocessing chains (see tests/test_equivalence.py for their agreement).
+
+    Args:
+        reference (Compose): Reference chain.
+        candidate (Compose): Chain to compare with the reference.
+        exams (list): Image paths of every exam, keyed on the modality.
+        device (torch.device): Pytorch device.
+        num_repeats (int): Number of timed repetitions per exam.
+    '''
+    print(f'{"exam":>5} {"shape":>16} {"reference (ms)":>15} {"candidate (ms)":>15} {"speedup":>8}')
+    for exam, paths in enumerate(exams):
+        shape = tuple(candidate(dict(paths))['image'].shape[1:])
+        reference_time = time_fn(lambda: reference(dict(paths)), device, num_repeats, num_warmup=0)
+        candidate_time = time_fn(lambda: candidate(dict(paths)), device, num_repeats, num_warmup=0)
+        print(f'{exam:>5} {str(shape):>16} {reference_time:>15.1f} {candidate_time:>15.1f} {reference_time / candidate_time:>7.2f}x')
+
+def benchmark_prep_roi(
+        args: argparse.Namespace,
+        device: torch.device
+    ) -> None:
+
+    '''
+    Compares the preprocessing that resamples only the planned region of interest with the original order on
+    synthetic exams.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        device (torch.device): Pytorch device.
+    '''
+    modalities = ['DWI_b0', 'DWI_b150', 'DWI_b400', 'DWI_b800']
+    planned = transforms(dataset='prep', modalities=modalities, device=device)
+    # the padding and center crop to the final size are shared by both and not timed
+    planned = Compose(planned.transforms[:-2], lazy=planned.lazy, overrides=planned.overrides)
+    with tempfile.TemporaryDirectory() as data_dir:
+        exams = create_exams(data_dir, args.batch_size, args.image_size, modalities)
+        compare_prep(reference_prep_transforms(modalities), planned, exams, device, args.num_repeats)
+
+def benchmark_lazy_resample(
+        args: argparse.Namespace,
+        device: torch.device
+    ) -> None:
+
+    '''
+    Compares the preprocessing that composes the reorientation with the resampling of every modality with its eager
+    evaluation on synthetic exams.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        device (torch.device): Pytorch device.
+    '''
+    modalities = ['DWI_b0', 'DWI_b150', 'DWI_b400', 'DWI_b800']
+    lazy = transforms(dataset='prep', modalities=modalities, device=device)
+    eager = Compose(lazy.transforms, lazy=False)
+    with tempfile.TemporaryDirectory() as data_dir:
+        exams = create_exams(data_dir, args.batch_size, args.image_size, modalities)
+        compare_prep(eager, lazy, exams, device, args.num_repeats)
+
+def benchmark_nifti_io(
+        args: argparse.Namespace,
+        device: torch.device
+    ) -> None:
+
+    '''
+    Compares reading a gzipped NIfTI image with nibabel to the header-only probe and the loader backend on the
+    original and the transcoded files, and verifies that all of them decode the same image.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        device (torch.device): Pytorch device.
+    '''
+    rng = np.random.default_rng(0)
+    size = args.image_size
+    # MRI-like image: integer intensities within the body and an empty background
+    image = np.zeros((size, size, size * 2 // 3), dtype=np.int16)
+    image[size // 8:size * 7 // 8, size // 8:size * 7 // 8] = rng.gamma(2.0, 200.0, size=(size * 3 // 4, size * 3 // 4, size * 2 // 3))
+    with tempfile.TemporaryDirectory() as data_dir:
+        path = os.path.join(data_dir, 'image.nii.gz')
+        nib.save(nib.Nifti1Image(image, np.diag([1.2, 1.2, 1.8, 1.0])), path)
+        files = {'original': path}
+        for level in [6, 1, 0]:
+            files[f'blocks, level {level}'] = os.path.join(data_dir, f'blocks_{level}.nii.gz')
+            transcode(path, files[f'blocks, level {level}'], level=level)
+        files['uncompressed'] = os.path.join(data_dir, 'image.nii')
+        transcode(path, files['uncompressed'])
+
+        assert read_header(path)['shape'] == image.shape
+        probe = time_fn(lambda: read_header(path), device, args.num_repeats)
+        print(f'Header probe: {probe:.2f}ms')
+        print(f'{"file":>16} {"size (MB)":>10} {"nibabel (ms)":>13} {"loader (ms)":>12} {"speedup":>8}')
+        for name, file in files.items():
+            assert np.array_equal(np.asanyarray(load_nifti(file).dataobj), image)
+            reference = time_fn(lambda: np.asanyarray(nib.load(file).dataobj), device, args.num_repeats)
+            loader = time_fn(lambda: np.asanyarray(load_nifti(file).dataobj), device, args.num_repeats)
+            print(f'{name:>16} {os.path.getsize(file) / 1024 ** 2:>10.1f} {reference:>13.1f} {loader:>12.1f} {reference / loader:>7.2f}x')
+
+def benchmark_volume_store(
+        args: argparse.Namespace,
+        device: torch.device
+    ) -> None:
+
+    '''
+    Compares fetching random crops of whole image sequences from one memory-mapped .npy file per observation, as in
+    the persistent cache, with the volume store, and verifies that both return the same crops.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        device (torch.device): Pytorch device.
+    '''
+    size, crop = args.image_size + 24, args.image_size
+    rng = np.random.default_rng(0)
+    sequences = [[{'uid': f'ID_{patient:04d}_{exam:03d}', 'image': torch.from_numpy(rng.standard_normal((4, size, size, size), dtype=np.float32))}
+        for exam in range(args.seq_length)] for patient in range(args.batch_size)]
+    with tempfile.TemporaryDirectory() as data_dir:
+        for sequence in sequences:
+            for item in sequence:
+                np.save(os.path.join(data_dir, item['uid'] + '.npy'), item['image'].numpy())
+        export_store(os.path.join(data_dir, 'store'), [item for sequence in sequences for item in sequence], Compose([]), 'image')
+        store = VolumeStore(os.path.join(data_dir, 'store'))
+        sequences = [[{'uid': item['uid']} for item in sequence] for sequence in sequences]
+
+        def crop_sequences(load):
+            starts = rng.integers(0, size - crop + 1, size=3)
+            return [torch.stack([image[:, starts[0]:starts[0] + crop, starts[1]:starts[1] + crop, starts[2]:starts[2] + crop] for image in load(sequence)])
+                for sequence in sequences]
+
+        def load_files(sequence):
+            return [torch.from_numpy(np.load(os.path.join(data_dir, item['uid'] + '.npy'), mmap_mode='c')) for item in sequence]
+
+        def load_store(sequence):
+            return [output['image'] for output in store.load_sequence(sequence)]
+
+        for sequence in sequences:
+            assert all(torch.equal(a, b) for a, b in zip(load_files(sequence), load_store(sequence)))
+        files = time_fn(lambda: crop_sequences(load_files), device, args.num_repeats)
+        stored = time_fn(lambda: crop_sequences(load_store), device, args.num_repeats)
+        print(f'{"sequences":>10} {"exams":>6} {"files (ms)":>11} {"store (ms)":>11} {"speedup":>8}')
+        print(f'{args.batch_size:>10} {args.seq_length:>6} {files:>11.1f} {stored:>11.1f} {files / stored:>7.2f}x')
+
+def benchmark_batched_augmentation(
+        args: argparse.Namespace,
+        device: torch.device
+    ) -> None:
+
+    '''
+    Compares augmenting the training sequences exam by exam with the dictionary transforms, followed by the collation,
+    with collating the crops into one batch that BatchedRandAugment augments at once. The batched augmentation is
+    checked against the array transforms with the same random parameters.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        device (torch.device): Pytorch device.
+    '''
+    modalities = ['DWI_b0','DWI_b150','DWI_b400','DWI_b800']
+    crop_size = (args.image_size,) * 3
+    rng = np.random.default_rng(0)
+    # the preprocessed images are up to 24 voxels larger than the crops along every axis
+    batch = [[{'image': torch.randn(4, *rng.integers(args.image_size, args.image_size + 25, size=3), device=device), 'label': 0, 'delta': float(t + 1)}
+        for t in range(args.seq_length)] for _ in range(args.batch_size)]
+    train = transforms(dataset='train', modalities=modalities, device=device, crop_size=crop_size)
+    itemwise = Compose(train.transforms[train.get_index_of_first(lambda t: isinstance(t, RandomizableTrait)):])
+    collater = SequenceBatchCollater(keys=['image','label','delta'], seq_length=args.seq_length)
+    batched = SequenceBatchCollater(
+        keys=['image','label','delta'],
+        seq_length=args.seq_length,
+        augmentation=batch_transforms(modalities, crop_size=crop_size))
+
+    augmentation = batched.augmentation
+    x = torch.stack([augmentation.crop(patient[0]['image'], (0, 0, 0)) for patient in batch])
+    params = augmentation.randomize([x.shape[2:]] * len(x), x.shape[1])
+    mean, std = [torch.tensor(stats, device=device).reshape(-1, 1, 1, 1) for stats in channel_stats(modalities)]
+    max_error = 0.0
+    for image, output, offset, flip, k, scale, shift in zip(x, augmentation(x, params), *params.values()):
+        expected = augmentation.crop(image, offset)
+        for axis in np.flatnonzero(flip):
+            expected = Flip(spatial_axis=int(axis))(expected)
+        if k > 0:
+            expected = Rotate90(int(k), augmentation.spatial_axes)(expected)
+        expected = torch.as_tensor(expected) * (1 + torch.tensor(scale, device=device, dtype=torch.float).reshape(-1, 1, 1, 1))
+        expected = (expected + torch.tensor(shift, device=device, dtype=torch.float).reshape(-1, 1, 1, 1) - mean) / std
+        max_error = max(max_error, (expected - output).abs().max().item())
+
+    exam_by_exam = time_fn(lambda: collater([[itemwise(dict(exam)) for exam in patient] for patient in batch]), device, args.num_repeats)
+    whole_batch = time_fn(lambda: batched(batch), device, args.num_repeats)
+    print(f'{"images":>7} {"exam by exam (ms)":>18} {"batched (ms)":>13} {"speedup":>8} {"max error":>10}')
+    print(f'{args.batch_size * args.seq_length:>7} {exam_by_exam:>18.1f} {whole_batch:>13.1f} {exam_by_exam / whole_batch:>7.2f}x {max_error:>10.2e}')
+
+def benchmark_multi_crop(
+        args: argparse.Namespace,
+        device: torch.device
+    ) -> None:
+
+    '''
+    Compares the DINO views of copying the preprocessed image once per view before cropping, with cropping all views
+    from the single image (see dino_transforms). Reports the size of the cached deterministic output per sample and the
+    run time of the random transforms per sample.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        device (torch.device): Pytorch device.
+    '''
+    modalities = ['DWI_b0','DWI_b150','DWI_b400','DWI_b800']
+    views = ['gv1','gv2','lv1','lv2']
+    global_crop_size, local_crop_size = (args.image_size,) * 3, (args.image_size * 2 // 3,) * 3
+    image = torch.randn(4, 96, 96, 96)
+    chain = dino_transforms(modalities, device, global_crop_size, local_crop_size)
+    start = chain.get_index_of_first(lambda t: isinstance(t, RandomizableTrait))
+    multi_crop = [EnsureTyped(keys='image', track_meta=False, device=device, dtype=torch.float)] + list(chain.transforms[start:])
+    copies = [
+        CopyItemsd(keys='image', times=4, names=views),
+        DeleteItemsd(keys='image'),
+        EnsureTyped(keys=views, track_meta=False, device=device, dtype=torch.float),
+        RandSpatialCropd(keys=['gv1','gv2'], roi_size=global_crop_size, random_size=False),
+        RandSpatialCropd(keys=['lv1','lv2'], roi_size=local_crop_size, random_size=False)
+    ] + list(chain.transforms[start + 1:])
+    print(f'{"views":>12} {"cached (MB)":>12} {"step (ms)":>10}')
+    for name, transforms in [('copies', copies), ('multi crop', multi_crop)]:
+        transform = Compose(transforms)
+        first_random = transform.get_index_of_first(lambda t: isinstance(t, RandomizableTrait))
+        cached = transform({'image': image}, end=first_random)
+        size = sum(value.numel() * value.element_size() for value in cached.values() if isinstance(value, torch.Tensor))
+        step = time_fn(lambda: transform(cached, start=first_random), device, args.num_repeats)
+        output = transform(cached, start=first_random)
+        assert all(tuple(output[view].shape[1:]) == (global_crop_size if view[0] == 'g' else local_crop_size) for view in views)
+        print(f'{name:>12} {size / 1024 ** 2:>12.1f} {step:>10.1f}')
+
+def benchmark_dino_loss(
+        args: argparse.Namespace,
+        device: torch.device
+    ) -> None:
+
+    '''
+    Compares the DINO loss with a Python loop over all pairs of teacher and student views with the batched matrix
+    product as a function of the number of crops and the output dimension, including the backward pass (see
+    tests/test_equivalence.py for their agreement).
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        device (torch.device): Pytorch device.
+    '''
+    if not dist.is_initialized():
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', '29531')
+        dist.init_process_group('nccl' if device.type == 'cuda' else 'gloo', rank=0, world_size=1)
+    print(f'{"out dim":>8} {"crops":>6} {"loop (ms)":>10} {"batched (ms)":>13} {"speedup":>8}')
+    for out_dim in [1024, 4096, 16384]:
+        for num_local_crops in [2, 6, 10]:
+            num_crops = 2 + num_local_crops
+            loss_fn = DINOLoss(out_dim, num_crops, num_steps=10, teacher_temp=0.04, teacher_warmup_temp=0.04, teacher_warmup_steps=0).to(device)
+            loss_fn.center.normal_()
+            student_output = torch.randn(num_crops * args.batch_size * 8, out_dim, device=device, requires_grad=True)
+            teacher_output = torch.randn(2 * args.batch_size * 8, out_dim, device=device)
+            center = loss_fn.center.clone()
+
+            def batched():
+                loss_fn.center.copy_(center)
+                loss_fn(0, student_output, teacher_output).backward()
+
+            loop = time_fn(lambda: reference_dino_loss(loss_fn, 0, student_output, teacher_output).backward(), device, args.num_repeats)
+            matmul = time_fn(batched, device, args.num_repeats)
+            print(f'{out_dim:>8} {num_crops:>6} {loop:>10.1f} {matmul:>13.1f} {loop / matmul:>7.2f}x')
+
+def benchmark_multi_crop_wrapper(
+        args: argparse.Namespace,
+        device: torch.device
+    ) -> None:
+
+    '''
+    Compares the forward and backward pass of MultiCropWrapper with the concatenated outputs and the host-side grouping
+    of every step, with the cached grouping and the preallocated output buffer. Backbone, head, and views are tiny, such
+    that the overhead of the wrapper is not hidden by the convolutions.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        device (torch.device): Pytorch device.
+    '''
+    embed_dim = 64
+    backbone = torch.nn.Sequential(torch.nn.AdaptiveAvgPool3d(4), torch.nn.Flatten(), torch.nn.Linear(64, embed_dim))
+    wrapper = MultiCropWrapper(backbone, DINOHead(embed_dim, 256, nlayers=1)).to(device)
+    print(f'{"crops":>6} {"concat (ms)":>12} {"buffer (ms)":>12} {"speedup":>8}')
+    for num_local_crops in [2, 6, 10]:
+        x = [torch.randn(args.batch_size, 1, 12, 12, 12, device=device) for _ in range(2)]
+        x += [torch.randn(args.batch_size, 1, 8, 8, 8, device=device) for _ in range(num_local_crops)]
+        assert torch.allclose(wrapper(x), reference_multi_crop_forward(wrapper, x))
+        concat = time_fn(lambda: reference_multi_crop_forward(wrapper, x).sum().backward(), device, args.num_repeats)
+        buffer = time_fn(lambda: wrapper(x).sum().backward(), device, args.num_repeats)
+        print(f'{2 + num_local_crops:>6} {concat:>12.2f} {buffer:>12.2f} {concat / buffer:>7.2f}x')
+
+def center_update_worker(
+        rank: int,
+        world_size: int,
+        port: int,
+        args: argparse.Namespace,
+        results: mp.SimpleQueue
+    ) -> None:
+
+    '''
+    Times DINO steps of a data parallel head with the blocking and the asynchronous center update on one gloo rank.
+
+    Args:
+        rank (int): Rank of the process.
+        world_size (int): Number of processes.
+        port (int): Port of the process group.
+        args (argparse.Namespace): Command line arguments.
+        results (mp.SimpleQueue): Queue the first rank puts the step times and final centers into.
+    '''
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port))
+    torch.set_num_threads(1)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    embed_dim, out_dim, num_crops = 96, 16384, 4
+    output = {}
+    for async_center in [False, True]:
+        torch.manual_seed(rank)
+        student = DDP(DINOHead(embed_dim, out_dim, nlayers=2))
+        teacher = DINOHead(embed_dim, out_dim, nlayers=2)
+        teacher.load_state_dict(student.module.state_dict())
+        loss_fn = DINOLoss(out_dim, num_crops, num_steps=100, teacher_temp=0.04, teacher_warmup_temp=0.04, teacher_warmup_steps=0, async_center=async_center)
+        optim = torch.optim.SGD(student.parameters(), lr=0.01)
+        features = torch.randn(num_crops * args.batch_size * 8, embed_dim)
+
+        def step():
+            with torch.no_grad():
+                teacher_output = teacher(features[:2 * args.batch_size * 8])
+            loss_fn(0, student(features), teacher_output).backward()
+            optim.step()
+            optim.zero_grad(set_to_none=True)
+
+        dist.barrier()
+        step_time = time_fn(step, torch.device('cpu'), args.num_repeats)
+        loss_fn.sync_center()
+        output[async_center] = (step_time, loss_fn.center.numpy())
+    if rank == 0:
+        results.put(output)
+    dist.destroy_process_group()
+
+def benchmark_center_update(
+        args: argparse.Namespace,
+        device: torch.device
+    ) -> None:
+
+    '''
+    Compares the step time of DINO pretraining with the blocking all-reduce of the teacher center in the forward pass
+    with the asynchronous one, which is overlapped with the backward pass and the optimizer step, on 2 to 8 gloo
+    processes on the CPU.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        device (torch.device): Pytorch device, unused as all processes run on the CPU.
+    '''
+    ctx = mp.get_context('spawn')
+    print(f'{"ranks":>6} {"blocking (ms)":>14} {"async (ms)":>11} {"speedup":>8} {"center error":>13}')
+    for i, world_size in enumerate([2, 4, 8]):
+        results = ctx.SimpleQueue()
+        context = mp.start_processes(center_update_worker, args=(world_size, 29541 + i, args, results), nprocs=world_size, join=False, start_method='spawn')
+        # the centers do not fit into the pipe buffer, they are read before joining
+        output = results.get()
+        context.join()
+        (blocking, center), (overlapped, async_center) = output[False], output[True]
+        error = np.abs(center - async_center).max()
+        print(f'{world_size:>6} {blocking:>14.1f} {overlapped:>11.1f} {blocking / overlapped:>7.2f}x {error:>13.2e}')
+
+def benchmark_teacher_ema(
+        args: argparse.Namespace,
+        device: torch.device
+    ) -> None:
+
+    '''
+    Compares the EMA update of the teacher with a loop over the parameters with the fused multi-tensor update, every
+    step and every k steps with the momentum m^k, on the parameters of a ConvNeXt3d tiny with a DINO head.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        device (torch.device): Pytorch device.
+    '''
+    student = MultiCropWrapper(convnext3d_tiny(in_chans=1), DINOHead(768, 4096)).to(device)
+    teacher = MultiCropWrapper(convnext3d_tiny(in_chans=1), DINOHead(768, 4096)).to(device)
+    teacher.load_state_dict(student.state_dict())
+    for p in student.parameters():
+        p.data.add_(torch.randn_like(p), alpha=1e-2)
+    student_params = [p.detach() for p in student.parameters()]
+    teacher_params = [p.detach() for p in teacher.parameters()]
+    print(f'{len(teacher_params)} parameter tensors, {sum(p.numel() for p in teacher_params) / 1e6:.1f}M parameters')
+
+    initial = [p.clone() for p in teacher_params]
+    reference_update_teacher(student, teacher, 0.996)
+    expected = [p.clone() for p in teacher_params]
+    for p, q in zip(teacher_params, initial):
+        p.copy_(q)
+    update_ema(teacher_params, student_params, 0.996)
+    error = max((p - q).abs().max().item() for p, q in zip(teacher_params, expected))
+    print(f'max error: {error:.2e}')
+
+    loop = time_fn(lambda: reference_update_teacher(student, teacher, 0.996), device, args.num_repeats)
+    fused = time_fn(lambda: update_ema(teacher_params, student_params, 0.996), device, args.num_repeats)
+    print(f'{"update every":>12} {"loop (ms)":>10} {"fused (ms)":>11} {"speedup":>8}')
+    for k in [1, 4, 16]:
+        # time per training step, the update runs every k-th step
+        print(f'{k:>12} {loop:>10.2f} {fused / k:>11.2f} {loop * k / fused:>7.2f}x')
+
+def benchmark_flat_params(
+        args: argparse.Namespace,
+        device: torch.device
+    ) -> None:
+
+    '''
+    Compares the per-step parameter bookkeeping of DINO pretraining on separate parameter tensors with the one on flat
+    parameter and gradient buffers, on a ConvNeXt3d tiny with a DINO head. Checks that two training steps with
+    gradient clipping and AdamW give the same parameters in both cases.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        device (torch.device): Pytorch device.
+    '''
+
+    def create_models(flat: bool) -> tuple:
+        torch.manual_seed(0)
+        student = MultiCropWrapper(convnext3d_tiny(in_chans=1), DINOHead(768, 4096)).to(device)
+        teacher = MultiCropWrapper(convnext3d_tiny(in_chans=1), DINOHead(768, 4096)).to(device)
+        flat_params = [FlatParameters(student), FlatParameters(teacher, grads=False)] if flat else None
+        if flat:
+            flat_params[1].copy_(flat_params[0])
+        else:
+            teacher.load_state_dict(student.state_dict())
+        for p in teacher.parameters():
+            p.requires_grad = False
+        optimizer = torch.optim.AdamW(student.parameters(), lr=1e-3)
+        return student, teacher, flat_params, optimizer
+
+    def train_step(student, teacher, flat_params, optimizer) -> None:
+        # the loss is large enough for the gradients to be clipped
+        student(x).square().sum().backward()
+        if flat_params is not None:
+            flat_params[0].clip_grad_norm_(max_norm=1.0)
+        else:
+            torch.nn.utils.clip_grad_norm_(student.parameters(), max_norm=1.0)
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        if flat_params is not None:
+            flat_params[0].attach_grads()
+            update_ema([flat_params[1].data], [flat_params[0].data], 0.996)
+        else:
+            update_ema([p.detach() for p in teacher.parameters()], [p.detach() for p in student.parameters()], 0.996)
+
+    x = [torch.randn(2, 1, 32, 32, 32, device=device) for _ in range(2)]
+    params = {}
+    for flat in [False, True]:
+        student, teacher, flat_params, optimizer = create_models(flat)
+        for _ in range(2):
+            train_step(student, teacher, flat_params, optimizer)
+        params[flat] = [p.detach().clone() for p in list(student.parameters()) + list(teacher.parameters())]
+    error = max((p - q).abs().max().item() for p, q in zip(params[False], params[True]))
+    print(f'max parameter error after two steps: {error:.2e}')
+
+    print(f'{"operation":>16} {"separate (ms)":>14} {"flat (ms)":>10} {"speedup":>8}')
+    results = {}
+    for flat in [False, True]:
+        student, teacher, flat_params, optimizer = create_models(flat)
+        results[flat] = {'train step': time_fn(lambda: train_step(student, teacher, flat_params, optimizer), device, args.num_repeats)}
+        for p in student.parameters():
+            if p.requires_grad:
+                p.grad = p.grad.normal_() if flat else torch.randn_like(p)
+        student_params = [flat_params[0].data] if flat else [p.detach() for p in student.parameters()]
+        teacher_params = [flat_params[1].data] if flat else [p.detach() for p in teacher.parameters()]
+        if flat:
+            clip = lambda: flat_params[0].clip_grad_norm_(max_norm=1.0)
+            copy = lambda: flat_params[1].copy_(flat_params[0])
+        else:
+            clip = lambda: torch.nn.utils.clip_grad_norm_(student.parameters(), max_norm=1.0)
+            copy = lambda: teacher.load_state_dict(student.state_dict())
+        results[flat].update({
+            'clip grad norm': time_fn(clip, device, args.num_repeats),
+            'teacher ema': time_fn(lambda: update_ema(teacher_params, student_params, 0.996), device, args.num_repeats),
+            'teacher copy': time_fn(copy, device, args.num_repeats)})
+    for name in results[False]:
+        separate, flat = results[False][name], results[True][name]
+        print(f'{name:>16} {separate:>14.2f} {flat:>10.2f} {separate / flat:>7.2f}x')
+
+def benchmark_shuffle_sequence(
+        args: argparse.Namespace,
+        device: torch.device
+    ) -> None:
+
+    '''
+    Compares the shuffling of the sequences for transformer pretraining with a loop over the sequences with the
+    batched sort over random keys. Checks that both give uniformly distributed permutations and the same labels.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        device (torch.device): Pytorch device.
+    '''
+    model = MedNet(convnext3d_femto(in_chans=4), num_classes=1, num_layers=4).to(device)
+    S, num_samples = args.seq_length + 1, 24000
+    # frequencies of the 4! permutations of four timepoints after the cls token
+    x = torch.arange(5, dtype=torch.float, device=device).expand(num_samples, 5)[..., None]
+    pad_mask = torch.zeros(num_samples, 5, device=device)
+    for name, fn in [('loop', reference_shuffle_sequence), ('sort', model.shuffle_sequence)]:
+        output, _ = fn(x.clone(), pad_mask, prob=1.0)
+        _, counts = torch.unique(output[..., 0], dim=0, return_counts=True)
+        freqs = counts.float() / num_samples
+        print(f'{name}: {len(counts)} permutations, frequencies in [{freqs.min():.4f}, {freqs.max():.4f}], uniform {1 / 24:.4f}')
+
+    # labels as a function of the number of real timepoints
+    print(f'{"real timepoints":>16} {"loop label rate":>16} {"sort label rate":>16}')
+    for num_real in range(1, S):
+        pad_mask = torch.zeros(num_samples, S, device=device)
+        pad_mask[:, num_real + 1:] = 1
+        x = torch.randn(num_samples, S, 1, device=device)
+        _, expected = reference_shuffle_sequence(x.clone(), pad_mask, prob=0.66)
+        _, labels = model.shuffle_sequence(x.clone(), pad_mask, prob=0.66)
+        print(f'{num_real:>16} {expected.mean().item():>16.3f} {labels.mean().item():>16.3f}')
+
+    print(f'{"batch size":>10} {"loop (ms)":>10} {"sort (ms)":>10} {"speedup":>8}')
+    for batch_size in [8, 64, 512]:
+        x = torch.randn(batch_size, S, model.d_model, device=device)
+        pad_mask = torch.zeros(batch_size, S, device=device)
+        for i, num_real in enumerate(torch.randint(1, S, (batch_size,)).tolist()):
+            pad_mask[i, num_real + 1:] = 1
+        loop = time_fn(lambda: reference_shuffle_sequence(x.clone(), pad_mask, prob=0.66), device, args.num_repeats)
+        sort = time_fn(lambda: model.shuffle_sequence(x.clone(), pad_mask, prob=0.66), device, args.num_repeats)
+        print(f'{batch_size:>10} {loop:>10.2f} {sort:>10.2f} {loop / sort:>7.2f}x')
+
+BENCHMARKS = {
+    'packed_features': benchmark_packed_features,
+    'load_data': benchmark_load_data,
+    'bucketing': benchmark_bucketing,
+    'yeo_johnson': benchmark_yeo_johnson,
+    'soft_clip': benchmark_soft_clip,
+    'batched_prep': benchmark_batched_prep,
+    'prep_roi': benchmark_prep_roi,
+    'lazy_resample': benchmark_lazy_resample,
+    'nifti_io': benchmark_nifti_io,
+    'volume_store': benchmark_volume_store,
+    'batched_augmentation': benchmark_batched_augmentation,
+    'multi_crop': benchmark_multi_crop,
+    'dino_loss': benchmark_dino_loss,
+    'multi_crop_wrapper': benchmark_multi_crop_wrapper,
+    'center_update': benchmark_center_update,
+    'teacher_ema': benchmark_teacher_ema,
+    'flat_params': benchmark_flat_params,
+    'shuffle_sequence': benchmark_shuffle_sequence
+}
+
+def parse_args() -> argparse.Namespace:
+
+    '''
+    Parse command line arguments.
+
+    Returns:
+        argparse.Namespace: Command line arguments.
+    '''
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("benchmark", type=str, choices=list(BENCHMARKS),
+                        help="Benchmark to run.")
+    parser.add_argument("--batch-size", default=4, type=int,
+                        help="Number of unique observations in a batch. Defaults to 4.")
+    parser.add_argument("--seq-length", default=7, type=int,
+                        help="Length of the padded image sequences. Defaults to 7.")
+    parser.add_argument("--image-size", default=72, type=int,
+                        help="Spatial size of the input images. Defaults to 72.")
+    parser.add_argument("--num-sequences", default=256, type=int,
+                        help="Number of synthetic image sequences. Defaults to 256.")
+    parser.add_argument("--num-observations", default=100000, type=int,
+                        help="Number of observations in the synthetic directory tree. Defaults to 100000.")
+    parser.add_argument("--num-repeats", default=10, type=int,
+                        help="Number of timed repetitions per measurement. Defaults to 10.")
+    parser.add_argument("--cpu", action='store_true',
+                        help="Whether to run the benchmark on the CPU even if a GPU is available.")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.cpu else 'cpu')
+    BENCHMARKS[args.benchmark](args, device)
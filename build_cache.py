@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import argparse
+import time
+import torch
+from multiprocessing import get_context
+from tqdm import tqdm
+from monai.utils.misc import ensure_tuple_rep
+from data.cache import PersistentCache, fill_cache
+from data.utils import DatasetPreprocessor
+from utils.transforms import transforms
+from utils.config import parse_args
+
+_cache = None
+_device = None
+
+def init_worker(
+        args: argparse.Namespace
+    ) -> None:
+
+    '''
+    Args:
+        args (argparse.Namespace): Command line arguments.
+    '''
+    global _cache, _device
+    torch.set_num_threads(1)
+    _device = torch.device('cuda') if torch.cuda.is_available() and args.prep_batch_size > 1 else None
+    _cache = PersistentCache(
+        cache_dir=args.cache_dir,
+        transform=transforms(
+            dataset='prep',
+            modalities=args.mod_list,
+            device=torch.device('cpu'),
+            crop_size=ensure_tuple_rep(args.global_crop_size, 3)),
+        image_keys=args.mod_list,
+        dtype=args.cache_dtype,
+        max_size=args.cache_size)
+
+def cache_observations(
+        data: list
+    ) -> int:
+
+    '''
+    Args:
+        data (list): Input data containing the image paths of single observations, whose intensity transforms
+            are batched on the GPU if --prep-batch-size is larger than 1.
+    '''
+    fill_cache(_cache, data, batch_size=len(data), device=_device)
+    return len(data)
+
+def main(
+        args: argparse.Namespace
+    ) -> None:
+
+    '''
+    Prebuilds the persistent cache of preprocessed images for all complete observations in parallel.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+    '''
+    if args.cache_dir is None:
+        raise ValueError('Please specify a path to the cache directory.')
+    start_time = time.time()
+    preprocessor = DatasetPreprocessor(data_dir=args.data_dir)
+    observation_list = preprocessor.assert_observation_completeness(args.mod_list)
+    modality_dict = {modality: preprocessor.split_observations_by_modality(observation_list, modality) for modality in args.mod_list}
+    data_dict = preprocessor.create_data_dict(observation_list, modality_dict)
+    # Observations with unreadable images are skipped, and observations of the same shape end up in the same chunk.
+    headers, corrupt = preprocessor.probe_headers(data_dict, args.mod_list, num_workers=args.num_workers)
+    for patient in corrupt:
+        print(f'Skipping observation {patient["uid"]} with unreadable images')
+    data_dict = sorted((patient for patient in data_dict if patient['uid'] in headers), key=lambda patient: headers[patient['uid']][args.mod_list[0]]['shape'])
+
+    # All phases read the shared preprocessing prefix from the cache and apply the remaining transforms in memory.
+    chunks = [data_dict[idx:idx + args.prep_batch_size] for idx in range(0, len(data_dict), args.prep_batch_size)]
+    with get_context('fork').Pool(args.num_workers, initializer=init_worker, initargs=(args,)) as pool:
+        with tqdm(total=len(data_dict), desc='Caching images') as progress:
+            for num_cached in pool.imap_unordered(cache_observations, chunks):
+                progress.update(num_cached)
+    init_worker(args)
+    _cache.prune()
+    cache_size = sum(size for _, size, _ in _cache.entries())
+    time_elapsed = time.time() - start_time
+    print(f'Cache built in {time_elapsed // 60:.0f}min {time_elapsed % 60:.0f}sec ({cache_size / 1024 ** 3:.2f} GB in {args.cache_dir})')
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
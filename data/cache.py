@@ -0,0 +1,360 @@
+from __future__ import annotations
+
+from collections.abc import Sequence
+from typing import Any
+from enum import Enum
+from monai.data import MetaTensor
+from monai.data.meta_obj import get_track_meta
+from monai.transforms import Compose, EnsureTyped, RandomizableTrait, ToDeviced, Transform
+from multiprocessing.pool import ThreadPool
+from tqdm import tqdm
+import torch
+import numpy as np
+import hashlib
+import pickle
+import shutil
+import uuid
+import os
+
+# Bump whenever the on-disk layout or the semantics of the custom transforms change.
+CACHE_VERSION = 5
+# Node-local shared memory, cache entries in here are memory-mapped by all processes on the node without copies.
+SHARED_CACHE_DIR = '/dev/shm/hccnet_cache'
+
+def _config_repr(
+        obj: Any,
+        seen: set
+    ) -> str:
+
+    '''
+    Builds a deterministic string representation of a (possibly nested) transform configuration.
+
+    Args:
+        obj (Any): Object to represent.
+        seen (set): Ids of the objects that have already been visited.
+    '''
+    if obj is None or isinstance(obj, (bool, int, float, str, bytes)):
+        return repr(obj)
+    if isinstance(obj, Enum):
+        return str(obj.value)
+    if isinstance(obj, (torch.dtype, torch.device, np.dtype, type)):
+        return str(obj)
+    if isinstance(obj, (np.ndarray, torch.Tensor)):
+        return repr(np.asarray(obj.detach().cpu() if isinstance(obj, torch.Tensor) else obj).tolist())
+    if isinstance(obj, np.generic):
+        return repr(obj.item())
+    if id(obj) in seen:
+        return '<cycle>'
+    seen.add(id(obj))
+    if isinstance(obj, (list, tuple)):
+        return '[' + ','.join(_config_repr(item, seen) for item in obj) + ']'
+    if isinstance(obj, dict):
+        return '{' + ','.join(f'{key!r}:{_config_repr(obj[key], seen)}' for key in sorted(obj, key=repr)) + '}'
+    if hasattr(obj, '__code__'):
+        code = obj.__code__
+        consts = [const for const in code.co_consts if not hasattr(const, 'co_code')]
+        return f'{obj.__module__}.{obj.__qualname__}:{code.co_code.hex()}:{_config_repr(consts, seen)}:{code.co_names}'
+    if hasattr(obj, '__dict__'):
+        return type(obj).__qualname__ + _config_repr(vars(obj), seen)
+    return type(obj).__qualname__
+
+def hash_transforms(
+        transform: Compose,
+        end: int,
+        dtype: str
+    ) -> str:
+
+    '''
+    Args:
+        transform (Compose): Chain of transforms to hash.
+        end (int): Index after the last transform to hash.
+        dtype (str): Data type the results are stored in.
+
+    Returns:
+        str: Hash of the configuration of the first transforms in the chain, including the lazy resampling settings
+            of the chain, which are applied to all pending transforms.
+    '''
+    config = _config_repr([CACHE_VERSION, transform.lazy, transform.overrides, dtype] + list(transform.transforms[:end]), set())
+    return hashlib.sha1(config.encode()).hexdigest()
+
+def persistent_end(
+        transform: Compose,
+        end: int | None
+    ) -> int:
+
+    '''
+    Returns the index of the first transform that should not be stored on disk, i.e., the first
+    transform that moves the data onto a (possibly rank specific) device.
+
+    Args:
+        transform (Compose): Chain of transforms.
+        end (int | None): Index of the first random transform or None if all transforms are deterministic.
+    '''
+    end = len(transform.transforms) if end is None else end
+    for idx, t in enumerate(transform.transforms[:end]):
+        if isinstance(t, (EnsureTyped, ToDeviced)):
+            return idx
+    return end
+
+class PersistentCache:
+
+    '''
+    Content-addressed on-disk cache of deterministically preprocessed images. Each entry is keyed on the image
+    paths, their modification times and sizes, as well as a hash of the transform chain's configuration. Image
+    arrays are stored as raw .npy files, which are memory-mapped when loaded, such that warm restarts skip
+    decoding and resampling entirely. When the cache grows beyond its maximum size, the least recently used
+    entries are evicted.
+    '''
+
+    def __init__(
+            self,
+            cache_dir: str,
+            transform: Compose,
+            image_keys: str | list,
+            end: int | None = None,
+            dtype: str = 'float32',
+            max_size: float | None = None
+        ) -> None:
+
+        '''
+        Args:
+            cache_dir (str): Path to the cache directory.
+            transform (Compose): Chain of transforms whose deterministic prefix is cached.
+            image_keys (str | list): Keys of the image paths in the input data.
+            end (int | None): Index after the last transform to cache. Defaults to the first random transform.
+            dtype (str): Data type to store the images in. Can be 'float16' or 'float32'. Defaults to 'float32'.
+            max_size (float | None): Maximum size of the cache in gigabytes. Defaults to None (no limit).
+        '''
+        if dtype not in ['float16', 'float32']:
+            raise ValueError("dtype must be 'float16' or 'float32'.")
+        self.cache_dir = cache_dir
+        self.transform = transform
+        self.image_keys = [image_keys] if isinstance(image_keys, str) else image_keys
+        if end is None:
+            end = transform.get_index_of_first(lambda t: isinstance(t, RandomizableTrait) or not isinstance(t, Transform))
+        self.end = persistent_end(transform, end)
+        self.dtype = dtype
+        self.max_size = None if max_size is None else int(max_size * 1024 ** 3)
+        self.transform_hash = hash_transforms(transform, self.end, dtype)
+        self._size = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(
+            self,
+            data: dict
+        ) -> str:
+
+        '''
+        Args:
+            data (dict): Input data containing the image paths of a single observation.
+        '''
+        key = hashlib.sha1(self.transform_hash.encode())
+        for image_key in self.image_keys:
+            paths = data.get(image_key, [])
+            for path in [paths] if isinstance(paths, str) else paths:
+                path = os.path.abspath(path)
+                stat = os.stat(path)
+                key.update(f'{image_key}:{path}:{stat.st_mtime_ns}:{stat.st_size};'.encode())
+        return key.hexdigest()
+
+    def _entry_dir(
+            self,
+            key: str
+        ) -> str:
+
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def contains(
+            self,
+            data: dict,
+            key: str | None = None
+        ) -> bool:
+
+        '''
+        Args:
+            data (dict): Input data containing the image paths of a single observation.
+            key (str | None): Precomputed cache key of the observation.
+        '''
+        return os.path.exists(os.path.join(self._entry_dir(self.key(data) if key is None else key), 'meta.pkl'))
+
+    def load(
+            self,
+            data: dict,
+            key: str | None = None
+        ) -> dict | None:
+
+        '''
+        Args:
+            data (dict): Input data containing the image paths of a single observation.
+            key (str | None): Precomputed cache key of the observation.
+
+        Returns:
+            dict | None: Cached output of the transform chain or None if the observation is not cached.
+        '''
+        entry_dir = self._entry_dir(self.key(data) if key is None else key)
+        try:
+            with open(os.path.join(entry_dir, 'meta.pkl'), 'rb') as f:
+                meta = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        try:
+            # mark the entry as recently used
+            os.utime(entry_dir)
+        except OSError:
+            pass
+
+        output = dict(meta['values'])
+        output.update({key: value for key, value in data.items() if key not in self.image_keys})
+        for name, affine in meta['arrays'].items():
+            # copy-on-write mapping: in-place transforms downstream never touch the files on disk
+            array = torch.from_numpy(np.load(os.path.join(entry_dir, name + '.npy'), mmap_mode='c'))
+            if affine is not None and get_track_meta():
+                array = MetaTensor(array, affine=torch.as_tensor(affine))
+            output[name] = array
+        return output
+
+    def save(
+            self,
+            data: dict,
+            output: dict,
+            key: str | None = None
+        ) -> None:
+
+        '''
+        Args:
+            data (dict): Input data containing the image paths of a single observation.
+            output (dict): Output of the transform chain to store.
+            key (str | None): Precomputed cache key of the observation.
+        '''
+        entry_dir = self._entry_dir(self.key(data) if key is None else key)
+        tmp_dir = f'{entry_dir}.{uuid.uuid4().hex}.tmp'
+        os.makedirs(tmp_dir)
+        meta = {'arrays': {}, 'values': {}}
+        for name, value in output.items():
+            if isinstance(value, (torch.Tensor, np.ndarray)):
+                affine = value.affine.cpu().numpy() if isinstance(value, MetaTensor) else None
+                array = value.detach().cpu().numpy() if isinstance(value, torch.Tensor) else value
+                np.save(os.path.join(tmp_dir, name + '.npy'), np.ascontiguousarray(array, dtype=self.dtype))
+                meta['arrays'][name] = affine
+            elif name not in data:
+                meta['values'][name] = value
+        with open(os.path.join(tmp_dir, 'meta.pkl'), 'wb') as f:
+            pickle.dump(meta, f)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another process stored the same entry in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        if self.max_size is not None:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self.entries())
+            else:
+                self._size += sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+            if self._size > self.max_size:
+                self.prune()
+
+    def __call__(
+            self,
+            data: dict
+        ) -> dict:
+
+        '''
+        Loads the cached output of the transform chain or computes and stores it if the observation is not cached.
+
+        Args:
+            data (dict): Input data containing the image paths of a single observation.
+        '''
+        key = self.key(data)
+        output = self.load(data, key)
+        if output is None:
+            output = self.transform(data, end=self.end, threading=True)
+            self.save(data, output, key)
+            output = self.load(data, key) or output
+        return output
+
+    def entries(self) -> list:
+
+        '''
+        Returns:
+            list: Tuples of entry directory, size in bytes, and last access time of all cache entries.
+        '''
+        entries = []
+        for prefix in os.scandir(self.cache_dir):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if not entry.is_dir() or entry.name.endswith('.tmp'):
+                    continue
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.path, size, entry.stat().st_mtime))
+        return entries
+
+    def prune(self) -> None:
+
+        '''
+        Evicts the least recently used entries until the cache fits into its maximum size.
+        '''
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        self._size = sum(size for _, size, _ in entries)
+        if self.max_size is None:
+            return
+        for entry_dir, size, _ in entries:
+            if self._size <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            self._size -= size
+
+    def clear(self) -> None:
+
+        '''
+        Removes all entries from the cache directory.
+        '''
+        for prefix in os.scandir(self.cache_dir):
+            if prefix.is_dir():
+                shutil.rmtree(prefix.path, ignore_errors=True)
+        self._size = 0
+
+def fill_cache(
+        cache: PersistentCache,
+        data: Sequence[dict],
+        num_workers: int = 1,
+        progress: bool = False,
+        batch_size: int = 1,
+        device: torch.device | None = None
+    ) -> None:
+
+    '''
+    Computes and stores all observations that are not cached yet.
+
+    Args:
+        cache (PersistentCache): Cache to fill.
+        data (Sequence[dict]): Input data containing the image paths of single observations.
+        num_workers (int): Number of worker threads. Defaults to 1.
+        progress (bool): Whether to display a progress bar. Defaults to False.
+        batch_size (int): Number of observations that are preprocessed together by the batched engine. Defaults to 1
+            (every observation is preprocessed on its own).
+        device (torch.device | None): Device to run the batched transforms on. Defaults to None (no batching).
+    '''
+    if batch_size > 1 and device is not None:
+        # imported here, as the engine depends on the custom transforms
+        from data.engine import BatchedCompose
+        engine = BatchedCompose(cache.transform, end=cache.end, num_workers=num_workers, device=device)
+        keys = [cache.key(item) for item in data]
+        missing = [(item, key) for item, key in zip(data, keys) if not cache.contains(item, key)]
+        batches = range(0, len(missing), batch_size)
+        for start in tqdm(batches, desc='Filling cache') if progress else batches:
+            batch = missing[start:start + batch_size]
+            for (item, key), output in zip(batch, engine([item for item, _ in batch])):
+                cache.save(item, output, key)
+        return
+
+    def cache_item(item: dict) -> None:
+        key = cache.key(item)
+        if not cache.contains(item, key):
+            cache.save(item, cache.transform(item, end=cache.end, threading=True), key)
+
+    with ThreadPool(max(num_workers, 1)) as p:
+        items = p.imap_unordered(cache_item, data)
+        for _ in tqdm(items, total=len(data), desc='Filling cache') if progress else items:
+            pass
@@ -11,6 +11,8 @@ from monai.transforms import (
     convert_to_contiguous
 )
 from monai.data import CacheDataset
+from data.cache import PersistentCache
+from data.store import VolumeStore
 from copy import deepcopy
 from monai.data.utils import pickle_hashing
 from multiprocessing.managers import ListProxy
@@ -25,6 +27,25 @@ from tqdm import tqdm
 
 has_tqdm = True
 
+def split_sequence(item: dict, image_keys: list) -> list:
+    """
+    Split a single data sequence into a list of data items, one per image in the sequence.
+
+    Args:
+        item: data sequence, where every key maps to a list of values.
+        image_keys: keys to create imaging data from (e.g., 'T1' or 'T2').
+
+    """
+    data_keys = [key for key in item.keys() if key not in image_keys]
+    seq_len = len(item[image_keys[0]])
+    item_seq = []
+    for i in range(seq_len):
+        image_dict = {key: [item[key][i]] for key in image_keys}
+        data_dict = {key: item[key][i] for key in data_keys}
+        image_dict.update(data_dict)
+        item_seq.append(image_dict)
+    return item_seq
+
 class SeqDataset(_TorchDataset):
     """
     A generic dataset for longitudinal imaging data that has a length property and an 
@@ -59,14 +80,8 @@ class SeqDataset(_TorchDataset):
         Fetch single data item from `self.data`.
         """
     
-        data_keys = list(self.data[idx].keys())
-        data_keys = [key for key in data_keys if key not in self.image_keys]
-        seq_len = len(self.data[idx][self.image_keys[0]])
         item_seq = []
-        for i in range(seq_len):
-            image_dict = {key: [self.data[idx][key][i]] for key in self.image_keys}
-            data_dict = {key: self.data[idx][key][i] for key in data_keys}
-            image_dict.update(data_dict) 
+        for image_dict in split_sequence(self.data[idx], self.image_keys):
             data = apply_transform(self.transform, image_dict)
             item_seq.append(data)
 
@@ -157,6 +172,11 @@ class CacheSeqDataset(SeqDataset, CacheDataset):
         hash_as_key: bool = False,
         hash_func: Callable[..., bytes] = pickle_hashing,
         runtime_cache: bool | str | list | ListProxy = False,
+        cache_dir: str | None = None,
+        cache_dtype: str = 'float32',
+        cache_size: float | None = None,
+        cache_end: int | None = None,
+        store: VolumeStore | None = None,
     ) -> None:
         """
         Args:
@@ -198,11 +218,31 @@ class CacheSeqDataset(SeqDataset, CacheDataset):
                 where this class is initialized in subprocesses, option 3 is recommended,
                 and the list-like object should be prepared in the main process and passed to all subprocesses.
                 Not following these recommendations may lead to runtime errors or duplicated cache across processes.
+            cache_dir: directory of the persistent on-disk cache of the deterministic transforms' results.
+                if None, the deterministic transforms are recomputed every time the dataset is created.
+            cache_dtype: data type to store the images in the persistent cache. Can be 'float16' or 'float32'.
+            cache_size: maximum size of the persistent cache in gigabytes. if None, the cache size is not limited.
+            cache_end: index after the last transform to store in the persistent cache, e.g., the end of the
+                deterministic preprocessing that is shared with other chains. if None, all deterministic transforms
+                up to the first one that moves the data onto a device are stored.
+            store: volume store of the exported deterministic transforms' results to read the images from instead of
+                the image files. takes precedence over `cache_dir`. the images are memory-mapped, so they are not
+                cached in memory but read from the store on every access, and all remaining transforms are applied.
 
         """
         if not isinstance(transform, Compose):
             transform = Compose(transform)
         self.image_keys = [image_keys] if isinstance(image_keys, str) else image_keys
+        self.persistent_cache = None
+        self.store = store
+        if cache_dir is not None and store is None:
+            self.persistent_cache = PersistentCache(
+                cache_dir=cache_dir,
+                transform=transform,
+                image_keys=self.image_keys,
+                end=cache_end,
+                dtype=cache_dtype,
+                max_size=cache_size)
         SeqDataset.__init__(
             self, 
             data=data, 
@@ -212,7 +252,7 @@ class CacheSeqDataset(SeqDataset, CacheDataset):
             self,
             data=data,
             transform=transform,
-            cache_num=cache_num,
+            cache_num=0 if store is not None else cache_num,
             cache_rate=cache_rate,
             num_workers=num_workers,
             progress=progress,
@@ -231,15 +271,13 @@ class CacheSeqDataset(SeqDataset, CacheDataset):
             lambda t: isinstance(t, RandomizableTrait) or not isinstance(t, Transform)
         )
 
-        data_keys = list(self.data[idx].keys())
-        data_keys = [key for key in data_keys if key not in self.image_keys]
-        seq_len = len(self.data[idx][self.image_keys[0]])
         item_seq = []
-        for i in range(seq_len):
-            image_dict = {key: [self.data[idx][key][i]] for key in self.image_keys}
-            data_dict = {key: self.data[idx][key][i] for key in data_keys}
-            image_dict.update(data_dict) 
-            data = self.transform(image_dict, end=first_random, threading=True)
+        for image_dict in split_sequence(self.data[idx], self.image_keys):
+            if self.persistent_cache is not None:
+                data = self.persistent_cache(image_dict)
+                data = self.transform(data, start=self.persistent_cache.end, end=first_random, threading=True)
+            else:
+                data = self.transform(image_dict, end=first_random, threading=True)
             item_seq.append(data)
 
         if self.as_contiguous:
@@ -247,6 +285,12 @@ class CacheSeqDataset(SeqDataset, CacheDataset):
         return item_seq
 
     def _transform(self, index: int):
+        if self.store is not None:
+            # the images of a sequence are adjacent in the store and fetched at once, random crops of the
+            # memory-mapped images only materialize the cropped region
+            item_seq = self.store.load_sequence(split_sequence(self.data[index], self.image_keys))
+            return [self.transform(data, start=self.store.end) for data in item_seq]
+
         cache_index = None
         if self.hash_as_key:
             key = self.hash_func(self.data[index])
@@ -280,3 +324,48 @@ class CacheSeqDataset(SeqDataset, CacheDataset):
 
         return data
 
+
+
+class SeqDatasetView(_TorchDataset):
+    """
+    Lightweight view on a subset of the sequences of a `CacheSeqDataset`, e.g., a single cross-validation fold.
+
+    The base dataset caches the results of the deterministic preprocessing once for all sequences. The view
+    only stores indices into the base dataset and applies the remaining transforms of its own chain, i.e., all
+    transforms after the ones that make up the base dataset's chain, every time an item is loaded. The items are
+    neither copied nor cached by the view, so the remaining transforms must not modify their input in-place.
+
+    For example, with a base dataset over all development sequences that runs ``transforms(dataset='prep')``::
+
+        train_views = [SeqDatasetView(base, train_idx[k], transforms(dataset='train')) for k in folds]
+        val_views = [SeqDatasetView(base, val_idx[k], transforms(dataset='val')) for k in folds]
+
+    """
+
+    def __init__(
+        self,
+        dataset: CacheSeqDataset,
+        indices: Sequence[int],
+        transform: Sequence[Callable] | Callable,
+    ) -> None:
+        """
+        Args:
+            dataset: base dataset whose cached sequences are shared between views.
+            indices: indices of the view's sequences in the base dataset.
+            transform: transforms to execute operations on input data. The first transforms have to match the
+                chain of the base dataset, only the transforms after them are executed by the view.
+
+        """
+        if not isinstance(transform, Compose):
+            transform = Compose(transform)
+        self.dataset = dataset
+        self.indices = list(indices)
+        self.transform = transform
+        self.start = len(dataset.transform.transforms)
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, index: int):
+        item_seq = self.dataset[self.indices[index]]
+        return [self.transform(data, start=self.start) for data in item_seq]
@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+from collections.abc import Callable, Sequence
+from collections import defaultdict
+from copy import deepcopy
+from monai.data import MetaTensor
+from monai.transforms import Compose, NormalizeIntensityd, ThreadUnsafe, apply_transform
+from monai.transforms.lazy.functional import apply_pending_transforms
+from monai.utils import get_equivalent_dtype
+from multiprocessing.pool import ThreadPool
+from data.transforms import YeoJohnsond, SoftClipOutliersd
+import torch
+
+# Batched implementations of intensity transforms, keyed on the transform type. Every implementation receives the
+# transform and a stack of same-shaped images of shape (N, C, H, W, D), and returns the transformed stack or None
+# if the configuration of the transform is not supported.
+BATCHED_TRANSFORMS = {}
+
+def register_batched(
+        transform_type: type
+    ) -> Callable:
+
+    '''
+    Args:
+        transform_type (type): Type of the transform that the decorated function implements for stacks of images.
+    '''
+    def register(fn: Callable) -> Callable:
+        BATCHED_TRANSFORMS[transform_type] = fn
+        return fn
+    return register
+
+def _channel_shape(x: torch.Tensor, channel_wise: bool) -> tuple:
+
+    return (x.shape[0], x.shape[1] if channel_wise else 1) + (1,) * (x.ndim - 2)
+
+@register_batched(YeoJohnsond)
+def yeo_johnson(
+        transform: YeoJohnsond,
+        x: torch.Tensor
+    ) -> torch.Tensor:
+
+    lmbda = torch.as_tensor(transform.lmbda, dtype=x.dtype, device=x.device)
+    if transform.channel_wise and lmbda.ndim > 0:
+        lmbda = lmbda.reshape(1, -1, *[1] * (x.ndim - 2))
+    return transform.yeo_johnson(x, lmbda)
+
+@register_batched(SoftClipOutliersd)
+def soft_clip(
+        transform: SoftClipOutliersd,
+        x: torch.Tensor
+    ) -> torch.Tensor:
+
+    shape = _channel_shape(x, transform.channel_wise)
+    flat = x.reshape(shape[0] * shape[1], -1)
+    if transform.approximate:
+        median, mad = transform.histogram_median_mad(flat, transform.rel_error)
+    else:
+        median, mad = transform.median_mad(flat)
+    mad = mad * 1.4826
+    min_value = (median - mad * transform.scale_factor).reshape(shape)
+    max_value = (median + mad * transform.scale_factor).reshape(shape)
+    return transform.softclip_(x, min_value, max_value)
+
+@register_batched(NormalizeIntensityd)
+def normalize_intensity(
+        transform: NormalizeIntensityd,
+        x: torch.Tensor
+    ) -> torch.Tensor | None:
+
+    normalizer = transform.normalizer
+    dtype = torch.float32 if normalizer.dtype is None else get_equivalent_dtype(normalizer.dtype, torch.Tensor)
+    if normalizer.nonzero or x.dtype != torch.float32 or dtype != torch.float32:
+        return None
+    shape = _channel_shape(x, normalizer.channel_wise)
+    flat = x.reshape(shape[0] * shape[1], -1)
+    if normalizer.subtrahend is None:
+        subtrahend = flat.mean(dim=1).reshape(shape)
+    else:
+        subtrahend = torch.as_tensor(normalizer.subtrahend, dtype=x.dtype, device=x.device).reshape((1, -1) + shape[2:])
+    if normalizer.divisor is None:
+        divisor = flat.std(dim=1, unbiased=False).reshape(shape)
+    else:
+        divisor = torch.as_tensor(normalizer.divisor, dtype=x.dtype, device=x.device).reshape((1, -1) + shape[2:])
+    divisor = torch.where(divisor == 0, torch.ones_like(divisor), divisor)
+    return x.sub_(subtrahend).div_(divisor)
+
+class BatchedCompose:
+
+    '''
+    Runs a range of deterministic transforms stage by stage over a batch of items instead of item by item. For
+    transforms with a batched implementation (see BATCHED_TRANSFORMS), the images of all items that have the same
+    shape are stacked and transformed with single tensor operations on the given device. All other transforms are
+    applied per item on a thread pool, like Compose(threading=True) within CacheDataset. Without a device, every
+    transform is applied per item: on the CPU, stacking whole volumes only adds copies and evicts the caches.
+    '''
+
+    def __init__(
+            self,
+            transform: Compose,
+            start: int = 0,
+            end: int | None = None,
+            num_workers: int = 1,
+            device: torch.device | None = None
+        ) -> None:
+
+        '''
+        Args:
+            transform (Compose): Chain of transforms.
+            start (int): Index of the first transform to run. Defaults to 0.
+            end (int | None): Index after the last transform to run. Defaults to None (the end of the chain).
+            num_workers (int): Number of threads to run unbatched transforms with. Defaults to 1.
+            device (torch.device | None): Device to run batched transforms on. Defaults to None (no batching).
+        '''
+        self.transforms = transform.transforms[start:end]
+        self.lazy = transform.lazy
+        self.overrides = transform.overrides
+        self.num_workers = max(num_workers, 1)
+        self.device = device
+
+    def _apply(
+            self,
+            transform: Callable,
+            items: list
+        ) -> list:
+
+        def apply(item: dict) -> dict:
+            _transform = deepcopy(transform) if isinstance(transform, ThreadUnsafe) else transform
+            return apply_transform(_transform, item, lazy=self.lazy, overrides=self.overrides)
+
+        if self.num_workers == 1 or len(items) == 1:
+            return [apply(item) for item in items]
+        with ThreadPool(min(self.num_workers, len(items))) as p:
+            return p.map(apply, items)
+
+    def _apply_batched(
+            self,
+            transform: Callable,
+            fn: Callable,
+            items: list
+        ) -> list:
+
+        # pending lazy transforms are applied before stacking, like before any other eager transform
+        items = [apply_pending_transforms(item, None, self.overrides) for item in items]
+        groups = defaultdict(list)
+        for idx, item in enumerate(items):
+            if not all(key in item and isinstance(item[key], torch.Tensor) for key in transform.keys):
+                groups[None].append(idx)
+                continue
+            signature = tuple((tuple(item[key].shape), item[key].dtype, item[key].device) for key in transform.keys)
+            groups[signature].append(idx)
+
+        unbatched = groups.pop(None, [])
+        for indices in groups.values():
+            if len(indices) == 1:
+                unbatched.extend(indices)
+                continue
+            outputs = {}
+            for key in transform.keys:
+                x = torch.stack([items[idx][key].as_tensor() if isinstance(items[idx][key], MetaTensor) else items[idx][key] for idx in indices])
+                x = fn(transform, x.to(self.device))
+                if x is None:
+                    break
+                outputs[key] = x
+            if len(outputs) < len(transform.keys):
+                # the items are only updated once all keys are transformed, so no key is transformed twice
+                unbatched.extend(indices)
+                continue
+            for key, x in outputs.items():
+                # the outputs are views into the stack, every image keeps its own meta data
+                for idx, out in zip(indices, x.unbind(0)):
+                    image = items[idx][key]
+                    if isinstance(image, MetaTensor):
+                        out = MetaTensor(out, meta=image.meta, applied_operations=image.applied_operations)
+                    items[idx][key] = out
+
+        if unbatched:
+            for idx, item in zip(unbatched, self._apply(transform, [items[idx] for idx in unbatched])):
+                items[idx] = item
+        return items
+
+    def __call__(
+            self,
+            items: Sequence[dict]
+        ) -> list:
+
+        '''
+        Args:
+            items (Sequence[dict]): Input data of single observations.
+
+        Returns:
+            list: Transformed observations.
+        '''
+        items = list(items)
+        for transform in self.transforms:
+            fn = BATCHED_TRANSFORMS.get(type(transform))
+            if fn is None or self.device is None or len(items) == 1:
+                items = self._apply(transform, items)
+            else:
+                items = self._apply_batched(transform, fn, items)
+        return [apply_pending_transforms(item, None, self.overrides) for item in items]
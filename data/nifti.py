@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+from collections.abc import Sequence
+from multiprocessing.pool import ThreadPool
+from monai.data import NibabelReader
+from monai.data.utils import correct_nifti_header_if_necessary
+from monai.utils import optional_import
+import nibabel as nib
+import numpy as np
+import struct
+import zlib
+import gzip
+import json
+import os
+
+igzip_threaded, has_isal = optional_import('isal.igzip_threaded')
+
+# Sidecar of block-compressed files that stores the offsets of the gzip members, such that they can be inflated in parallel.
+BLOCK_INDEX_SUFFIX = '.blocks'
+# NIfTI-2 headers are the larger ones, reading this many bytes always covers the fixed part of the header.
+HEADER_SIZE = 540
+
+def _header_class(
+        buffer: bytes
+    ) -> type:
+
+    '''
+    Args:
+        buffer (bytes): First bytes of the uncompressed file.
+    '''
+    sizeof_hdr = struct.unpack('<i', buffer[:4])[0]
+    if sizeof_hdr in (540, struct.unpack('>i', struct.pack('<i', 540))[0]):
+        return nib.Nifti2Header
+    return nib.Nifti1Header
+
+def read_header(
+        path: str
+    ) -> dict:
+
+    '''
+    Reads the header of a NIfTI file without decompressing the image data. For gzipped files, only the first
+    blocks of the stream are inflated.
+
+    Args:
+        path (str): Path to the NIfTI file.
+
+    Returns:
+        dict: Shape, voxel spacing, affine, and data type of the image.
+    '''
+    with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as f:
+        buffer = f.read(HEADER_SIZE)
+    header_class = _header_class(buffer)
+    header = header_class(binaryblock=buffer[:header_class.template_dtype.itemsize])
+    return {
+        'shape': tuple(int(size) for size in header.get_data_shape()),
+        'spacing': tuple(float(z) for z in header.get_zooms()[:3]),
+        'affine': header.get_best_affine(),
+        'dtype': header.get_data_dtype()}
+
+def probe_headers(
+        paths: Sequence[str],
+        num_workers: int = 16
+    ) -> tuple:
+
+    '''
+    Args:
+        paths (Sequence[str]): Paths to the NIfTI files.
+        num_workers (int): Number of threads to read the headers with. Defaults to 16.
+
+    Returns:
+        tuple: Headers of all readable files keyed on the path, and the paths of all unreadable files.
+    '''
+
+    def probe(path: str) -> tuple:
+        try:
+            return path, read_header(path)
+        except (OSError, EOFError, ValueError, struct.error, nib.filebasedimages.ImageFileError):
+            return path, None
+
+    with ThreadPool(max(num_workers, 1)) as p:
+        results = p.map(probe, paths)
+    headers = {path: header for path, header in results if header is not None}
+    return headers, [path for path, header in results if header is None]
+
+def read_block_index(
+        path: str
+    ) -> list | None:
+
+    '''
+    Args:
+        path (str): Path to the block-compressed file.
+
+    Returns:
+        list | None: Offsets of the gzip members or None if the file has no (up-to-date) index.
+    '''
+    try:
+        with open(path + BLOCK_INDEX_SUFFIX) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    stat = os.stat(path)
+    if index.get('size') != stat.st_size or index.get('mtime_ns') != stat.st_mtime_ns:
+        return None
+    return index['offsets']
+
+def decompress(
+        path: str,
+        num_threads: int = 4
+    ) -> bytes:
+
+    '''
+    Decompresses a gzipped file. Block-compressed files (see transcode) are inflated in parallel, as zlib releases
+    the GIL. Other files are inflated by python-isal if installed, or by zlib in a single pass otherwise.
+
+    Args:
+        path (str): Path to the gzipped file.
+        num_threads (int): Number of threads to inflate with. Defaults to 4.
+    '''
+    offsets = read_block_index(path)
+    if offsets is None and has_isal:
+        with igzip_threaded.open(path, 'rb', threads=num_threads) as f:
+            return f.read()
+    with open(path, 'rb') as f:
+        buffer = f.read()
+    if offsets is not None and len(offsets) > 2 and num_threads > 1:
+        members = [memoryview(buffer)[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        with ThreadPool(min(num_threads, len(members))) as p:
+            return b''.join(p.map(lambda member: zlib.decompress(member, wbits=31), members))
+    # a single decompression object per member, gzip files may consist of several concatenated members
+    chunks = []
+    while buffer:
+        inflater = zlib.decompressobj(wbits=31)
+        chunks.append(inflater.decompress(buffer))
+        buffer = inflater.unused_data
+    return b''.join(chunks)
+
+def load_nifti(
+        path: str,
+        num_threads: int = 4
+    ) -> nib.Nifti1Image:
+
+    '''
+    Args:
+        path (str): Path to the NIfTI file.
+        num_threads (int): Number of threads to inflate gzipped files with. Defaults to 4.
+    '''
+    if not path.endswith('.gz'):
+        return nib.load(path)
+    buffer = decompress(path, num_threads)
+    image_class = nib.Nifti2Image if _header_class(buffer) is nib.Nifti2Header else nib.Nifti1Image
+    return image_class.from_bytes(buffer)
+
+def transcode(
+        src: str,
+        dst: str,
+        block_size: int = 4 * 1024 ** 2,
+        level: int = 6,
+        num_threads: int = 4
+    ) -> None:
+
+    '''
+    Rewrites a NIfTI file once for faster repeated reads. Files ending in .nii are written uncompressed. Other files
+    are written as a sequence of independent gzip members of block_size uncompressed bytes each, together with an
+    index of the member offsets. The result is still a regular .nii.gz file, but can be inflated in parallel.
+
+    Args:
+        src (str): Path to the source file.
+        dst (str): Path to the transcoded file.
+        block_size (int): Number of uncompressed bytes per gzip member. Defaults to 4 MiB.
+        level (int): Compression level. Level 0 stores the blocks without compression. Defaults to 6.
+        num_threads (int): Number of threads to compress with. Defaults to 4.
+    '''
+    if src.endswith('.gz'):
+        buffer = decompress(src, num_threads)
+    else:
+        with open(src, 'rb') as f:
+            buffer = f.read()
+    tmp_path = f'{dst}.{os.getpid()}.tmp'
+    if not dst.endswith('.gz'):
+        with open(tmp_path, 'wb') as f:
+            f.write(buffer)
+        os.replace(tmp_path, dst)
+        return
+
+    def compress(start: int) -> bytes:
+        deflater = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return deflater.compress(buffer[start:start + block_size]) + deflater.flush()
+
+    with ThreadPool(max(num_threads, 1)) as p:
+        members = p.map(compress, range(0, len(buffer), block_size))
+    with open(tmp_path, 'wb') as f:
+        for member in members:
+            f.write(member)
+    os.replace(tmp_path, dst)
+    stat = os.stat(dst)
+    offsets = np.cumsum([0] + [len(member) for member in members]).tolist()
+    with open(tmp_path, 'w') as f:
+        json.dump({'offsets': offsets, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}, f)
+    os.replace(tmp_path, dst + BLOCK_INDEX_SUFFIX)
+
+class ParallelNiftiReader(NibabelReader):
+
+    '''
+    Nibabel reader that decompresses gzipped NIfTI files with multiple threads (see decompress) instead of
+    streaming them through a single-threaded GzipFile.
+    '''
+
+    def __init__(
+            self,
+            num_threads: int = 4,
+            **kwargs
+        ) -> None:
+
+        '''
+        Args:
+            num_threads (int): Number of threads to inflate every file with. Defaults to 4.
+            kwargs: Additional arguments of the NibabelReader.
+        '''
+        super().__init__(**kwargs)
+        self.num_threads = num_threads
+
+    def read(
+            self,
+            data: Sequence[str] | str,
+            **kwargs
+        ) -> list | nib.Nifti1Image:
+
+        '''
+        Args:
+            data (Sequence[str] | str): Path or list of paths to the NIfTI files.
+        '''
+        filenames = [data] if isinstance(data, (str, os.PathLike)) else list(data)
+        images = [correct_nifti_header_if_necessary(load_nifti(str(name), self.num_threads)) for name in filenames]
+        return images if len(filenames) > 1 else images[0]
@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+from collections.abc import Sequence
+from monai.data import MetaTensor
+from monai.data.meta_obj import get_track_meta
+from monai.transforms import Compose, RandomizableTrait, Transform
+from tqdm import tqdm
+from data.cache import PersistentCache, hash_transforms, persistent_end
+import torch
+import numpy as np
+import pickle
+import mmap
+import os
+
+# Offsets of all arrays are aligned to pages, such that sequences can be prefetched with madvise.
+PAGE_SIZE = mmap.PAGESIZE
+
+class VolumeStore:
+
+    '''
+    Read-only store of the deterministically preprocessed cohort. The image arrays of all observations are packed
+    into a single raw file, ordered by patient and exam, together with an index of their offsets keyed on the
+    observation uid. Arrays are memory-mapped, so random crops only read the pages they touch and all processes
+    on a node share the page cache. The observations of a patient sequence are adjacent in the file and are
+    prefetched with a single sequential read.
+    '''
+
+    def __init__(
+            self,
+            store_dir: str,
+            transform: Compose | None = None
+        ) -> None:
+
+        '''
+        Args:
+            store_dir (str): Path to the store directory.
+            transform (Compose | None): Chain of transforms whose deterministic prefix was exported. If provided, the
+                store is checked to have been exported with the same transforms.
+        '''
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'index.pkl'), 'rb') as f:
+            index = pickle.load(f)
+        self.end = index['end']
+        self.dtype = np.dtype(index['dtype'])
+        self.entries = index['entries']
+        self.image_keys = index['image_keys']
+        if transform is not None and hash_transforms(transform, self.end, index['dtype']) != index['transform_hash']:
+            raise ValueError(f'The volume store in {store_dir} was exported with different transforms, please export it again.')
+        self._mmap = None
+
+    def __getstate__(self) -> dict:
+
+        # memory maps cannot be pickled, every process maps the file on its own
+        state = dict(self.__dict__)
+        state['_mmap'] = None
+        return state
+
+    def _map(self) -> mmap.mmap:
+
+        if self._mmap is None:
+            with open(os.path.join(self.store_dir, 'images.bin'), 'rb') as f:
+                # copy-on-write mapping: in-place transforms downstream never touch the file
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        return self._mmap
+
+    def __contains__(
+            self,
+            data: dict
+        ) -> bool:
+
+        return data['uid'] in self.entries
+
+    def __call__(
+            self,
+            data: dict
+        ) -> dict:
+
+        '''
+        Args:
+            data (dict): Input data of a single observation, containing its uid.
+
+        Returns:
+            dict: Stored output of the transform chain, with the images as views into the memory-mapped file.
+        '''
+        entry = self.entries[data['uid']]
+        buffer = self._map()
+        output = dict(entry['values'])
+        output.update({key: value for key, value in data.items() if key not in self.image_keys})
+        for name, (offset, shape, affine) in entry['arrays'].items():
+            array = torch.from_numpy(np.frombuffer(buffer, dtype=self.dtype, count=int(np.prod(shape)), offset=offset).reshape(shape))
+            if affine is not None and get_track_meta():
+                array = MetaTensor(array, affine=torch.as_tensor(affine))
+            output[name] = array
+        return output
+
+    def load_sequence(
+            self,
+            data: Sequence[dict]
+        ) -> list:
+
+        '''
+        Args:
+            data (Sequence[dict]): Input data of the observations of a sequence, containing their uids.
+
+        Returns:
+            list: Stored outputs of the transform chain.
+        '''
+        spans = [(offset, offset + int(np.prod(shape)) * self.dtype.itemsize)
+            for item in data for offset, shape, _ in self.entries[item['uid']]['arrays'].values()]
+        if spans and hasattr(mmap, 'MADV_WILLNEED'):
+            start, end = min(span[0] for span in spans), max(span[1] for span in spans)
+            self._map().madvise(mmap.MADV_WILLNEED, start, end - start)
+        return [self(item) for item in data]
+
+def export_store(
+        store_dir: str,
+        data: Sequence[dict],
+        transform: Compose,
+        image_keys: str | list,
+        dtype: str = 'float32',
+        cache: PersistentCache | None = None,
+        progress: bool = False
+    ) -> None:
+
+    '''
+    Packs the outputs of the deterministic transforms for all observations into a volume store.
+
+    Args:
+        store_dir (str): Path to the store directory.
+        data (Sequence[dict]): Input data of single observations, containing their uids, in patient and exam order.
+        transform (Compose): Chain of transforms whose deterministic prefix is exported.
+        image_keys (str | list): Keys of the image paths in the input data.
+        dtype (str): Data type to store the images in. Can be 'float16' or 'float32'. Defaults to 'float32'.
+        cache (PersistentCache | None): Persistent cache of the same transforms to read already preprocessed
+            observations from. Defaults to None.
+        progress (bool): Whether to display a progress bar. Defaults to False.
+    '''
+    if dtype not in ['float16', 'float32']:
+        raise ValueError("dtype must be 'float16' or 'float32'.")
+    image_keys = [image_keys] if isinstance(image_keys, str) else image_keys
+    end = transform.get_index_of_first(lambda t: isinstance(t, RandomizableTrait) or not isinstance(t, Transform))
+    end = persistent_end(transform, end) if cache is None else cache.end
+    os.makedirs(store_dir, exist_ok=True)
+    entries = {}
+    tmp_path = os.path.join(store_dir, f'images.bin.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        for item in tqdm(data, desc='Exporting images') if progress else data:
+            output = cache(item) if cache is not None else transform(item, end=end, threading=True)
+            entry = {'arrays': {}, 'values': {}}
+            for name, value in output.items():
+                if isinstance(value, (torch.Tensor, np.ndarray)):
+                    affine = value.affine.cpu().numpy() if isinstance(value, MetaTensor) else None
+                    array = value.detach().cpu().numpy() if isinstance(value, torch.Tensor) else value
+                    f.write(b'\0' * (-f.tell() % PAGE_SIZE))
+                    entry['arrays'][name] = (f.tell(), array.shape, affine)
+                    f.write(np.ascontiguousarray(array, dtype=dtype).tobytes())
+                elif name not in item:
+                    entry['values'][name] = value
+            entries[item['uid']] = entry
+    os.replace(tmp_path, os.path.join(store_dir, 'images.bin'))
+    index = {
+        'end': end,
+        'dtype': dtype,
+        'image_keys': image_keys,
+        'transform_hash': hash_transforms(transform, end, dtype),
+        'entries': entries}
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(index, f)
+    os.replace(tmp_path, os.path.join(store_dir, 'index.pkl'))
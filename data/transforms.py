@@ -1,6 +1,8 @@
 import torch
+import math
 from typing import Sequence
-from monai.transforms import Transform, Randomizable, ResampleToMatchd
+from monai.data import MetaTensor
+from monai.transforms import Transform, Randomizable, ResampleToMatchd, Spacing, SpatialCrop, SpatialResample
 from monai.transforms.spatial.functional import resize
 from monai.config import DtypeLike, KeysCollection, SequenceStr
 from collections.abc import Hashable, Mapping, Sequence
@@ -35,21 +37,85 @@ class PercentileSpatialCropd(Transform):
         self.roi_size = roi_size
         self.min_size = min_size
         
+    def roi(
+            self,
+            shape: Sequence[int]
+        ) -> tuple:
+
+        '''
+        Args:
+            shape (Sequence[int]): Spatial shape of the image.
+
+        Returns:
+            tuple: Start and end voxel indices of the region of interest. The end indices may exceed the shape.
+        '''
+        roi_center = [int(self.roi_center[i] * shape[i]) for i in range(len(shape))]
+        roi_size = [int(self.roi_size[i] * shape[i]) for i in range(len(shape))]
+        roi_start = [int(roi_center[i] - roi_size[i] / 2) for i in range(len(shape))]
+        roi_end = [int(roi_center[i] + roi_size[i] / 2) for i in range(len(shape))]
+        roi_end = [self.min_size[i] + roi_start[i] if roi_end[i] - roi_start[i] < self.min_size[i] else roi_end[i] for i in range(len(shape))]
+        return roi_start, roi_end
+
     def __call__(self, image: torch.Tensor):
 
         for key in self.keys:
-            cropped_image = []
-            for channel in image[key]:
-                shape = channel.shape            
-                roi_center = [int(self.roi_center[i] * shape[i]) for i in range(len(shape))]
-                roi_size = [int(self.roi_size[i] * shape[i]) for i in range(len(shape))]
-                roi_start = [int(roi_center[i] - roi_size[i] / 2) for i in range(len(shape))]
-                roi_end = [int(roi_center[i] + roi_size[i] / 2) for i in range(len(shape))]
-                roi_end = [self.min_size[i] + roi_start[i] if roi_end[i] - roi_start[i] < self.min_size[i] else roi_end[i] for i in range(len(shape))]
-                cropped_image.append(channel[roi_start[0]:roi_end[0], roi_start[1]:roi_end[1], roi_start[2]:roi_end[2]])
-            image[key] = torch.stack(cropped_image)
+            # the crop is tracked in the affine, such that later resampling steps can refer to the cropped grid
+            roi_start, roi_end = self.roi(image[key].shape[1:])
+            image[key] = SpatialCrop(roi_start=roi_start, roi_end=roi_end)(image[key])
         return image
 
+class SpacingPercentileCropd(Transform):
+
+    '''
+    Transform that resamples images to the provided spacing, but only computes the region of interest that
+    PercentileSpatialCropd would keep of the resampled image. As every output voxel of the resampling only depends on
+    its position on the output grid, the result equals Spacingd followed by PercentileSpatialCropd.
+    '''
+
+    def __init__(
+            self,
+            keys: str | list,
+            pixdim: Sequence[float],
+            roi_center: Sequence[float],
+            roi_size: Sequence[float],
+            min_size: Sequence[int],
+            mode: int | str = GridSampleMode.BILINEAR
+        ) -> None:
+
+        '''
+        Args:
+            keys (str | list): String or list of strings to perform transform on.
+            pixdim (Sequence[float]): Output voxel spacing.
+            roi_center (Sequence[float]): Percentile of the center voxels per axis of the resampled image.
+            roi_size (Sequence[float]): Size of the region of interest in percent of the resampled image.
+            min_size (Sequence[float]): Minimum size of the cropped image in absolute values.
+            mode (int | str): Interpolation mode or order of the spline interpolation.
+        '''
+
+        self.keys = [keys] if isinstance(keys, str) else keys
+        self.spacing = Spacing(pixdim=pixdim, mode=mode, lazy=True)
+        self.crop = PercentileSpatialCropd(keys=keys, roi_center=roi_center, roi_size=roi_size, min_size=min_size)
+        self.resampler = SpatialResample(mode=mode)
+
+    def __call__(
+            self,
+            data: Mapping[Hashable, torch.Tensor]
+        ) -> dict[Hashable, torch.Tensor]:
+
+        d = dict(data)
+        for key in self.keys:
+            # plan the resampled grid without resampling, then shift its origin to the start of the region of interest
+            planned = self.spacing(d[key])
+            shape, affine = planned.peek_pending_shape(), planned.peek_pending_affine().to(torch.float64)
+            roi_start, roi_end = self.crop.roi(shape)
+            roi_end = [min(end, size) for end, size in zip(roi_end, shape)]
+            affine[:3, 3] += affine[:3, :3] @ torch.as_tensor(roi_start, dtype=torch.float64)
+            d[key] = self.resampler(
+                d[key],
+                dst_affine=affine,
+                spatial_size=[end - start for start, end in zip(roi_start, roi_end)])
+        return d
+
 class YeoJohnsond(Transform):
 
     '''
@@ -77,31 +143,36 @@ class YeoJohnsond(Transform):
         self.channel_wise = channel_wise
         self.allow_missing_keys = allow_missing_keys
 
+    @staticmethod
+    def yeo_johnson(x: torch.Tensor, lmbda: torch.Tensor) -> torch.Tensor:
+
+        '''
+        Computes both branches of the transformation in one pass, with the exponent of every voxel selected by its sign.
+
+        Args:
+            x (torch.Tensor): Image to transform.
+            lmbda (torch.Tensor): Strength of the transformation, broadcastable to the image.
+        '''
+        # a lambda of 0 or 2 applies a signed log transform to both branches
+        log = (lmbda == 0) | (lmbda == 2)
+        if log.all():
+            return torch.log1p(torch.abs(x)).copysign_(x)
+        exponent = torch.where(x >= 0, lmbda, 2 - lmbda)
+        y = torch.abs(x).add_(1).pow_(exponent).sub_(1).div_(exponent)
+        if log.any():
+            y = torch.where(log, torch.log1p(torch.abs(x)), y)
+        return y.copysign_(x)
+
     def __call__(self, image: torch.Tensor):
 
         for key in self.keys:
             if self.allow_missing_keys and key not in image:
                 continue
-            if self.channel_wise:
-                for channel in range(image[key].shape[0]):
-                    lmbda = self.lmbda[channel] if isinstance(self.lmbda, Sequence) else self.lmbda
-                    positives = image[key][channel] >= 0
-                    negatives = image[key][channel] < 0
-                    if lmbda == 0 or lmbda == 2:
-                        image[key][channel][positives] = torch.log1p(image[key][channel][positives])
-                        image[key][channel][negatives] = -torch.log1p(-image[key][channel][negatives])
-                    else:
-                        image[key][channel][positives] = ((image[key][channel][positives] + 1) ** lmbda - 1) / lmbda
-                        image[key][channel][negatives] = -((-image[key][channel][negatives] + 1) ** (2 - lmbda) - 1) / (2 - lmbda)
-            else:
-                positives = image[key] >= 0
-                negatives = image[key] < 0
-                if self.lmbda == 0 or self.lmbda == 2:
-                    image[key][positives] = torch.log1p(image[key][positives])
-                    image[key][negatives] = -torch.log1p(-image[key][negatives])
-                else:
-                    image[key][positives] = ((image[key][positives] + 1) ** self.lmbda - 1) / self.lmbda
-                    image[key][negatives] = -((-image[key][negatives] + 1) ** (2 - self.lmbda) - 1) / (2 - self.lmbda)
+            x = image[key]
+            lmbda = torch.as_tensor(self.lmbda, dtype=x.dtype, device=x.device)
+            if self.channel_wise and lmbda.ndim > 0:
+                lmbda = lmbda.reshape(-1, *[1] * (x.ndim - 1))
+            image[key] = self.yeo_johnson(x, lmbda)
         return image
 
 class RandSelectChanneld(Transform, Randomizable):
@@ -132,6 +203,58 @@ class RandSelectChanneld(Transform, Randomizable):
             image[key] = image[key][torch.randperm(shape[0])[:self.num_channels]]
         return image
 
+class RandMultiCropd(Transform, Randomizable):
+
+    '''
+    Transform that samples several random crops of an image, e.g., the global and local views of DINO. The crops are
+    views into the image, such that only the cropped regions are copied by the transforms that follow and the image
+    itself is shared by all crops instead of being copied per crop.
+    '''
+
+    def __init__(
+            self,
+            keys: str,
+            crops: dict,
+            delete_key: bool = True
+        ) -> None:
+
+        '''
+        Args:
+            keys (str): Key of the image to crop.
+            crops (dict): Spatial size of every crop, keyed on the name of the crop.
+            delete_key (bool): Whether to remove the image from the output. Defaults to True.
+        '''
+
+        self.keys = keys
+        self.crops = crops
+        self.delete_key = delete_key
+
+    def randomize(
+            self,
+            shape: Sequence[int]
+        ) -> list:
+
+        '''
+        Args:
+            shape (Sequence[int]): Spatial shape of the image.
+
+        Returns:
+            list: Start of every crop per spatial axis.
+        '''
+        return [[self.R.randint(max(size - crop, 0) + 1) for size, crop in zip(shape, roi_size)] for roi_size in self.crops.values()]
+
+    def __call__(
+            self,
+            data: Mapping[Hashable, torch.Tensor]
+        ) -> dict[Hashable, torch.Tensor]:
+
+        # the input may be a cached item, so it is never modified in-place
+        d = dict(data)
+        image = d.pop(self.keys) if self.delete_key else d[self.keys]
+        for (name, roi_size), start in zip(self.crops.items(), self.randomize(image.shape[1:])):
+            d[name] = image[(slice(None),) + tuple(slice(s, s + size) for s, size in zip(start, roi_size))]
+        return d
+
 class ResampleToMatchFirstd(ResampleToMatchd):
 
     '''
@@ -199,63 +322,293 @@ class SoftClipOutliersd(Transform):
     Transform that clips the intensity values of a provided image based on the median absolute deviation.
     '''
 
+    # slope of the soft clip at the bounds, relative to half the width of the clipping interval
+    const = math.log(2) / (1 - math.tanh(1))
+    # the soft plus terms of both bounds sum to a constant, so a single exponential suffices (see softclip_)
+    exp_const = math.exp(-2 * const)
+
     def __init__(
             self,
             keys: str | list,
             scale_factor: float = 1.5,
-            channel_wise: bool = False
+            channel_wise: bool = False,
+            approximate: bool = False,
+            rel_error: float = 1e-3
         ) -> None:
 
         '''
         Args:
             keys (str | list): String or list of strings to perform transform on.
             scale_factor (float): Maximum median absolute deviation.
-            Whether to perform the transform on all channels independently.
+            channel_wise (bool): Whether to perform the transform on all channels independently.
+            approximate (bool): Whether to estimate the median and the median absolute deviation from a histogram
+                instead of computing them exactly. Defaults to False.
+            rel_error (float): Maximum error of the approximate median and median absolute deviation relative to
+                the intensity range of the image. Defaults to 1e-3.
         '''
 
         self.keys = [keys] if isinstance(keys, str) else keys
         self.scale_factor = scale_factor
         self.channel_wise = channel_wise
+        self.approximate = approximate
+        self.rel_error = rel_error
 
     @staticmethod
-    def softplus(x: torch.Tensor):
+    def median_mad(x: torch.Tensor) -> tuple:
 
-        other = torch.tensor([0])
-        return torch.log(1 + torch.exp(-torch.abs(x))) + torch.maximum(x, other)
-    
-    def softminus(self, x: torch.Tensor):
+        '''
+        Args:
+            x (torch.Tensor): Flattened channels of shape (C, N).
 
-        return -self.softplus(-x)
-    
-    def softclip(self, x: torch.Tensor, lower: float | None, upper: float | None):
+        Returns:
+            tuple: Median and median absolute deviation per channel.
+        '''
+        # a full reduction per channel selects the median faster than a reduction along a dimension
+        median = torch.stack([torch.median(channel) for channel in x])
+        mad = torch.stack([torch.median(torch.abs(channel - m)) for channel, m in zip(x, median)])
+        return median, mad
+
+    @staticmethod
+    def histogram_median_mad(x: torch.Tensor, rel_error: float) -> tuple:
 
-        tanh = 1 - torch.tanh(torch.tensor([1]))
-        const = torch.log(torch.tensor([2])) / tanh
+        '''
+        Estimates the median and the median absolute deviation of all channels from a single histogram pass. Every
+        value is rounded to the nearest of num_bins equally spaced bin centers, such that the median is off by at most
+        half a bin width. The deviations of the bin centers from the estimated median are then off by at most one bin
+        width, and so is their weighted median.
+
+        Args:
+            x (torch.Tensor): Flattened channels of shape (C, N).
+            rel_error (float): Bin width relative to the intensity range of every channel.
 
-        if lower is not None and upper is not None:
-            const /= (upper - lower) / 2
+        Returns:
+            tuple: Approximate median and median absolute deviation per channel.
+        '''
+        C, N = x.shape
+        num_bins = math.ceil(1 / rel_error) + 1
+        lower, upper = torch.aminmax(x, dim=1)
+        width = (upper - lower) / (num_bins - 1)
+        scale = torch.where(width > 0, 1 / width, torch.zeros_like(width))
+        # rounds every value to its nearest bin center, then offsets the bins of every channel
+        bins = torch.addcmul((0.5 - lower * scale)[:, None], x, scale[:, None]).to(torch.int32).clamp_(0, num_bins - 1)
+        bins += torch.arange(C, dtype=torch.int32, device=x.device)[:, None] * num_bins
+        counts = torch.bincount(bins.flatten(), minlength=C * num_bins).reshape(C, num_bins)
+        del bins
+        centers = lower[:, None] + width[:, None] * torch.arange(num_bins, dtype=x.dtype, device=x.device)
+
+        # lower median, as returned by torch.median
+        rank = torch.full((C, 1), (N - 1) // 2, dtype=counts.dtype, device=x.device)
+        median_bin = torch.searchsorted(counts.cumsum(dim=1), rank, right=True).clamp_(max=num_bins - 1)
+        median = centers.gather(1, median_bin)
+        deviations, order = torch.sort(torch.abs(centers - median), dim=1)
+        mad_bin = torch.searchsorted(counts.gather(1, order).cumsum(dim=1), rank, right=True).clamp_(max=num_bins - 1)
+        mad = deviations.gather(1, mad_bin)
+        return median.squeeze(1), mad.squeeze(1)
+
+    @classmethod
+    def softclip_(cls, x: torch.Tensor, lower: torch.Tensor, upper: torch.Tensor) -> torch.Tensor:
 
-        v = x
-        if lower is not None:
-            v = v - self.softminus(const * (x - lower)) / const
-        if upper is not None:
-            v = v - self.softplus(const * (x - upper)) / const
-        return v
+        '''
+        Softly clips the values of x to the interval between lower and upper in place. With c = const / ((upper - lower) / 2),
+        the soft clip x + softplus(c * (lower - x)) / c - softplus(c * (x - upper)) / c simplifies to
+        lower + log((1 + s) / (1 + exp(-2 * const) * s)) / c with s = exp(c * (x - lower)).
+
+        Args:
+            x (torch.Tensor): Image to clip.
+            lower (torch.Tensor): Lower bound, broadcastable to the image.
+            upper (torch.Tensor): Upper bound, broadcastable to the image.
+        '''
+        const = cls.const / ((upper - lower) / 2)
+        # beyond |c * (x - lower)| > 50 the result is constant up to float precision, clamping avoids inf / inf
+        x.sub_(lower).mul_(const).clamp_(-50, 50).exp_()
+        denominator = x.mul(cls.exp_const).add_(1)
+        return x.add_(1).div_(denominator).log_().div_(const).add_(lower)
     
     def __call__(self, image: torch.Tensor):
 
         for key in self.keys:
-            if self.channel_wise:
-                for channel in range(image[key].shape[0]):
-                    median = torch.median(image[key][channel])
-                    mad = torch.median(torch.abs(image[key][channel] - median)) * 1.4826
-                    min_value = median - mad * self.scale_factor
-                    max_value = median + mad * self.scale_factor
-                    image[key][channel] = self.softclip(image[key][channel], min_value, max_value)
+            x = image[key]
+            data = x.as_tensor() if isinstance(x, MetaTensor) else x
+            flat = data.reshape(data.shape[0] if self.channel_wise else 1, -1)
+            if self.approximate:
+                median, mad = self.histogram_median_mad(flat, self.rel_error)
             else:
-                median = torch.median(image[key])
-                mad = torch.median(torch.abs(image[key] - median)) * 1.4826
-                min_value = median - mad * self.scale_factor
-                max_value = median + mad * self.scale_factor
-                image[key] = self.softclip(image[key], min_value, max_value)
-        return image
\ No newline at end of file
+                median, mad = self.median_mad(flat)
+            mad = mad * 1.4826
+            shape = (-1,) + (1,) * (data.ndim - 1)
+            min_value = (median - mad * self.scale_factor).reshape(shape)
+            max_value = (median + mad * self.scale_factor).reshape(shape)
+            self.softclip_(data, min_value, max_value)
+        return image
+
+class BatchedRandAugment(Randomizable):
+
+    '''
+    Random augmentation of a whole batch of images of shape (N, C, H, W, D) at once. Every image is augmented
+    independently as by RandSpatialCrop, RandFlip along every spatial axis, RandRotate90, RandScaleIntensity,
+    RandShiftIntensity, and NormalizeIntensity (all channel-wise). The crops, flips, and rotations of all images are
+    composed into a single gather with per-image index vectors, the intensity transforms into a single affine map per
+    image and channel.
+    '''
+
+    def __init__(
+            self,
+            roi_size: Sequence[int],
+            flip_prob: float = 0.5,
+            rotate_prob: float = 0.5,
+            max_k: int = 3,
+            spatial_axes: tuple = (0, 1),
+            scale_factors: float = 0.1,
+            shift_offsets: float = 0.1,
+            subtrahend: Sequence[float] | None = None,
+            divisor: Sequence[float] | None = None
+        ) -> None:
+
+        '''
+        Args:
+            roi_size (Sequence[int]): Spatial size of the random crops.
+            flip_prob (float): Probability to flip the images along each spatial axis. Defaults to 0.5.
+            rotate_prob (float): Probability to rotate the images by 90 degrees. Defaults to 0.5.
+            max_k (int): Maximum number of 90 degree rotations. Defaults to 3.
+            spatial_axes (tuple): Spatial axes that define the plane of the rotation. Defaults to (0, 1).
+            scale_factors (float): Images are scaled by 1 + factor, with the factor drawn from (-scale_factors,
+                scale_factors) per channel. Defaults to 0.1.
+            shift_offsets (float): Images are shifted by an offset drawn from (-shift_offsets, shift_offsets) per
+                channel. Defaults to 0.1.
+            subtrahend (Sequence[float] | None): Mean per channel to normalize the images with. Defaults to None.
+            divisor (Sequence[float] | None): Standard deviation per channel to normalize the images with. Defaults to None.
+        '''
+
+        self.roi_size = tuple(int(size) for size in roi_size)
+        if roi_size[spatial_axes[0]] != roi_size[spatial_axes[1]]:
+            raise ValueError('The crops must be square in the plane of the rotation.')
+        self.flip_prob = flip_prob
+        self.rotate_prob = rotate_prob
+        self.max_k = max_k
+        self.spatial_axes = tuple(spatial_axes)
+        self.scale_factors = scale_factors
+        self.shift_offsets = shift_offsets
+        self.subtrahend = subtrahend
+        self.divisor = divisor
+
+    def randomize(
+            self,
+            shapes: Sequence[Sequence[int]],
+            num_channels: int
+        ) -> dict:
+
+        '''
+        Draws the random parameters of all images at once.
+
+        Args:
+            shapes (Sequence[Sequence[int]]): Spatial shapes of the images.
+            num_channels (int): Number of channels of the images.
+
+        Returns:
+            dict: Crop offsets, flips, numbers of rotations, scale factors, and shift offsets of every image.
+        '''
+        max_offset = np.asarray(shapes, dtype=np.int64) - np.asarray(self.roi_size)
+        if (max_offset < 0).any():
+            raise ValueError(f'All images must be at least of size {self.roi_size}.')
+        num_images = len(max_offset)
+        rotate = self.R.random_sample(num_images) < self.rotate_prob
+        return {
+            'offset': np.floor(self.R.random_sample(max_offset.shape) * (max_offset + 1)).astype(np.int64),
+            'flip': self.R.random_sample((num_images, 3)) < self.flip_prob,
+            'k': np.where(rotate, self.R.randint(self.max_k, size=num_images) + 1, 0),
+            'scale': self.R.uniform(-self.scale_factors, self.scale_factors, (num_images, num_channels)),
+            'shift': self.R.uniform(-self.shift_offsets, self.shift_offsets, (num_images, num_channels))}
+
+    def crop(
+            self,
+            image: torch.Tensor,
+            offset: Sequence[int]
+        ) -> torch.Tensor:
+
+        '''
+        Args:
+            image (torch.Tensor): Single image of shape (C, H, W, D).
+            offset (Sequence[int]): Start of the crop per spatial axis.
+
+        Returns:
+            torch.Tensor: View of the crop.
+        '''
+        return image[(slice(None),) + tuple(slice(int(start), int(start) + size) for start, size in zip(offset, self.roi_size))]
+
+    def index(
+            self,
+            params: dict,
+            shape: Sequence[int],
+            device: torch.device
+        ) -> torch.Tensor:
+
+        '''
+        Composes crop, flips, and rotation of every image into a single index.
+
+        Args:
+            params (dict): Random parameters of the images (see randomize).
+            shape (Sequence[int]): Spatial shape of the images.
+            device (torch.device): Device of the images.
+
+        Returns:
+            torch.Tensor: Linear indices of shape (N, 1, prod(roi_size)) into the flattened spatial dimensions, i.e., the
+                input voxel of every output voxel.
+        '''
+
+        def column(values: np.ndarray) -> torch.Tensor:
+            return torch.as_tensor(values, device=device).reshape(-1, 1, 1, 1, 1)
+
+        # torch.rot90 by k maps output voxel (i, j) to (j, L - 1 - i), (L - 1 - i, L - 1 - j), and (L - 1 - j, i)
+        # for k = 1, 2, and 3, i.e., odd rotations swap the axes and all of them reverse some
+        first, second = self.spatial_axes
+        k = params['k']
+        reverse = params['flip'].copy()
+        reverse[:, first] ^= (k == 2) | (k == 3)
+        reverse[:, second] ^= (k == 1) | (k == 2)
+        swap = column(k % 2 == 1)
+        strides = np.cumprod((list(shape) + [1])[:0:-1])[::-1]
+        grids = [
+            torch.arange(size, device=device).reshape([1, 1] + [size if axis == dim else 1 for dim in range(3)])
+            for axis, size in enumerate(self.roi_size)]
+        index = 0
+        for axis, size in enumerate(self.roi_size):
+            grid = grids[axis]
+            if axis in self.spatial_axes:
+                grid = torch.where(swap, grids[second if axis == first else first], grid)
+            grid = torch.where(column(reverse[:, axis]), size - 1 - grid, grid)
+            index = index + (grid + column(params['offset'][:, axis])) * int(strides[axis])
+        return index.reshape(len(k), 1, -1)
+
+    def __call__(
+            self,
+            x: torch.Tensor,
+            params: dict | None = None,
+            out: torch.Tensor | None = None
+        ) -> torch.Tensor:
+
+        '''
+        Args:
+            x (torch.Tensor): Batch of images of shape (N, C, H, W, D).
+            params (dict | None): Random parameters of the images (see randomize). Defaults to None (drawn for the batch).
+            out (torch.Tensor | None): Tensor to write the augmented crops into. Defaults to None.
+
+        Returns:
+            torch.Tensor: Augmented crops of shape (N, C) + roi_size.
+        '''
+        num_images, num_channels = x.shape[:2]
+        if params is None:
+            params = self.randomize([x.shape[2:]] * num_images, num_channels)
+        index = self.index(params, x.shape[2:], x.device)
+        x = x.reshape(num_images, num_channels, -1).gather(2, index.expand(-1, num_channels, -1))
+        x = x.reshape((num_images, num_channels) + self.roi_size)
+
+        # (x * (1 + scale) + shift - subtrahend) / divisor
+        subtrahend = np.zeros(num_channels) if self.subtrahend is None else np.asarray(self.subtrahend, dtype=np.float64)
+        divisor = np.ones(num_channels) if self.divisor is None else np.asarray(self.divisor, dtype=np.float64)
+        if subtrahend.size not in [1, num_channels] or divisor.size not in [1, num_channels]:
+            raise ValueError(f'subtrahend and divisor must have 1 or {num_channels} values.')
+        weight = (1 + params['scale']) / divisor
+        bias = (params['shift'] - subtrahend) / divisor
+        weight = torch.as_tensor(weight, dtype=x.dtype, device=x.device).reshape(num_images, num_channels, 1, 1, 1)
+        bias = torch.as_tensor(bias, dtype=x.dtype, device=x.device).reshape(num_images, num_channels, 1, 1, 1)
+        return torch.addcmul(bias, x, weight, out=x if out is None else out)
@@ -1,118 +1,389 @@
-from typing import List
+from typing import Callable, Iterable, Iterator, List
 import torch
 import os
+import hashlib
+import pickle
 import numpy as np
 import pandas as pd
-from glob import glob
 from natsort import natsorted
 from collections import defaultdict
-from monai.data.utils import collate_meta_tensor
+from multiprocessing.pool import ThreadPool
+from torch.utils.data import Sampler
+from data.nifti import probe_headers
+
+MANIFEST_DIR = os.path.expanduser('~/.cache/hccnet')
+# Manifests that have been scanned in this process, keyed on the absolute path of the image directory.
+_manifests = {}
 
 
 class SequenceBatchCollater:
 
     '''
-    A generic collate function that pads or truncates sequences of images to a specified sequence length.
+    A generic collate function that pads or truncates sequences of images to a specified sequence length. The batch
+    is written into a single preallocated tensor per key, such that neither padding nor stacking allocates per image.
     '''
 
     def __init__(
             self,
             keys: list,
-            seq_length: int
+            seq_length: int,
+            pad_to_max: bool = False,
+            copy_padding: bool = True,
+            pin_memory: bool = False,
+            augmentation: Callable | None = None
         ) -> None:
 
         '''
         Args:
             keys (list): A list of keys to retain when data loading.
             seq_length (int): The maximum sequence length. All sequences are automatically padded to truncated to its maximum length.
+            pad_to_max (bool): Whether to only pad the sequences to the longest sequence in the batch (at most seq_length). Defaults to False.
+            copy_padding (bool): Whether padded images are copies of the first image in the sequence or left as zeros. Only disable
+                if the model never looks at padded images, e.g., MedNet(packed=True). Defaults to True.
+            pin_memory (bool): Whether to collate images that reside on the CPU into pinned memory. Defaults to False.
+            augmentation (Callable | None): Random augmentation of the collated images, e.g., BatchedRandAugment. The images
+                are cropped while they are copied into the batch, all other augmentations run on the whole batch. Padded
+                images are augmented like the first image of their sequence. Defaults to None.
         '''
 
         self.keys = keys
         self.seq_length = seq_length
+        self.pad_to_max = pad_to_max
+        self.copy_padding = copy_padding
+        self.pin_memory = pin_memory
+        self.augmentation = augmentation
 
-    def pad_or_trunc_seq(self, data: list) -> list:
+    def select_timepoints(self, length: int, seq_length: int | None = None) -> list:
 
-        sequences = {x: [seq[x] for seq in data] for x in self.keys}
-        zero_values = {}
-        for key in self.keys:
-            if isinstance(sequences[key][0], torch.Tensor):
-                zero_values[key] = torch.clone(sequences[key][0])
-            else:
-                zero_values[key] = torch.zeros(1)
+        '''
+        Args:
+            length (int): Length of the sequence.
+            seq_length (int | None): Target sequence length. Defaults to the maximum sequence length.
 
-        if len(sequences[self.keys[0]]) < self.seq_length:
-            while len(sequences[self.keys[0]]) < self.seq_length:
-                for key in self.keys:
-                    sequences[key].append(zero_values[key])
-        elif len(sequences[self.keys[0]]) > self.seq_length:
-            while len(sequences[self.keys[0]]) > self.seq_length:
-                idx_to_remove = np.random.choice(len(sequences[self.keys[0]]))
-                for key in self.keys:
-                    sequences[key].pop(idx_to_remove)
+        Returns:
+            list: Indices of the retained timepoints. Sequences that are too long lose timepoints at random.
+        '''
+        seq_length = self.seq_length if seq_length is None else seq_length
+        indices = list(range(length))
+        while len(indices) > seq_length:
+            indices.pop(np.random.choice(len(indices)))
+        return indices
 
-        data = [{key: sequences[key][i] for key in self.keys} for i in range(self.seq_length)]
+    def __call__(self, batch: list) -> dict:
 
+        seq_length = min(max(len(patient) for patient in batch), self.seq_length) if self.pad_to_max else self.seq_length
+        timepoints = [self.select_timepoints(len(patient), seq_length) for patient in batch]
+        # every position of the batch holds a timepoint of a patient, padding repeats the first timepoint or is None
+        # and is augmented like the first timepoint, which is always retained
+        padding = 0 if self.copy_padding else None
+        positions, source = [], []
+        for b, indices in enumerate(timepoints):
+            num_padded = seq_length - len(indices)
+            positions.extend((b, t) for t in indices + [padding] * num_padded)
+            source.extend(list(range(b * seq_length, b * seq_length + len(indices))) + [b * seq_length] * num_padded)
+        params = None
+        data = {}
+        for key in self.keys:
+            first = batch[0][0][key]
+            if not isinstance(first, torch.Tensor):
+                # padded timepoints have a value of zero, i.e., a delta of zero marks padding
+                values = []
+                for patient, indices in zip(batch, timepoints):
+                    values.extend(patient[t][key] for t in indices)
+                    values.extend(0 for _ in range(seq_length - len(indices)))
+                data[key] = torch.tensor(values)
+                continue
+            shape = tuple(first.shape)
+            if self.augmentation is not None:
+                if params is None:
+                    params = self.augmentation.randomize(
+                        [batch[b][t or 0][key].shape[1:] for b, t in positions], num_channels=shape[0])
+                    params = {name: value[source] for name, value in params.items()}
+                shape = shape[:1] + self.augmentation.roi_size
+            out = torch.empty(
+                (len(positions),) + shape, 
+                dtype=first.dtype, 
+                device=first.device, 
+                pin_memory=self.pin_memory and first.device.type == 'cpu')
+            # the crops are gathered into a temporary batch, the augmentation writes into the (pinned) output
+            crops = out if params is None else torch.empty_like(out, pin_memory=False)
+            for n, (b, t) in enumerate(positions):
+                if t is None:
+                    crops[n].zero_()
+                    continue
+                image = batch[b][t][key]
+                crops[n].copy_(image if params is None else self.augmentation.crop(image, params['offset'][n]))
+            if params is not None:
+                self.augmentation(crops, dict(params, offset=np.zeros_like(params['offset'])), out=out)
+                padded = [n for n, (_, t) in enumerate(positions) if t is None]
+                if padded:
+                    out[padded] = 0
+            data[key] = out
         return data
 
-    def __call__(self, batch: list) -> list:
 
-        data = [self.pad_or_trunc_seq(patient) for patient in batch]
-        return collate_meta_tensor([item for sublist in data for item in sublist])
+class BucketBatchSampler(Sampler):
+
+    '''
+    Batch sampler that groups sequences of similar length into the same batch. Every epoch, the shuffled sequences are
+    split into buckets of bucket_size batches, each bucket is sorted by sequence length and cut into batches, and
+    the order of all batches is shuffled again. Together with SequenceBatchCollater(pad_to_max=True), most batches
+    need little to no padding.
+    '''
+
+    def __init__(
+            self,
+            lengths: list,
+            batch_size: int,
+            bucket_size: int = 32,
+            max_length: int | None = None,
+            drop_last: bool = True,
+            seed: int = 0
+        ) -> None:
+
+        '''
+        Args:
+            lengths (list): Sequence length of every item in the dataset.
+            batch_size (int): Number of sequences per batch.
+            bucket_size (int): Number of batches per bucket. Defaults to 32.
+            max_length (int | None): Sequence length beyond which sequences are truncated anyway. Defaults to None.
+            drop_last (bool): Whether to drop the last incomplete batch. Defaults to True.
+            seed (int): Seed of the random shuffling. Defaults to 0.
+        '''
+
+        self.lengths = np.asarray(lengths) if max_length is None else np.minimum(lengths, max_length)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self) -> Iterator[list]:
+
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+        indices = rng.permutation(len(self.lengths))
+        if self.drop_last:
+            indices = indices[:len(self) * self.batch_size]
+        batches = []
+        bucket = self.batch_size * self.bucket_size
+        for start in range(0, len(indices), bucket):
+            bucket_indices = indices[start:start + bucket]
+            bucket_indices = bucket_indices[np.argsort(self.lengths[bucket_indices], kind='stable')]
+            batches.extend(bucket_indices[i:i + self.batch_size].tolist() for i in range(0, len(bucket_indices), self.batch_size))
+        for idx in rng.permutation(len(batches)):
+            yield batches[idx]
+
+    def __len__(self) -> int:
+
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class PatientIndex:
+
+    '''
+    Index over a list of observations that maps every observation uid to its row and every patient to the rows of its
+    observations, such that splits and sequences can be built in linear time.
+    '''
+
+    def __init__(
+            self,
+            data_dict: list,
+            modalities: list
+        ) -> None:
+
+        '''
+        Args:
+            data_dict (list): List of observations. The patient id is the second field of the observations' uid.
+            modalities (list): List of image modalities, i.e., the keys whose values are lists of image paths.
+        '''
+
+        self.data_dict = data_dict
+        self.modalities = set(modalities)
+        self.rows = {patient['uid']: row for row, patient in enumerate(data_dict)}
+        self.patient_ids = [patient['uid'].split('_')[1] for patient in data_dict]
+        self.patients = defaultdict(list)
+        for row, patient_id in enumerate(self.patient_ids):
+            self.patients[patient_id].append(row)
+        self._sequences = {}
+
+    def select(
+            self,
+            uids: Iterable[str]
+        ) -> list:
+
+        '''
+        Args:
+            uids (Iterable[str]): Uids of the observations to select. Unknown uids are ignored.
+
+        Returns:
+            list: Rows of the selected observations in the order of the index.
+        '''
+        return sorted({self.rows[uid] for uid in uids if uid in self.rows})
+
+    def split(
+            self,
+            uids: Iterable[str]
+        ) -> list:
+
+        '''
+        Args:
+            uids (Iterable[str]): Uids of the observations in the split.
+
+        Returns:
+            list: Observations in the split.
+        '''
+        return [self.data_dict[row] for row in self.select(uids)]
+
+    def sequences(
+            self,
+            uids: Iterable[str]
+        ) -> list:
+
+        '''
+        Args:
+            uids (Iterable[str]): Uids of the observations in the split.
+
+        Returns:
+            list: One sequence per patient in the split, where every key maps to the values of the patient's observations.
+        '''
+        rows = self.select(uids)
+        selected = set(rows)
+        sequences = []
+        for patient_id in dict.fromkeys(self.patient_ids[row] for row in rows):
+            patient_rows = self.patients[patient_id]
+            if not selected.issuperset(patient_rows):
+                patient_rows = [row for row in patient_rows if row in selected]
+                sequences.append(self._sequence(patient_rows))
+                continue
+            # splits are grouped by patient, so complete sequences are built once and shared between splits
+            if patient_id not in self._sequences:
+                self._sequences[patient_id] = self._sequence(patient_rows)
+            sequences.append(self._sequences[patient_id])
+        return sequences
+
+    def _sequence(
+            self,
+            rows: list
+        ) -> dict:
+
+        sequence = {'uid': []}
+        for row in rows:
+            for key, value in self.data_dict[row].items():
+                if key in self.modalities:
+                    sequence.setdefault(key, []).extend(value)
+                else:
+                    sequence.setdefault(key, []).append(value)
+        return sequence
 
 
 def convert_to_dict(
         data_frames: list, 
         data_dict: dict, 
         split_names: list, 
-        verbose: bool = False
+        verbose: bool = False,
+        index: PatientIndex | None = None
     ) -> dict:
 
+    if index is None:
+        index = PatientIndex(data_dict, modalities=[])
     split_dict = {}
     for idx, df in enumerate(data_frames):
         name = split_names[idx]
-        split_dict[name] = df[['uid']].values
+        split_dict[name] = index.split(df['uid'].tolist())
         if verbose:
             print(f'{len(df)} total observations in {name} set with {df["label"].sum()} positive cases ({round(df["label"].mean(), ndigits=3)} %)')
-        
-    split_dict = {x: [patient for patient in data_dict if patient['uid'] in split_dict[x]] for x in split_names} 
     return split_dict
 
 
 def convert_to_seqdict(
         split_dict: dict,
         modalities: list,
-        splits: list
+        splits: list,
+        index: PatientIndex | None = None
     ) -> dict:
 
     seq_dict = {x: [] for x in splits}
     for phase in splits:
-        desired_split_dict = defaultdict(lambda: defaultdict(list))
-        for entry in split_dict[phase]:
-            uid = entry['uid'].split('_')[1]
-            for key, value in entry.items():
-                if key not in modalities:
-                    value = [value]
-                desired_split_dict[uid][key].extend(value)
-
-        desired_split_list = [{'uid': uid, **entry} for uid, entry in desired_split_dict.items()]
-        seq_dict[phase].append(desired_split_list)
+        phase_index = PatientIndex(split_dict[phase], modalities) if index is None else index
+        seq_dict[phase].append(phase_index.sequences(patient['uid'] for patient in split_dict[phase]))
     return seq_dict
 
 
+def scan_observations(
+        nifti_dir: str,
+        manifest_path: str | None = None,
+        num_workers: int = 16
+    ) -> dict:
+
+    '''
+    Scans all observation directories for images and returns a manifest that maps every observation to its image files,
+    in natural sort order of the observations.
+    The manifest is cached in memory and on disk. On later scans, only the observations whose directory modification
+    time has changed are listed again.
+
+    Args:
+        nifti_dir (str): Path to the directory containing one subdirectory per observation.
+        manifest_path (str | None): Path to the manifest file. Defaults to a file in ~/.cache/hccnet.
+        num_workers (int): Number of threads to scan the observation directories with. Defaults to 16.
+    '''
+    key = os.path.abspath(nifti_dir)
+    if key in _manifests:
+        return _manifests[key]
+    if manifest_path is None:
+        manifest_path = os.path.join(MANIFEST_DIR, hashlib.sha1(key.encode()).hexdigest() + '.pkl')
+    try:
+        with open(manifest_path, 'rb') as f:
+            cached = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        cached = {}
+
+    with os.scandir(nifti_dir) as it:
+        names = [entry.name for entry in it if not entry.name.startswith('.') and entry.is_dir()]
+
+    def scan(name: str) -> tuple:
+        observation = os.path.join(nifti_dir, name)
+        mtime = os.stat(observation).st_mtime_ns
+        if name in cached and cached[name][0] == mtime:
+            return name, cached[name]
+        with os.scandir(observation) as it:
+            images = sorted(entry.name for entry in it if entry.name.endswith('.nii.gz') and not entry.name.startswith('.'))
+        return name, (mtime, images)
+
+    with ThreadPool(max(num_workers, 1)) as p:
+        entries = dict(p.map(scan, names))
+    if entries != cached:
+        try:
+            os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+            with open(manifest_path + f'.{os.getpid()}.tmp', 'wb') as f:
+                pickle.dump(entries, f)
+            os.replace(manifest_path + f'.{os.getpid()}.tmp', manifest_path)
+        except OSError:
+            pass
+    manifest = {os.path.join(nifti_dir, name): entries[name][1] for name in natsorted(entries)}
+    _manifests[key] = manifest
+    return manifest
+
+
 class DatasetPreprocessor:
 
     def __init__(
             self,
             data_dir: str,
             partial: bool = False,
+            manifest_path: str | None = None
         ) -> None:
         '''
         Args:
             data_dir (str): Path to the data directory.
             partial (bool): Whether to also load images that only include part of the specified modalities.
+            manifest_path (str | None): Path to the cached manifest of the image directory. Defaults to a file in ~/.cache/hccnet.
         '''
         self.nifti_dir = os.path.join(data_dir, 'nifti')
-        self.nifti_patients = glob(os.path.join(self.nifti_dir, '*'), recursive = True)
+        self.manifest = scan_observations(self.nifti_dir, manifest_path)
+        self.nifti_patients = list(self.manifest)
         self.label_dir = os.path.join(data_dir, 'labels')
         self.partial = partial
 
@@ -128,8 +399,8 @@ class DatasetPreprocessor:
         '''
         image_names_list = [image_name + '.nii.gz' for image_name in modalities]
         observation_list = []
-        for observation in natsorted(self.nifti_patients):
-            images = [image for image in glob(os.path.join(observation, '*.nii.gz'))]
+        for observation in self.nifti_patients:
+            images = [os.path.join(observation, image) for image in self.manifest[observation]]
             common_prefix = os.path.commonprefix(images)
             image_names = [image_name[len(common_prefix):] for image_name in images]
             if self.partial:
@@ -142,8 +413,8 @@ class DatasetPreprocessor:
             print('{} out of {} observations include all required images'.format(len(observation_list), len(self.nifti_patients)))
         return observation_list
 
-    @staticmethod
     def split_observations_by_modality(
+            self,
             observation_list: list, 
             modality: str
         ) -> list:
@@ -152,8 +423,35 @@ class DatasetPreprocessor:
             observation_list (list): List of observations to split.
             modality (str): Modality to split by.
         '''
-        return [glob(os.path.join(observation, modality + '.nii.gz')) for observation in observation_list]
+        image_name = modality + '.nii.gz'
+        return [[os.path.join(observation, image_name)] if image_name in self.manifest[observation] else [] for observation in observation_list]
     
+    @staticmethod
+    def probe_headers(
+            data_dict: list,
+            modalities: list,
+            num_workers: int = 16
+        ) -> tuple:
+        '''
+        Reads the image headers of all observations without decompressing the image data.
+
+        Args:
+            data_dict (list): List of observations containing the image paths per modality.
+            modalities (list): List of image modalities to probe.
+            num_workers (int): Number of threads to read the headers with. Defaults to 16.
+
+        Returns:
+            tuple: Headers per modality keyed on the observation uid, and the observations with unreadable images.
+        '''
+        paths = [path for patient in data_dict for modality in modalities for path in patient.get(modality, [])]
+        headers, unreadable = probe_headers(paths, num_workers)
+        unreadable = set(unreadable)
+        corrupt = [patient for patient in data_dict if any(path in unreadable for modality in modalities for path in patient.get(modality, []))]
+        corrupt_uids = {patient['uid'] for patient in corrupt}
+        headers = {patient['uid']: {modality: headers[patient[modality][0]] for modality in modalities if patient.get(modality)}
+            for patient in data_dict if patient['uid'] not in corrupt_uids}
+        return headers, corrupt
+
     @staticmethod
     def create_label_dict(
             observation_list: list, 
@@ -166,23 +464,18 @@ class DatasetPreprocessor:
             keys (List[str]): List of keys to preserve when data loading.
             label_path (str): Path to the dataframe containing the labels.
         '''
-        new_keys = ['uid'] + keys
-        label_dict = {x: [] for x in new_keys}
         labels_df = pd.read_csv(label_path)
-        labels_df['observation'] = labels_df['observation'].astype(int)
-        for idx, row in labels_df.iterrows():
-            if labels_df.loc[idx, 'observation'] < 10:
-                labels_df.loc[idx, 'uid'] = row['id'] + '_00' + str(row['observation'])
-            else:
-                labels_df.loc[idx, 'uid'] = row['id'] + '_0' + str(row['observation'])
-        for observation in observation_list:
-            observation_id = os.path.basename(observation)
-            if observation_id not in labels_df['uid'].values:
-                continue
-            else:
-                for key in keys:
-                    label_dict[key].append(labels_df.loc[labels_df['uid'] == observation_id, key].values.item())
-            label_dict['uid'].append(observation_id)
+        observations = labels_df['observation'].astype(int).astype(str)
+        labels_df['uid'] = labels_df['id'] + '_0' + observations.str.zfill(2)
+        observation_ids = pd.Series([os.path.basename(observation) for observation in observation_list])
+        observation_ids = observation_ids[observation_ids.isin(labels_df['uid'])]
+        # duplicate labels would shift all following labels against the observation ids
+        duplicates = labels_df['uid'][labels_df['uid'].duplicated()]
+        duplicates = sorted(set(duplicates[duplicates.isin(observation_ids)]))
+        if duplicates:
+            raise ValueError(f'{label_path} contains multiple labels for the observations {duplicates}.')
+        labels_df = labels_df.set_index('uid').loc[observation_ids, keys]
+        label_dict = {'uid': observation_ids.tolist(), **{key: labels_df[key].tolist() for key in keys}}
         return [dict(zip(label_dict.keys(), vals)) for vals in zip(*(label_dict[k] for k in label_dict.keys()))]
     
     @staticmethod
@@ -218,13 +511,11 @@ class DatasetPreprocessor:
         label_df = pd.DataFrame.from_dict(label_dict)
         label_df['patient_id'] = label_df['uid'].str.split('_').str[1]
         data_dict = self.create_data_dict(observation_list, modality_dict)
-        for idx, patient in enumerate(data_dict):
-            if patient['uid'] in [label['uid'] for label in label_dict]:
-                for key in keys:
-                    data_dict[idx][key] = label_dict[[label['uid'] for label in label_dict].index(patient['uid'])][key]
-            else:
-                for key in keys:
-                    data_dict[idx][key] = None
+        labels = {label['uid']: label for label in label_dict}
+        for patient in data_dict:
+            label = labels.get(patient['uid'], {})
+            for key in keys:
+                patient[key] = label.get(key)
         if self.partial:
             for patient in data_dict:
                 keys_to_remove = [key for key, value in patient.items() if value == []]
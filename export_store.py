@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+import argparse
+import time
+import torch
+from monai.utils.misc import ensure_tuple_rep
+from data.cache import PersistentCache
+from data.store import export_store
+from data.utils import DatasetPreprocessor
+from utils.transforms import transforms
+from utils.config import parse_args
+
+def main(
+        args: argparse.Namespace
+    ) -> None:
+
+    '''
+    Packs the preprocessed images of all complete observations into a volume store, which is read instead of the
+    image files when --store-dir is passed to training. Observations that are in the persistent cache are not
+    preprocessed again.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+    '''
+    if args.store_dir is None:
+        raise ValueError('Please specify a path to the store directory.')
+    start_time = time.time()
+    preprocessor = DatasetPreprocessor(data_dir=args.data_dir)
+    observation_list = preprocessor.assert_observation_completeness(args.mod_list)
+    modality_dict = {modality: preprocessor.split_observations_by_modality(observation_list, modality) for modality in args.mod_list}
+    # the manifest is in natural order of the uids, so the exams of a patient are adjacent and in order
+    data_dict = preprocessor.create_data_dict(observation_list, modality_dict)
+    prep_transform = transforms(
+        dataset='prep',
+        modalities=args.mod_list,
+        device=torch.device('cpu'),
+        crop_size=ensure_tuple_rep(args.global_crop_size, 3))
+    cache = None
+    if args.cache_dir is not None:
+        cache = PersistentCache(
+            cache_dir=args.cache_dir,
+            transform=prep_transform,
+            image_keys=args.mod_list,
+            dtype=args.cache_dtype,
+            max_size=args.cache_size)
+    export_store(args.store_dir, data_dict, prep_transform, args.mod_list, dtype=args.cache_dtype, cache=cache, progress=True)
+    time_elapsed = time.time() - start_time
+    print(f'Store exported in {time_elapsed // 60:.0f}min {time_elapsed % 60:.0f}sec ({len(data_dict)} observations in {args.store_dir})')
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -1,6 +1,5 @@
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 import torch.distributed as dist
 import numpy as np
 
@@ -15,7 +14,8 @@ class DINOLoss(nn.Module):
             teacher_warmup_temp: float, 
             teacher_warmup_steps: int, 
             student_temp: float = 0.1,
-            center_momentum: float = 0.9
+            center_momentum: float = 0.9,
+            async_center: bool = False
         ) -> None:
         
         super().__init__()
@@ -23,6 +23,10 @@ class DINOLoss(nn.Module):
         self.center_momentum = center_momentum
         self.ncrops = num_crops
         self.register_buffer("center", torch.zeros(1, out_dim))
+        # with async_center, the all-reduce of the teacher outputs runs in the background during the backward pass
+        # and the optimizer step, and the center is updated at the beginning of the next forward pass
+        self.async_center = async_center
+        self.pending_center = None
         # we apply a warm up for the teacher temperature because
         # a too high temperature makes the training instable at the beginning
         self.teacher_temp_schedule = np.concatenate((
@@ -40,29 +44,37 @@ class DINOLoss(nn.Module):
         """
         Cross-entropy between softmax outputs of the teacher and student networks.
         """
+        self.sync_center()
 
-        student_out = student_output / self.student_temp
-        student_out = student_out.chunk(self.ncrops)
+        # student logits and their log-partition functions, the log-probabilities are never materialised:
+        # -sum(q * log_softmax(z)) = logsumexp(z) - sum(q * z), as the teacher probabilities q sum to one
+        student_out = (student_output.float() / self.student_temp).reshape(self.ncrops, -1, student_output.shape[-1])
+        student_lse = torch.logsumexp(student_out, dim=-1).mean(dim=1)
+        teacher_out = self.sharpen(teacher_output, self.teacher_temp_schedule[step])
+        teacher_out = teacher_out.reshape(2, -1, teacher_out.shape[-1])
 
-        # teacher centering and sharpening
-        temp = self.teacher_temp_schedule[step]
-        teacher_out = F.softmax((teacher_output - self.center) / temp, dim=-1)
-        teacher_out = teacher_out.detach().chunk(2)
-
-        total_loss = 0
-        n_loss_terms = 0
-        for iq, q in enumerate(teacher_out):
-            for v in range(len(student_out)):
-                if v == iq:
-                    # we skip cases where student and teacher operate on the same view
-                    continue
-                loss = torch.sum(-q * F.log_softmax(student_out[v], dim=-1), dim=-1)
-                total_loss += loss.mean()
-                n_loss_terms += 1
-        total_loss /= n_loss_terms
+        # cross-entropy between every pair of teacher and student views at once, in full precision under autocast:
+        # the einsum 'tbk,sbk->ts' contracts batch and output dimension together, i.e., a single matrix product
+        with torch.autocast(device_type=student_out.device.type, enabled=False):
+            cross = teacher_out.reshape(2, -1) @ student_out.reshape(self.ncrops, -1).T
+            loss = student_lse - cross / student_out.shape[1]
+        # we skip cases where student and teacher operate on the same view
+        total_loss = loss[~torch.eye(*loss.shape, dtype=torch.bool, device=loss.device)].mean()
         self.update_center(teacher_output)
         return total_loss
 
+    @torch.no_grad()
+    def sharpen(
+            self,
+            teacher_output: torch.Tensor,
+            temp: float
+        ) -> torch.Tensor:
+
+        """
+        Teacher centering and sharpening, with a single intermediate buffer.
+        """
+        return torch.sub(teacher_output.float(), self.center).mul_(1 / temp).softmax(dim=-1)
+
     @torch.no_grad()
     def update_center(
             self, 
@@ -73,8 +85,36 @@ class DINOLoss(nn.Module):
         Update center used for teacher output.
         """
         batch_center = torch.sum(teacher_output, dim=0, keepdim=True)
+        if self.async_center:
+            self.pending_center = (dist.all_reduce(batch_center, async_op=True), batch_center, len(teacher_output))
+            return
         dist.all_reduce(batch_center)
-        batch_center = batch_center / (len(teacher_output) * dist.get_world_size())
+        self.apply_center(batch_center, len(teacher_output))
+
+    @torch.no_grad()
+    def sync_center(self) -> None:
+
+        """
+        Wait for a pending all-reduce of the teacher outputs and update the center with it.
+        """
+        if self.pending_center is None:
+            return
+        work, batch_center, batch_size = self.pending_center
+        self.pending_center = None
+        work.wait()
+        self.apply_center(batch_center, batch_size)
+
+    @torch.no_grad()
+    def apply_center(
+            self,
+            batch_center: torch.Tensor,
+            batch_size: int
+        ) -> None:
+
+        """
+        EMA update of the center with the all-reduced sum of the teacher outputs.
+        """
+        batch_center = batch_center / (batch_size * dist.get_world_size())
 
         # ema update
         self.center = self.center * self.center_momentum + batch_center * (1 - self.center_momentum)
\ No newline at end of file
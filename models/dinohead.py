@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from itertools import groupby
 from torch.nn.utils.parametrizations import weight_norm
 from timm.models.layers import trunc_normal_
 
@@ -45,8 +46,8 @@ class MultiCropWrapper(nn.Module):
     The inputs corresponding to a single resolution are clubbed and single
     forward is run on the same resolution inputs. Hence we do several
     forward passes = number of different resolutions used. We then
-    concatenate all the output features and run the head forward on these
-    concatenated features.
+    write all the output features into one buffer and run the head
+    forward on it.
     """
     def __init__(self, backbone, head):
         super(MultiCropWrapper, self).__init__()
@@ -54,24 +55,41 @@ class MultiCropWrapper(nn.Module):
         backbone.fc, backbone.head = nn.Identity(), nn.Identity()
         self.backbone = backbone
         self.head = head
+        # resolution groups keyed on the input shapes, they are the same for every step
+        self._groups = {}
+
+    def groups(self, x):
+        shapes = tuple(tuple(inp.shape) for inp in x)
+        groups = self._groups.get(shapes)
+        if groups is None:
+            # consecutive inputs of the same spatial shape are run as one batch, e.g., 2 global and N local crops in 2 forwards
+            groups, start_idx, start_row = [], 0, 0
+            for _, group in groupby(shapes, key=lambda shape: shape[1:]):
+                group = list(group)
+                num_rows = sum(shape[0] for shape in group)
+                groups.append((start_idx, start_idx + len(group), start_row, start_row + num_rows))
+                start_idx, start_row = start_idx + len(group), start_row + num_rows
+            groups = self._groups[shapes] = tuple(groups)
+        return groups
 
     def forward(self, x):
         # convert to list
         if not isinstance(x, list):
             x = [x]
-        idx_crops = torch.cumsum(torch.unique_consecutive(
-            torch.tensor([inp.shape[-1] for inp in x]),
-            return_counts=True,
-        )[1], 0)
-        start_idx, output = 0, torch.empty(0).to(x[0].device)
-        for end_idx in idx_crops:
-            _out = self.backbone(torch.cat(x[start_idx: end_idx]))
+        groups = self.groups(x)
+        output = None
+        for start_idx, end_idx, start_row, end_row in groups:
+            _out = self.backbone(torch.cat(x[start_idx: end_idx]) if end_idx - start_idx > 1 else x[start_idx])
             # The output is a tuple with XCiT model. See:
             # https://github.com/facebookresearch/xcit/blob/master/xcit.py#L404-L405
             if isinstance(_out, tuple):
                 _out = _out[0]
-            # accumulate outputs
-            output = torch.cat((output, _out))
-            start_idx = end_idx
-        # Run the head forward on the concatenated features.
-        return self.head(output)
\ No newline at end of file
+            if len(groups) == 1:
+                output = _out
+                break
+            # write the outputs into one buffer instead of growing it by concatenation
+            if output is None:
+                output = _out.new_empty((groups[-1][-1],) + _out.shape[1:])
+            output[start_row:end_row] = _out
+        # Run the head forward on the buffer of all features.
+        return self.head(output)
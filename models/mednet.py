@@ -151,7 +151,8 @@ class MedNet(nn.Module):
             dropout: float = 0.1,
             activation: str = 'gelu',
             eps: float = 1e-6,
-            norm_first: bool = True
+            norm_first: bool = True,
+            packed: bool = False
         ) -> None:
 
         '''
@@ -165,6 +166,7 @@ class MedNet(nn.Module):
             activation (str): The activation function in the encoder layers.
             eps (float): Epsilon to stabilize training. Default: 1e-6.
             norm_first (bool): Whether the use the Pre-LN transformer encoder.
+            packed (bool): Whether to only run the backbone on non-padded timepoints.
         '''
 
         super().__init__()
@@ -172,6 +174,7 @@ class MedNet(nn.Module):
         _remove_last_layer(backbone)
         self.backbone = backbone
         self.pretrain = pretrain
+        self.packed = packed
         self.positional_encoding = PositionalEncoding(
             d_model=self.d_model, 
             max_len=max_len, 
@@ -235,25 +238,39 @@ class MedNet(nn.Module):
         B, S, _ = x.shape
         pad_idx = torch.argmax(pad_mask, dim=1)
         pad_idx = torch.where(pad_idx == 0, S, pad_idx)
-        prob_mask = torch.rand(B) < prob
-        for i in range(B):
-            if prob_mask[i]:
-                if pad_idx[i] - 1 == 1:
-                    prob_mask[i] = False
-                rand_idx = torch.randperm(pad_idx[i] - 1)
-                rand_idx += 1
-                x[i, 1:pad_idx[i]] = x[i, rand_idx]
-        labels = prob_mask.float()
-        return x, labels.to(x.device)
+        prob_mask = torch.rand(B, device=x.device) < prob
+        # the timepoints between the cls token and the padding of the selected sequences get uniform random sort keys
+        # in (0, 1), all others keep their order, i.e., sorting the keys yields a random permutation of these timepoints
+        idx = torch.arange(S, device=x.device).expand(B, S)
+        shuffle_mask = prob_mask[:, None] & (idx > 0) & (idx < pad_idx[:, None])
+        keys = torch.where(shuffle_mask, torch.rand(B, S, device=x.device), torch.where(idx == 0, -1.0, idx + 1.0))
+        rand_idx = torch.argsort(keys, dim=1)
+        x = torch.gather(x, 1, rand_idx[..., None].expand_as(x))
+        # sequences with a single timepoint to shuffle are never altered
+        labels = prob_mask & (pad_idx - 1 != 1)
+        return x, labels.float()
 
     def extract_features(
             self,
             x: torch.Tensor,
+            pad_mask: torch.Tensor | None = None
         ) -> torch.Tensor:
 
         B, S, C, H, W, D = x.shape
         x = x.reshape(B * S, C, H, W, D)
-        x = self.backbone(x)
+        if self.packed and pad_mask is not None:
+            # Padded timepoints are copies of the first image in the sequence or left empty (see SequenceBatchCollater),
+            # so we only embed the real timepoints and reuse the first embedding for the padded ones.
+            real = pad_mask == 0
+            real[:, 0] = True
+            real = real.reshape(B * S)
+            packed_idx = torch.cumsum(real, dim=0) - 1
+            first_idx = torch.arange(B, device=x.device).repeat_interleave(S) * S
+            src_idx = torch.where(real, torch.arange(B * S, device=x.device), first_idx)
+            x = self.backbone(x[real])
+            x = x.index_select(0, packed_idx[src_idx])
+        else:
+            x = self.backbone(x)
         x = x.reshape(B, S, self.d_model)
         return x
     
@@ -264,7 +281,7 @@ class MedNet(nn.Module):
             pos: torch.Tensor
         ) -> torch.Tensor:
 
-        x = self.extract_features(x)
+        x = self.extract_features(x, pad_mask)
         x, pad_mask, pos = self.add_cls_token(x, pad_mask, pos)
         if self.pretrain:
             x, labels = self.shuffle_sequence(x, pad_mask, prob=0.66)
@@ -28,7 +28,9 @@ from utils.config import parse_args
 from utils.utils import (
     cancel_gradients_last_layer, 
     scale_learning_rate, 
-    prep_batch)
+    prep_batch,
+    update_ema,
+    FlatParameters)
 
 class Pretrainer:
 
@@ -42,7 +44,10 @@ class Pretrainer:
             num_steps: int = 1000,
             amp: bool = True,
             suffix: str | None = None,
-            output_dir: str | None = None
+            output_dir: str | None = None,
+            num_local_crops: int = 2,
+            teacher_update_every: int = 1,
+            flat_params: List[FlatParameters] | None = None
         ) -> None:
 
         '''
@@ -56,6 +61,10 @@ class Pretrainer:
             amp (bool): Boolean flag to enable automatic mixed precision training. Defaults to true.
             suffix (str | None): Unique string under which model results are stored.
             output_dir (str | None): Directory to store model outputs.
+            num_local_crops (int): Number of local views per image for DINO pretraining. Defaults to 2.
+            teacher_update_every (int): Number of update steps between EMA updates of the teacher. Defaults to 1.
+            flat_params (List[FlatParameters] | None): Flat parameters of the student and the teacher for CNN backbone pretraining, or None
+                if the parameters are separate tensors. Defaults to None.
         '''
 
         self.gpu_id = int(os.environ['LOCAL_RANK'])
@@ -77,6 +86,7 @@ class Pretrainer:
         if self.output_dir is None:
             raise ValueError('Please specify a path to the data directory.')
         self.scaler = GradScaler(enabled=amp)
+        self.views = ['gv1','gv2'] + [f'lv{i + 1}' for i in range(num_local_crops)]
 
         if isinstance(loss_fn, list):
             self.loss_fn = loss_fn[0].to(self.gpu_id)
@@ -86,10 +96,18 @@ class Pretrainer:
         self.optim = optimizer
         if self.backbone_only:
             self.lr_schedule, self.wd_schedule, self.m_schedule = scheduler[0], scheduler[1], scheduler[2]
-            self.params = self.student.parameters()
+            self.params = list(self.student.parameters())
+            self.flat_params = flat_params
+            if self.flat_params is not None:
+                self.student_params, self.teacher_params = [self.flat_params[0].data], [self.flat_params[1].data]
+            else:
+                self.student_params = [p.detach() for p in self.student.parameters()]
+                self.teacher_params = [p.detach() for p in self.teacher.parameters()]
+            self.teacher_update_every = teacher_update_every
         else:
             self.lr_schedule, self.wd_schedule = scheduler[0], scheduler[1]
-            self.params = self.model.parameters()
+            self.params = list(self.model.parameters())
+            self.flat_params = None
         self.results_dict = {dataset: {metric: [] for metric in ['loss']} for dataset in ['train']}
         self.auroc = BinaryAUROC()
 
@@ -170,8 +188,8 @@ class Pretrainer:
 
         self.student.train()
         self.teacher.train()
-        gv1, gv2, lv1, lv2 = batch['gv1'], batch['gv2'], batch['lv1'], batch['lv2']
-        views = [view.to(self.gpu_id) for view in [gv1, gv2, lv1, lv2]]
+        # global views first, the teacher only sees those
+        views = [batch[view].to(self.gpu_id) for view in self.views]
 
         with autocast(enabled=self.amp):
             student_logits = self.student(views)
@@ -229,13 +247,18 @@ class Pretrainer:
 
         if clip_grad:
             self.scaler.unscale_(self.optim)
-            nn.utils.clip_grad_norm_(self.params, max_norm=1.0, norm_type=2)
+            if self.flat_params is not None:
+                self.flat_params[0].clip_grad_norm_(max_norm=1.0)
+            else:
+                nn.utils.clip_grad_norm_(self.params, max_norm=1.0, norm_type=2)
         if self.backbone_only:
             cancel_gradients_last_layer(self.student, step=step, warmup_steps=warmup_steps)
 
         self.scaler.step(self.optim)
         self.scaler.update()
         self.optim.zero_grad(set_to_none=True)
+        if self.flat_params is not None:
+            self.flat_params[0].attach_grads()
 
     @torch.no_grad()
     def update_teacher(
@@ -243,15 +266,17 @@ class Pretrainer:
             step: int
         ) -> None:
 
-        m = self.m_schedule[step]
-        for param_q, param_k in zip(self.student.parameters(), self.teacher.parameters()):
-            param_k.data.mul_(m).add_((1 - m) * param_q.detach().data)
-
         '''
         Args:
             step (int): Current training step.
         '''
 
+        if (step + 1) % self.teacher_update_every != 0:
+            return
+        # the skipped updates are folded into the momentum: m^k instead of k updates with momentum m
+        m = self.m_schedule[step] ** self.teacher_update_every
+        update_ema(self.teacher_params, self.student_params, m)
+
     def pretrain(
             self,
             batch_size: int,
@@ -272,6 +297,8 @@ class Pretrainer:
         running_loss = 0.0
         start_time = time.time()
         self.optim.zero_grad(set_to_none=True)
+        if self.flat_params is not None:
+            self.flat_params[0].attach_grads()
 
         for epoch in range(self.num_steps * accum_steps // len(self.dataloaders['train']) + 1):
             for idx, batch in enumerate(self.dataloaders['train']):
@@ -319,6 +346,8 @@ class Pretrainer:
                 if (step + 1) / accum_steps == self.num_steps:
                     break
 
+        if self.backbone_only:
+            self.loss_fn.sync_center()
         if self.gpu_id == 0:
             time_elapsed = time.time() - start_time
             print(f'Pretraining finished in {time_elapsed // 60:.0f}min {time_elapsed % 60:.0f}sec')
@@ -431,10 +460,14 @@ def main(
             teacher,
             DINOHead(embed_dim, args.out_dim))
         student, teacher = student.to(device_id), teacher.to(device_id)
+        flat_params = [FlatParameters(student), FlatParameters(teacher, grads=False)] if args.flat_params else None
         if args.distributed:
             student = nn.parallel.DistributedDataParallel(student, device_ids=[device_id])
             teacher = nn.parallel.DistributedDataParallel(teacher, device_ids=[device_id])
-        teacher.load_state_dict(student.state_dict())
+        if flat_params is not None:
+            flat_params[1].copy_(flat_params[0])
+        else:
+            teacher.load_state_dict(student.state_dict())
         for p in teacher.parameters():
             p.requires_grad = False
         loss_fn, optimizer, schedules = load_objs(args, student, learning_rate)
@@ -448,7 +481,8 @@ def main(
             max_len=12,
             num_layers=4 if any(args.arch in x for x in ['femto', 'pico']) else 6,
             dropout=args.dropout,
-            eps=args.epsilon)
+            eps=args.epsilon,
+            packed=args.packed)
         weights = load_weights(args, os.path.join(args.results_dir, f'model_weights/weights_fold32000_{modality}_{args.arch}.pth'))
         model.load_state_dict(weights, strict=False)
         model = model.to(device_id)
@@ -467,7 +501,10 @@ def main(
         num_steps=args.num_steps,
         amp=args.amp,
         suffix=args.suffix,
-        output_dir=args.results_dir)
+        output_dir=args.results_dir,
+        num_local_crops=args.num_local_crops,
+        teacher_update_every=args.teacher_update_every,
+        flat_params=flat_params if backbone_only else None)
 
     if rank == 0:
         print('-' * 15)
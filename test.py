@@ -295,7 +295,8 @@ def main(
                     max_len=12,
                     num_layers=4 if any(arch in x for x in ['femto', 'pico']) else 6,
                     dropout=args.dropout, 
-                    eps=args.epsilon)
+                    eps=args.epsilon,
+                    packed=args.packed)
                 file_name = f'weights_fold{k}_{modality}_{arch}_{suffix}.pth'
                 weights = load_weights(os.path.join(args.weights_dir, file_name))
                 model.load_state_dict(weights)
@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import torch
+import torch.nn.functional as F
+import os
+import numpy as np
+import nibabel as nib
+from data.transforms import YeoJohnsond, SoftClipOutliersd, PercentileSpatialCropd
+from monai.transforms import (
+    Compose, ConcatItemsd, CopyItemsd, CropForegroundd, DeleteItemsd, EnsureChannelFirstd,
+    KeepLargestConnectedComponentd, Lambdad, LoadImaged, NormalizeIntensityd, Orientationd, ResampleToMatchd, Spacingd
+)
+from models.dinohead import MultiCropWrapper
+from losses.dinoloss import DINOLoss
+
+def masked_yeo_johnson(
+        image: torch.Tensor,
+        lmbda: float | list
+    ) -> torch.Tensor:
+
+    '''
+    Reference implementation of the Yeo-Johnson transformation with boolean-mask indexing per channel.
+
+    Args:
+        image (torch.Tensor): Image to transform in place.
+        lmbda (float | list): Strength of the transformation, per channel if a list is provided.
+    '''
+
+    for channel in range(image.shape[0]):
+        channel_lmbda = lmbda[channel] if isinstance(lmbda, list) else lmbda
+        positives = image[channel] >= 0
+        negatives = image[channel] < 0
+        if channel_lmbda == 0 or channel_lmbda == 2:
+            image[channel][positives] = torch.log1p(image[channel][positives])
+            image[channel][negatives] = -torch.log1p(-image[channel][negatives])
+        else:
+            image[channel][positives] = ((image[channel][positives] + 1) ** channel_lmbda - 1) / channel_lmbda
+            image[channel][negatives] = -((-image[channel][negatives] + 1) ** (2 - channel_lmbda) - 1) / (2 - channel_lmbda)
+    return image
+
+def reference_soft_clip(
+        image: torch.Tensor,
+        scale_factor: float
+    ) -> torch.Tensor:
+
+    '''
+    Reference implementation of the channel-wise median absolute deviation soft clip with exact medians and
+    unfused soft plus/minus terms.
+
+    Args:
+        image (torch.Tensor): Image to clip.
+        scale_factor (float): Maximum median absolute deviation.
+    '''
+
+    def softplus(x):
+        return torch.log(1 + torch.exp(-torch.abs(x))) + torch.maximum(x, torch.tensor([0]))
+
+    for channel in range(image.shape[0]):
+        median = torch.median(image[channel])
+        mad = torch.median(torch.abs(image[channel] - median)) * 1.4826
+        lower, upper = median - mad * scale_factor, median + mad * scale_factor
+        const = torch.log(torch.tensor([2])) / (1 - torch.tanh(torch.tensor([1])))
+        const /= (upper - lower) / 2
+        x = image[channel]
+        image[channel] = x + softplus(-const * (x - lower)) / const - softplus(const * (x - upper)) / const
+    return image
+
+def reference_prep_transforms(
+        modalities: list
+    ) -> Compose:
+
+    '''
+    Deterministic preprocessing in its original order, which resamples all modalities onto the full field of view of
+    the first modality and the whole foreground onto the target spacing before cropping.
+
+    Args:
+        modalities (list): List of image modalities.
+    '''
+    return Compose([
+        LoadImaged(keys=modalities, image_only=True),
+        EnsureChannelFirstd(keys=modalities),
+        Orientationd(keys=modalities, axcodes='PLI'),
+        YeoJohnsond(keys=modalities, lmbda=0.5),
+        ResampleToMatchd(keys=modalities, key_dst=modalities[0], mode=3),
+        ConcatItemsd(keys=modalities, name='image'),
+        CopyItemsd(keys=modalities[0], names='mask'),
+        PercentileSpatialCropd(keys=['image','mask'], roi_center=(0.5, 0.5, 0.5), roi_size=(0.85, 0.8, 0.99), min_size=(82, 82, 82)),
+        Lambdad(keys='mask', func=lambda x: torch.where(x > torch.mean(x), 1, 0)),
+        KeepLargestConnectedComponentd(keys='mask', connectivity=1),
+        CropForegroundd(keys='image', source_key='mask', select_fn=lambda x: x > 0, k_divisible=1, allow_smaller=False),
+        DeleteItemsd(keys=modalities + ['mask']),
+        SoftClipOutliersd(keys='image', scale_factor=3.5, channel_wise=True),
+        NormalizeIntensityd(keys='image', channel_wise=True),
+        Spacingd(keys='image', pixdim=(1.5, 1.5, 1.5), mode=3),
+        PercentileSpatialCropd(keys='image', roi_center=(0.5, 0.3, 0.3), roi_size=(0.6, 0.5, 0.4), min_size=(82, 82, 82))
+    ])
+
+def create_exams(
+        data_dir: str,
+        num_exams: int,
+        size: int,
+        modalities: list
+    ) -> list:
+
+    '''
+    Writes synthetic exams whose modalities are acquired on slightly different grids.
+
+    Args:
+        data_dir (str): Path to the directory to write the images to.
+        num_exams (int): Number of exams to create.
+        size (int): In-plane size of the images.
+        modalities (list): List of image modalities per exam.
+
+    Returns:
+        list: Image paths of every exam, keyed on the modality.
+    '''
+    rng = np.random.default_rng(0)
+    exams = []
+    for exam in range(num_exams):
+        shape = (size, size, size * 2 // 3)
+        liver = np.zeros(shape, dtype=np.float32)
+        liver[size // 4:size * 3 // 4, size // 4:size * 3 // 4, size // 6:size // 2] = 300
+        paths = {}
+        for idx, modality in enumerate(modalities):
+            affine = np.diag([1.2 + 0.05 * idx, 1.2, 1.8, 1.0])
+            affine[:3, 3] = [-60 + idx, -70 - idx, -50]
+            image = rng.gamma(2.0, 50.0, size=shape).astype(np.float32) + liver * (1 - 0.2 * idx)
+            paths[modality] = os.path.join(data_dir, f'{exam}_{modality}.nii.gz')
+            nib.save(nib.Nifti1Image(image, affine), paths[modality])
+        exams.append(paths)
+    return exams
+
+def reference_dino_loss(
+        loss_fn: DINOLoss,
+        step: int,
+        student_output: torch.Tensor,
+        teacher_output: torch.Tensor
+    ) -> torch.Tensor:
+
+    '''
+    DINO cross-entropy with one term per pair of teacher and student views, as computed before the batched matrix product.
+
+    Args:
+        loss_fn (DINOLoss): Loss whose configuration and center are used.
+        step (int): Current training step.
+        student_output (torch.Tensor): Outputs of the student for all views.
+        teacher_output (torch.Tensor): Outputs of the teacher for the global views.
+    '''
+    student_out = (student_output / loss_fn.student_temp).chunk(loss_fn.ncrops)
+    teacher_out = F.softmax((teacher_output - loss_fn.center) / loss_fn.teacher_temp_schedule[step], dim=-1).detach().chunk(2)
+    total_loss, n_loss_terms = 0, 0
+    for iq, q in enumerate(teacher_out):
+        for v in range(len(student_out)):
+            if v == iq:
+                continue
+            total_loss += torch.sum(-q * F.log_softmax(student_out[v], dim=-1), dim=-1).mean()
+            n_loss_terms += 1
+    return total_loss / n_loss_terms
+
+def reference_multi_crop_forward(
+        wrapper: MultiCropWrapper,
+        x: list
+    ) -> torch.Tensor:
+
+    '''
+    Forward of MultiCropWrapper as before the cached grouping, which grouped the inputs on the host and concatenated
+    the outputs of every resolution group.
+
+    Args:
+        wrapper (MultiCropWrapper): Wrapper whose backbone and head are used.
+        x (list): Input views.
+    '''
+    idx_crops = torch.cumsum(torch.unique_consecutive(torch.tensor([inp.shape[-1] for inp in x]), return_counts=True)[1], 0)
+    start_idx, output = 0, torch.empty(0).to(x[0].device)
+    for end_idx in idx_crops:
+        output = torch.cat((output, wrapper.backbone(torch.cat(x[start_idx: end_idx]))))
+        start_idx = end_idx
+    return wrapper.head(output)
+
+def reference_update_teacher(
+        student: torch.nn.Module,
+        teacher: torch.nn.Module,
+        m: float
+    ) -> None:
+
+    '''
+    EMA update of the teacher with one multiplication and addition per parameter, as before the fused update.
+
+    Args:
+        student (torch.nn.Module): Student network.
+        teacher (torch.nn.Module): Teacher network, updated in place.
+        m (float): Momentum of the moving average.
+    '''
+    with torch.no_grad():
+        for param_q, param_k in zip(student.parameters(), teacher.parameters()):
+            param_k.data.mul_(m).add_((1 - m) * param_q.detach().data)
+
+def reference_shuffle_sequence(
+        x: torch.Tensor,
+        pad_mask: torch.Tensor,
+        prob: float = 0.5
+    ) -> tuple:
+
+    '''
+    Shuffles the timepoints of the sequences one sequence at a time, as before the batched sort over random keys.
+
+    Args:
+        x (torch.Tensor): Features of the sequences including the cls token.
+        pad_mask (torch.Tensor): Padding mask of the sequences.
+        prob (float): Probability to shuffle a sequence. Defaults to 0.5.
+    '''
+    B, S, _ = x.shape
+    pad_idx = torch.argmax(pad_mask, dim=1)
+    pad_idx = torch.where(pad_idx == 0, S, pad_idx)
+    prob_mask = torch.rand(B) < prob
+    for i in range(B):
+        if prob_mask[i]:
+            if pad_idx[i] - 1 == 1:
+                prob_mask[i] = False
+            rand_idx = torch.randperm(pad_idx[i] - 1)
+            rand_idx += 1
+            x[i, 1:pad_idx[i]] = x[i, rand_idx]
+    return x, prob_mask.float().to(x.device)
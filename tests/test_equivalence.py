@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+import pytest
+import torch
+import torch.distributed as dist
+import numpy as np
+import os
+from tests.reference import masked_yeo_johnson, reference_soft_clip, reference_prep_transforms, create_exams, reference_dino_loss
+from data.transforms import YeoJohnsond, SoftClipOutliersd
+from data.engine import BatchedCompose
+from monai.data import MetaTensor
+from monai.transforms import Compose, ConcatItemsd, NormalizeIntensityd
+from utils.transforms import transforms, batch_transforms
+from losses.dinoloss import DINOLoss
+
+@pytest.mark.parametrize('lmbda', [0.5, 0, [0.5, 1.0, 1.5, 0.25], [0.5, 2, 0, 1.5]])
+def test_yeo_johnson(
+        lmbda: float | list
+    ) -> None:
+
+    '''
+    The fused YeoJohnsond transform agrees with the masked reference implementation.
+
+    Args:
+        lmbda (float | list): Strength of the transformation, per channel if a list is provided.
+    '''
+    torch.manual_seed(0)
+    image = torch.randn(4, 8, 8, 8) * 2
+    expected = masked_yeo_johnson(image.clone(), lmbda)
+    actual = YeoJohnsond(keys='image', lmbda=lmbda, channel_wise=True)({'image': image.clone()})['image']
+    torch.testing.assert_close(actual, expected)
+
+def mri_like_image() -> torch.Tensor:
+
+    '''
+    Skewed tissue intensities next to a large background, after the Yeo-Johnson transformation of the preprocessing.
+    '''
+    torch.manual_seed(0)
+    image = torch.distributions.Gamma(2.0, 0.02).sample((4, 16, 16, 16))
+    image[:, :, :4] = 0
+    return YeoJohnsond(keys='image', lmbda=0.5)({'image': image})['image']
+
+def test_soft_clip() -> None:
+
+    '''
+    The fused SoftClipOutliersd with exact medians agrees with the unfused reference implementation.
+    '''
+    image = mri_like_image()
+    expected = reference_soft_clip(image.clone(), 3.5)
+    actual = SoftClipOutliersd(keys='image', scale_factor=3.5, channel_wise=True)({'image': image.clone()})['image']
+    torch.testing.assert_close(actual, expected, rtol=1e-4, atol=1e-4)
+
+@pytest.mark.parametrize('rel_error', [1e-2, 1e-3, 1e-4])
+def test_histogram_median_mad(
+        rel_error: float
+    ) -> None:
+
+    '''
+    The histogram based medians and median absolute deviations are within the requested error of the exact ones.
+
+    Args:
+        rel_error (float): Maximum error relative to the intensity range.
+    '''
+    flat = mri_like_image().reshape(4, -1)
+    value_range = flat.max(dim=1).values - flat.min(dim=1).values
+    exact_median, exact_mad = SoftClipOutliersd.median_mad(flat)
+    median, mad = SoftClipOutliersd.histogram_median_mad(flat, rel_error)
+    assert torch.all((median - exact_median).abs() <= rel_error * value_range / 2 + 1e-5)
+    assert torch.all((mad - exact_mad).abs() <= rel_error * value_range + 1e-5)
+
+def test_batched_prep() -> None:
+
+    '''
+    The batched engine produces the same images as the intensity transforms of the preprocessing per observation.
+    '''
+    modalities = ['DWI_b0', 'DWI_b150', 'DWI_b400', 'DWI_b800']
+    torch.manual_seed(0)
+    images = torch.distributions.Gamma(2.0, 0.02).sample((3, len(modalities), 1, 12, 12, 12))
+    transform = Compose([
+        YeoJohnsond(keys=modalities, lmbda=0.5),
+        ConcatItemsd(keys=modalities, name='image'),
+        SoftClipOutliersd(keys='image', scale_factor=3.5, channel_wise=True),
+        NormalizeIntensityd(keys='image', channel_wise=True)])
+
+    def observations():
+        return [{mod: MetaTensor(image[idx].clone()) for idx, mod in enumerate(modalities)} for image in images]
+
+    expected = torch.stack([transform(item)['image'].as_tensor() for item in observations()])
+    actual = torch.stack([item['image'].as_tensor() for item in BatchedCompose(transform, device=torch.device('cpu'))(observations())])
+    torch.testing.assert_close(actual, expected, rtol=1e-4, atol=1e-4)
+
+    # only float32 images are normalized batched, the observations fall back to the per-observation transform
+    transform = Compose([NormalizeIntensityd(keys=['image', 'mask'], subtrahend=1.0, divisor=2.0)])
+
+    def mixed_observations():
+        return [{'image': image[:, 0].clone(), 'mask': image[:, 0].double()} for image in images]
+
+    expected = [transform(item) for item in mixed_observations()]
+    actual = BatchedCompose(transform, device=torch.device('cpu'))(mixed_observations())
+    for key in ['image', 'mask']:
+        torch.testing.assert_close(torch.stack([item[key] for item in actual]), torch.stack([item[key] for item in expected]))
+
+PREP_MODALITIES = ['DWI_b0', 'DWI_b150', 'DWI_b400', 'DWI_b800']
+
+@pytest.fixture(scope='module')
+def exams(
+        tmp_path_factory: pytest.TempPathFactory
+    ) -> list:
+
+    '''
+    Synthetic exams whose modalities are acquired on slightly different grids.
+
+    Args:
+        tmp_path_factory (pytest.TempPathFactory): Factory of temporary directories.
+    '''
+    return create_exams(str(tmp_path_factory.mktemp('exams')), 2, 40, PREP_MODALITIES)
+
+def test_prep_roi(
+        exams: list
+    ) -> None:
+
+    '''
+    The preprocessing that resamples only the planned region of interest produces the same images as the original
+    order, which resamples the whole field of view before cropping.
+
+    Args:
+        exams (list): Image paths of every exam, keyed on the modality.
+    '''
+    planned = transforms(dataset='prep', modalities=PREP_MODALITIES, device=torch.device('cpu'))
+    # the padding and center crop to the final size are not part of the reference
+    planned = Compose(planned.transforms[:-2], lazy=planned.lazy, overrides=planned.overrides)
+    reference = reference_prep_transforms(PREP_MODALITIES)
+    for paths in exams:
+        torch.testing.assert_close(planned(dict(paths))['image'].as_tensor(), reference(dict(paths))['image'].as_tensor(), rtol=1e-4, atol=1e-4)
+
+def test_lazy_resample(
+        exams: list
+    ) -> None:
+
+    '''
+    The preprocessing that composes the reorientation with the resampling of every modality produces the same images
+    as its eager evaluation.
+
+    Args:
+        exams (list): Image paths of every exam, keyed on the modality.
+    '''
+    lazy = transforms(dataset='prep', modalities=PREP_MODALITIES, device=torch.device('cpu'))
+    eager = Compose(lazy.transforms, lazy=False)
+    for paths in exams:
+        torch.testing.assert_close(lazy(dict(paths))['image'].as_tensor(), eager(dict(paths))['image'].as_tensor(), rtol=1e-4, atol=1e-4)
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_batched_augmentation(
+        seed: int
+    ) -> None:
+
+    '''
+    The augmentation of the collated batch produces the same crops as the random transforms of the training images,
+    given the parameters that the transforms have drawn per image.
+
+    Args:
+        seed (int): Seed of the random transforms.
+    '''
+    crop_size = (8, 8, 8)
+    device = torch.device('cpu')
+    torch.manual_seed(seed)
+    images = torch.randn(6, len(PREP_MODALITIES), 12, 10, 14)
+    start = len(transforms(dataset='prep', modalities=PREP_MODALITIES, device=device).transforms)
+    chain = transforms(dataset='train', modalities=PREP_MODALITIES, device=device, crop_size=crop_size)
+    augment = Compose(chain.transforms[start:]).set_random_state(seed=seed)
+    crop, flip_x, flip_y, flip_z, rotate, scale, shift = augment.transforms[1:-1]
+
+    expected, params = [], {'offset': [], 'flip': [], 'k': [], 'scale': [], 'shift': []}
+    for image in images:
+        expected.append(augment({'image': image.clone()})['image'])
+        params['offset'].append([s.start for s in crop.cropper._slices])
+        params['flip'].append([flip._do_transform for flip in [flip_x, flip_y, flip_z]])
+        params['k'].append(rotate._rand_k if rotate._do_transform else 0)
+        params['scale'].append(scale.scaler.factor)
+        params['shift'].append(shift.shifter._offset)
+    params = {key: np.asarray(value) for key, value in params.items()}
+    actual = batch_transforms(PREP_MODALITIES, crop_size=crop_size)(images.clone(), params)
+    torch.testing.assert_close(actual, torch.stack(expected), rtol=1e-5, atol=1e-5)
+
+@pytest.fixture(scope='module')
+def process_group() -> None:
+
+    '''
+    Single-process gloo group for the all-reduce of the DINO center.
+    '''
+    if not dist.is_initialized():
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', '29561')
+        dist.init_process_group('gloo', rank=0, world_size=1)
+
+@pytest.mark.parametrize('num_crops', [4, 6])
+def test_dino_loss(
+        process_group: None,
+        num_crops: int
+    ) -> None:
+
+    '''
+    The batched DINO cross-entropy agrees in loss and student gradients with one term per pair of views.
+
+    Args:
+        process_group (None): Initialized process group.
+        num_crops (int): Number of global and local views.
+    '''
+    torch.manual_seed(0)
+    loss_fn = DINOLoss(64, num_crops, num_steps=10, teacher_temp=0.04, teacher_warmup_temp=0.04, teacher_warmup_steps=0)
+    loss_fn.center.normal_()
+    student_output = torch.randn(num_crops * 8, 64, requires_grad=True)
+    teacher_output = torch.randn(2 * 8, 64)
+    expected = reference_dino_loss(loss_fn, 0, student_output, teacher_output)
+    expected_grad, = torch.autograd.grad(expected, student_output)
+    loss = loss_fn(0, student_output, teacher_output)
+    grad, = torch.autograd.grad(loss, student_output)
+    torch.testing.assert_close(loss, expected)
+    torch.testing.assert_close(grad, expected_grad)
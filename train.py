@@ -414,7 +414,8 @@ def main(
                 num_layers=4 if any(args.arch in x for x in ['femto', 'pico']) else 6,
                 max_len=12,
                 dropout=args.dropout, 
-                eps=args.epsilon)
+                eps=args.epsilon,
+                packed=args.packed)
             if args.pretrained:
                 weights_version = 'te' if any(args.arch in x for x in ['femto', 'pico']) else 'te_1gpu'
                 weights_path = os.path.join(args.results_dir, f'model_weights/weights_fold8000_{modality}_{args.arch}_{weights_version}.pth')
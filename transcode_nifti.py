@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import argparse
+import shutil
+import time
+import os
+from multiprocessing.pool import ThreadPool
+from tqdm import tqdm
+from data.nifti import transcode
+from data.utils import scan_observations
+from utils.config import parse_args
+
+def main(
+        args: argparse.Namespace
+    ) -> None:
+
+    '''
+    Transcodes all images of the data directory once into block-compressed images, which are still regular .nii.gz
+    files but can be decompressed in parallel. The labels are copied as they are.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+    '''
+    if args.transcode_dir is None:
+        raise ValueError('Please specify a path to the transcoded data directory.')
+    if os.path.abspath(args.transcode_dir) == os.path.abspath(args.data_dir):
+        raise ValueError('The transcoded data directory must differ from the data directory.')
+    start_time = time.time()
+    manifest = scan_observations(os.path.join(args.data_dir, 'nifti'))
+    images = [(observation, image) for observation, names in manifest.items() for image in names]
+
+    def transcode_image(image: tuple) -> int:
+        observation, name = image
+        dst_dir = os.path.join(args.transcode_dir, 'nifti', os.path.basename(observation))
+        os.makedirs(dst_dir, exist_ok=True)
+        dst = os.path.join(dst_dir, name)
+        transcode(os.path.join(observation, name), dst, level=args.compress_level, num_threads=1)
+        return os.path.getsize(dst)
+
+    # zlib releases the GIL, so the images are transcoded in parallel on threads
+    with ThreadPool(args.num_workers) as p:
+        size = sum(tqdm(p.imap_unordered(transcode_image, images), total=len(images), desc='Transcoding images'))
+    shutil.copytree(os.path.join(args.data_dir, 'labels'), os.path.join(args.transcode_dir, 'labels'), dirs_exist_ok=True)
+    time_elapsed = time.time() - start_time
+    print(f'Transcoded {len(images)} images in {time_elapsed // 60:.0f}min {time_elapsed % 60:.0f}sec ({size / 1024 ** 3:.2f} GB in {args.transcode_dir})')
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
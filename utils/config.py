@@ -34,6 +34,12 @@ def parse_args() -> argparse.Namespace:
                         help="Flag to use pretrained weights.")
     parser.add_argument("--partial", action='store_true',
                         help="Flag to only use DINO pretrained weights.")
+    parser.add_argument("--packed", action='store_true',
+                        help="Whether to skip padded timepoints when extracting image features.")
+    parser.add_argument("--batched-augmentation", action='store_true',
+                        help="Whether to apply the random augmentations of the training images to the whole collated batch instead of per image.")
+    parser.add_argument("--bucket-size", default=0, type=int,
+                        help="Number of batches within which training sequences are grouped by length and only padded to the longest sequence in the batch. Defaults to 0 (no bucketing).")
     parser.add_argument("--k-folds", default=5, type=int, 
                         help="Number of folds to use in cross validation. Defaults to 5.")
     parser.add_argument("--max-delta", default=3, type=int, 
@@ -72,16 +78,24 @@ def parse_args() -> argparse.Namespace:
                         help="Global crop size to use. Defaults to 72.")
     parser.add_argument("--local-crop-size", default=48, type=int, 
                         help="Local crop size to use. Defaults to 48.")
+    parser.add_argument("--num-local-crops", default=2, type=int, 
+                        help="Number of local crops per image for DINO pretraining. Defaults to 2.")
           
     # DINO pre-training specifics
     parser.add_argument("--norm-last-layer", action='store_true',
                         help="Whether to weight normalize the last layer of the DINO head.")
     parser.add_argument("--teacher-momentum", default=0.9995, type=float, 
                         help="Inital momentum value to update teacher network with EMA. Defaults to 0.9995.")
+    parser.add_argument("--teacher-update-every", default=1, type=int,
+                        help="Number of update steps between EMA updates of the teacher, the momentum is raised to this power. Defaults to 1.")
+    parser.add_argument("--flat-params", action='store_true',
+                        help="Whether to pack the parameters and gradients of the student and teacher into contiguous buffers.")
     parser.add_argument("--teacher-temp", default=0.04, type=float, 
                         help="Final (i.e., after warmup) teacher temperature value. Defaults to 0.04")
     parser.add_argument("--teacher-warmup-temp", default=0.04, type=float, 
                         help="Initial teacher temperature value. Defaults to 0.04")
+    parser.add_argument("--async-center", action='store_true',
+                        help="Whether to overlap the all-reduce of the teacher center with the backward pass and apply it at the next step.")
 
     # File paths and auxiliaries
     parser.add_argument("--mod-list", default=MOD_LIST, nargs='+', 
@@ -96,6 +110,24 @@ def parse_args() -> argparse.Namespace:
                         help="Path to results directory")
     parser.add_argument("--weights-dir", default=WEIGHTS_DIR, type=str, 
                         help="Path to weights directory")
+    parser.add_argument("--cache-dir", default=None, type=str,
+                        help="Path to the persistent cache of preprocessed images. Defaults to None (no persistent cache).")
+    parser.add_argument("--shared-cache", action='store_true',
+                        help="Whether to share the cache of preprocessed images between all processes on a node through shared memory.")
+    parser.add_argument("--cache-dtype", default='float32', type=str,
+                        help="Data type of the images in the persistent cache. Can be float16 or float32. Defaults to float32.")
+    parser.add_argument("--cache-size", default=None, type=float,
+                        help="Maximum size of the persistent cache in gigabytes. Defaults to None (no limit).")
+    parser.add_argument("--store-dir", default=None, type=str,
+                        help="Path to the volume store of the preprocessed images (see export_store.py) to train from instead of the image files. Defaults to None.")
+    parser.add_argument("--transcode-dir", default=None, type=str,
+                        help="Path to write a block-compressed copy of the data directory to, whose images can be decompressed in parallel. Defaults to None.")
+    parser.add_argument("--compress-level", default=6, type=int,
+                        help="Compression level of the transcoded images. Level 0 stores the images uncompressed. Defaults to 6.")
+    parser.add_argument("--num-workers", default=8, type=int,
+                        help="Number of workers to preprocess the images with. Defaults to 8.")
+    parser.add_argument("--prep-batch-size", default=1, type=int,
+                        help="Number of observations whose intensity transforms are batched on the GPU when filling the persistent cache. Defaults to 1 (no batching).")
     return parser.parse_args()
 
 RESULTS_DIR = '/Users/noltinho/thesis/results'
@@ -4,6 +4,7 @@ import torch.distributed as dist
 import torch.optim as optim
 import numpy as np
 import argparse
+import os
 from typing import List, Tuple
 from models.convnext3d import (
     convnext3d_atto, 
@@ -21,14 +22,18 @@ from monai.data import (
 from monai.utils.misc import ensure_tuple_rep
 from sklearn.model_selection import StratifiedGroupKFold
 from data.splits import GroupStratifiedSplit
-from data.datasets import CacheSeqDataset
+from data.datasets import CacheSeqDataset, SeqDatasetView, split_sequence
+from data.cache import PersistentCache, fill_cache, SHARED_CACHE_DIR
+from data.store import VolumeStore
 from data.utils import (
     DatasetPreprocessor, 
     convert_to_dict, 
     convert_to_seqdict, 
-    SequenceBatchCollater
+    PatientIndex,
+    SequenceBatchCollater,
+    BucketBatchSampler
 )
-from utils.transforms import transforms, dino_transforms
+from utils.transforms import transforms, batch_transforms, dino_transforms
 from utils.utils import cosine_scheduler, get_params_groups
 from losses.focalloss import FocalLoss
 from losses.binaryceloss import BinaryCELoss
@@ -117,25 +122,26 @@ def load_data(
         keys=['label','delta'], 
         file_name='labels.csv')
     default_dev, default_test = GroupStratifiedSplit(split_ratio=0.75).split_dataset(default_df)
+    index = PatientIndex(data_dict, args.mod_list)
     test = label_df[label_df['patient_id'].isin(default_test['patient_id'])]
     dev = label_df[-label_df['patient_id'].isin(test['patient_id'])]
     if phase == 'train':
         if args.k_folds > 1:
             cv_folds = StratifiedGroupKFold(n_splits=args.k_folds, shuffle=True, random_state=args.seed).split(dev, y=dev['label'], groups=dev['patient_id'])
             indices = [(dev.iloc[train_idx], dev.iloc[val_idx]) for train_idx, val_idx in list(cv_folds)]
-            split_dict = [convert_to_dict([indices[k][0], indices[k][1]], data_dict=data_dict, split_names=phases) for k in folds]
+            split_dict = [convert_to_dict([indices[k][0], indices[k][1]], data_dict=data_dict, split_names=phases, index=index) for k in folds]
         elif args.k_folds == 1:
             train, val = GroupStratifiedSplit(split_ratio=0.8).split_dataset(dev)
-            split_dict = [convert_to_dict([train, val], data_dict=data_dict, split_names=phases, verbose=True) for k in folds]
+            split_dict = [convert_to_dict([train, val], data_dict=data_dict, split_names=phases, verbose=True, index=index) for k in folds]
         else:
-            split_dict = [convert_to_dict([dev, test], data_dict=data_dict, split_names=phases, verbose=True) for k in folds]
+            split_dict = [convert_to_dict([dev, test], data_dict=data_dict, split_names=phases, verbose=True, index=index) for k in folds]
     elif phase == 'pretrain':
         folds = range(1)
-        split_dict = [convert_to_dict([dev], data_dict=data_dict, split_names=phases, verbose=True) for k in folds]
+        split_dict = [convert_to_dict([dev], data_dict=data_dict, split_names=phases, verbose=True, index=index) for k in folds]
     elif phase == 'test':
         folds = range(1)
-        split_dict = [convert_to_dict([test], data_dict=data_dict, split_names=phases, verbose=True) for k in folds]
-    seq_split_dict = [convert_to_seqdict(split_dict[k], args.mod_list, phases) for k in folds]
+        split_dict = [convert_to_dict([test], data_dict=data_dict, split_names=phases, verbose=True, index=index) for k in folds]
+    seq_split_dict = [convert_to_seqdict(split_dict[k], args.mod_list, phases, index=index) for k in folds]
 
     class_dict = {x: [[patient['label'] for patient in split_dict[k][x]] for k in folds] for x in phases}
     seq_class_dict = {x: [[max(patient['label']) for patient in seq_split_dict[k][x][0]] for k in folds] for x in phases}
@@ -146,6 +152,29 @@ def load_data(
         shuffle=(True if x != 'test' else False),
         even_divisible=False
         )[dist.get_rank()] for k in folds] for x in phases}
+    cache_dir = SHARED_CACHE_DIR if args.shared_cache else args.cache_dir
+    if not partial:
+        prep_transform = transforms(
+            dataset='prep', 
+            modalities=args.mod_list,
+            device=device,
+            crop_size=ensure_tuple_rep(args.global_crop_size, 3))
+        store = None if args.store_dir is None else VolumeStore(args.store_dir, prep_transform)
+    if args.shared_cache and args.store_dir is None and not partial:
+        # Every local rank preprocesses a shard of all sequences into node-local shared memory, such that
+        # the datasets of all ranks attach to the same cache entries instead of building their own.
+        local_rank, local_world_size = int(os.environ.get('LOCAL_RANK', 0)), int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        cache = PersistentCache(
+            cache_dir=cache_dir,
+            transform=prep_transform,
+            image_keys=args.mod_list,
+            dtype=args.cache_dtype,
+            max_size=args.cache_size)
+        all_sequences = {tuple(patient['uid']): patient for x in phases for k in folds for patient in seq_split_dict[k][x][0]}
+        items = [item for patient in all_sequences.values() for item in split_sequence(patient, args.mod_list)]
+        fill_cache(cache, items[local_rank::local_world_size], num_workers=args.num_workers, batch_size=args.prep_batch_size,
+            device=device if device.type == 'cuda' else None)
+        dist.barrier()
     if partial:
         datasets = {x: [CacheDataset(
             data=data_partition_dict[x][k], 
@@ -153,10 +182,35 @@ def load_data(
                 modalities=args.mod_list, 
                 device=device,
                 global_crop_size=ensure_tuple_rep(args.global_crop_size, 3),
-                local_crop_size=ensure_tuple_rep(args.local_crop_size, 3)),
-            num_workers=8,
+                local_crop_size=ensure_tuple_rep(args.local_crop_size, 3),
+                num_local_crops=args.num_local_crops),
+            num_workers=args.num_workers,
             copy_cache=False
             ) for k in folds] for x in phases}
+    elif phase == 'train' and args.k_folds > 1:
+        # The folds overlap, so we preprocess every sequence of the rank once and build the folds as views on top.
+        sequences = {tuple(patient['uid']): patient for x in phases for k in folds for patient in data_partition_dict[x][k]}
+        seq_index = {uid: idx for idx, uid in enumerate(sequences)}
+        base_dataset = CacheSeqDataset(
+            data=list(sequences.values()),
+            image_keys=args.mod_list,
+            transform=prep_transform,
+            num_workers=args.num_workers,
+            copy_cache=False,
+            cache_dir=cache_dir,
+            cache_dtype=args.cache_dtype,
+            cache_size=args.cache_size,
+            store=store)
+        datasets = {x: [SeqDatasetView(
+            dataset=base_dataset,
+            indices=[seq_index[tuple(patient['uid'])] for patient in data_partition_dict[x][k]],
+            transform=transforms(
+                dataset=x, 
+                modalities=args.mod_list,
+                device=device,
+                crop_size=ensure_tuple_rep(args.global_crop_size, 3),
+                batched=args.batched_augmentation)
+            ) for k in folds] for x in phases}
     else:
         datasets = {x: [CacheSeqDataset(
             data=data_partition_dict[x][k],
@@ -165,19 +219,43 @@ def load_data(
                 dataset=x, 
                 modalities=args.mod_list,
                 device=device,
-                crop_size=ensure_tuple_rep(args.global_crop_size, 3)),
-            num_workers=8,
-            copy_cache=False
+                crop_size=ensure_tuple_rep(args.global_crop_size, 3),
+                batched=args.batched_augmentation),
+            num_workers=args.num_workers,
+            copy_cache=False,
+            cache_dir=cache_dir,
+            cache_dtype=args.cache_dtype,
+            cache_size=args.cache_size,
+            cache_end=len(prep_transform.transforms),
+            store=store
             ) for k in folds] for x in phases}
+    bucketing = args.bucket_size > 0 and not partial
+    batch_sampler = {x: [BucketBatchSampler(
+        lengths=[len(patient['uid']) for patient in data_partition_dict[x][k]],
+        batch_size=args.batch_size,
+        bucket_size=args.bucket_size,
+        max_length=args.seq_length,
+        seed=args.seed
+        ) if (x == 'train') & bucketing else None for k in folds] for x in phases}
     dataloader = {x: [ThreadDataLoader(
         datasets[x][k], 
-        batch_size=(args.batch_size if x == 'train' else 1), 
-        shuffle=(True if x == 'train' else False),   
-        drop_last=(True if x == 'train' else False),   
+        batch_size=(args.batch_size if (x == 'train') & (batch_sampler[x][k] is None) else 1), 
+        shuffle=(True if (x == 'train') & (batch_sampler[x][k] is None) else False),   
+        drop_last=(True if (x == 'train') & (batch_sampler[x][k] is None) else False),   
+        batch_sampler=batch_sampler[x][k],
         num_workers=0,
         collate_fn=(SequenceBatchCollater(
             keys=['image','label','delta'], 
-            seq_length=args.seq_length) if (x == 'train') & (not partial) else list_data_collate)
+            seq_length=args.seq_length,
+            pad_to_max=bucketing,
+            copy_padding=not args.packed,
+            pin_memory=torch.cuda.is_available(),
+            # the collater runs outside of the dataset, so its augmentation is not seeded by the dataloader
+            augmentation=batch_transforms(
+                modalities=args.mod_list,
+                crop_size=ensure_tuple_rep(args.global_crop_size, 3)).set_random_state(seed=args.seed + dist.get_rank())
+                if args.batched_augmentation else None
+            ) if (x == 'train') & (not partial) else list_data_collate)
         ) for k in folds] for x in phases}
     _, counts = np.unique(seq_class_dict['test' if phase == 'test' else 'train'][0], return_counts=True)
     pos_weight = counts[1] / counts.sum()
@@ -210,11 +288,12 @@ def load_objs(
     elif args.loss_fn == 'dino':
         loss_fn = DINOLoss(
             out_dim=args.out_dim,
-            num_crops=4,
+            num_crops=2 + args.num_local_crops,
             num_steps=args.num_steps,
             teacher_temp=args.teacher_temp,
             teacher_warmup_temp=args.teacher_warmup_temp,
-            teacher_warmup_steps=int(args.warmup_steps * 2))
+            teacher_warmup_steps=int(args.warmup_steps * 2),
+            async_center=args.async_center)
     params = get_params_groups(model)
     optimizer = optim.AdamW(params, lr=learning_rate, weight_decay=args.weight_decay)
     lr_schedule = cosine_scheduler(
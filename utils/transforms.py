@@ -5,7 +5,6 @@ from monai.transforms import (
     LoadImaged,
     EnsureChannelFirstd,
     Orientationd,
-    Spacingd,
     CropForegroundd,
     ConcatItemsd,
     CenterSpatialCropd,
@@ -23,29 +22,43 @@ from monai.transforms import (
     NormalizeIntensityd,
     SpatialPadd
 )
+from data.nifti import ParallelNiftiReader
 from data.transforms import (
     PercentileSpatialCropd, 
+    SpacingPercentileCropd,
     YeoJohnsond, 
     SoftClipOutliersd, 
     ResampleToMatchFirstd, 
-    RandSelectChanneld
+    RandSelectChanneld,
+    RandMultiCropd,
+    BatchedRandAugment
 )
 
-def transforms(
-        dataset: str,
+def lazy_overrides(
         modalities: list,
-        device: torch.device,
-        crop_size: tuple = (72, 72, 72),
-        image_spacing: tuple = (1.5, 1.5, 1.5)
-    ) -> transforms:
+        mode: int = 3
+    ) -> dict:
 
     '''
+    Lazy resampling does not carry over the interpolation settings of the pending transforms, so they are passed to
+    the composed resampling of every modality explicitly. They match the eager ResampleToMatchd defaults.
+
     Args:
-        dataset (str): Dataset to apply transformations on. Can be 'train', 'val' or 'test'.
-        modalities (list): List of image modalities to perform transformations on.
-        device (torch.device): Pytorch device.
-        crop_size (tuple): Tuple of integers specifying the image size.
-        image_spacing (tuple): Tuple of floats specifying the spacing between MRI slides.
+        modalities (list): List of image modalities that are resampled lazily.
+        mode (int): Order of the spline interpolation.
+    '''
+    return {mod: {'mode': mode, 'padding_mode': 'border', 'dtype': torch.float64} for mod in modalities}
+
+def channel_stats(
+        modalities: list
+    ) -> tuple:
+
+    '''
+    Args:
+        modalities (list): List of image modalities.
+
+    Returns:
+        tuple: Mean and standard deviation of every channel of the preprocessed images.
     '''
     if any('DWI' in mod for mod in modalities):
         mean = (0.5396, 0.5280, 0.5601, 0.5737)
@@ -56,17 +69,41 @@ def transforms(
     elif any('T1W_IP' in mod for mod in modalities):
         mean = (-0.2312, -0.3776, -0.1640, -0.0783)
         std = (0.6274, 0.7104, 0.5422, 0.5877)
+    return mean, std
+
+def transforms(
+        dataset: str,
+        modalities: list,
+        device: torch.device,
+        crop_size: tuple = (72, 72, 72),
+        image_spacing: tuple = (1.5, 1.5, 1.5),
+        batched: bool = False
+    ) -> transforms:
+
+    '''
+    Args:
+        dataset (str): Dataset to apply transformations on. Can be 'train', 'val', 'test', or 'prep' for the
+            deterministic preprocessing that is shared by all datasets.
+        modalities (list): List of image modalities to perform transformations on.
+        device (torch.device): Pytorch device.
+        crop_size (tuple): Tuple of integers specifying the image size.
+        image_spacing (tuple): Tuple of floats specifying the spacing between MRI slides.
+        batched (bool): Whether the random augmentations of the training images are left to batch_transforms, which
+            applies them to the collated batch. Defaults to False.
+    '''
+    mean, std = channel_stats(modalities)
 
     prep = [
-        LoadImaged(keys=modalities, image_only=True),
+        LoadImaged(keys=modalities, image_only=True, reader=ParallelNiftiReader()),
         EnsureChannelFirstd(keys=modalities),
-        Orientationd(keys=modalities, axcodes='PLI'),
+        # The transform is voxel-wise, so it commutes with the reorientation and does not break up the lazy resampling.
         YeoJohnsond(keys=modalities, lmbda=0.5),
-        ResampleToMatchd(keys=modalities, key_dst=modalities[0], mode=3),
-        ConcatItemsd(keys=modalities, name='image'),
+        Orientationd(keys=modalities[0], axcodes='PLI'),
+        # The region of interest is planned on the grid of the first modality, such that the other modalities
+        # are only resampled onto the foreground instead of the full field of view.
         CopyItemsd(keys=modalities[0], names='mask'),
         PercentileSpatialCropd(
-            keys=['image','mask'],
+            keys=[modalities[0],'mask'],
             roi_center=(0.5, 0.5, 0.5),
             roi_size=(0.85, 0.8, 0.99),
             min_size=(82, 82, 82)),
@@ -75,27 +112,34 @@ def transforms(
             func=lambda x: torch.where(x > torch.mean(x), 1, 0)),
         KeepLargestConnectedComponentd(keys='mask', connectivity=1),
         CropForegroundd(
-            keys='image',
+            keys=modalities[0],
             source_key='mask',
             select_fn=lambda x: x > 0,
             k_divisible=1,
             allow_smaller=False),
+        # The reorientation is composed with the resampling, so every modality is interpolated only once.
+        Orientationd(keys=modalities, axcodes='PLI', lazy=True),
+        ResampleToMatchd(keys=modalities, key_dst=modalities[0], mode=3, lazy=True),
+        ConcatItemsd(keys=modalities, name='image'),
         DeleteItemsd(keys=modalities + ['mask']),
         SoftClipOutliersd(keys='image', scale_factor=3.5, channel_wise=True),
         NormalizeIntensityd(keys='image', channel_wise=True),
-        Spacingd(keys='image', pixdim=(1.5, 1.5, 1.5), mode=3),
-        PercentileSpatialCropd(
+        SpacingPercentileCropd(
             keys='image',
+            pixdim=(1.5, 1.5, 1.5),
             roi_center=(0.5, 0.3, 0.3),
             roi_size=(0.6, 0.5, 0.4),
-            min_size=(82, 82, 82)),
+            min_size=(82, 82, 82),
+            mode=3),
         SpatialPadd(keys='image', spatial_size=(72, 72, 72)),
         CenterSpatialCropd(keys='image', roi_size=(96, 96, 96))
     ]
 
     train = [
+        EnsureTyped(keys='image', track_meta=False, device=device, dtype=torch.float)
+    ] if batched else [
         EnsureTyped(keys='image', track_meta=False, device=device, dtype=torch.float),
-        RandSpatialCropd(keys='image', roi_size=(72, 72, 72), random_size=False),
+        RandSpatialCropd(keys='image', roi_size=crop_size, random_size=False),
         RandFlipd(keys='image', spatial_axis=0, prob=0.5),
         RandFlipd(keys='image', spatial_axis=1, prob=0.5),
         RandFlipd(keys='image', spatial_axis=2, prob=0.5),
@@ -107,31 +151,63 @@ def transforms(
 
     test = [
         CenterSpatialCropd(keys='image', roi_size=(72, 72, 72)),
-        NormalizeIntensityd(keys='image', subtrahend=mean, divisor=std, channel_wise=True),
+        # The crop is a view on the cached image, so the channel statistics are broadcast instead of normalizing
+        # every channel in-place.
+        NormalizeIntensityd(
+            keys='image', 
+            subtrahend=torch.tensor(mean).reshape(-1, 1, 1, 1), 
+            divisor=torch.tensor(std).reshape(-1, 1, 1, 1)),
         EnsureTyped(keys='image', track_meta=False, device=device, dtype=torch.float)
     ]
 
     if dataset == 'train':
-        return Compose(prep + train)
+        return Compose(prep + train, lazy=None, overrides=lazy_overrides(modalities))
     elif dataset in ['val', 'test']:
-        return Compose(prep + test)
+        return Compose(prep + test, lazy=None, overrides=lazy_overrides(modalities))
+    elif dataset == 'prep':
+        return Compose(prep, lazy=None, overrides=lazy_overrides(modalities))
     else:
-        raise ValueError ("Dataset must be 'train', 'val' or 'test'.")
+        raise ValueError ("Dataset must be 'train', 'val', 'test' or 'prep'.")
+
+def batch_transforms(
+        modalities: list,
+        crop_size: tuple = (72, 72, 72)
+    ) -> BatchedRandAugment:
+
+    '''
+    Random augmentations of the training images of transforms(dataset='train', batched=True), applied to the whole
+    collated batch (see SequenceBatchCollater).
+
+    Args:
+        modalities (list): List of image modalities to perform transformations on.
+        crop_size (tuple): Tuple of integers specifying the image size.
+    '''
+    mean, std = channel_stats(modalities)
+    return BatchedRandAugment(
+        roi_size=crop_size,
+        flip_prob=0.5,
+        rotate_prob=0.5,
+        scale_factors=0.1,
+        shift_offsets=0.1,
+        subtrahend=mean,
+        divisor=std)
 
 def dino_transforms(
         modalities: list,
         device: torch.device,
         global_crop_size: tuple = (72, 72, 72),
         local_crop_size: tuple = (48, 48, 48),
-        image_spacing: tuple = (1.5, 1.5, 1.5)
+        image_spacing: tuple = (1.5, 1.5, 1.5),
+        num_local_crops: int = 2
     ) -> transforms:
     '''
     Args:
         modalities (list): List of image modalities to perform transformations on.
         device (torch.device): Pytorch device.
         global_crop_size (tuple): Tuple of integers specifying the size of the global views.
-        global_crop_size (tuple): Tuple of integers specifying the size of the local views.
+        local_crop_size (tuple): Tuple of integers specifying the size of the local views.
         image_spacing (tuple): Tuple of floats specifying the spacing between MRI slides.
+        num_local_crops (int): Number of local views, named lv1 to lvN. There are always two global views, gv1 and gv2.
     '''
     if any('DWI' in mod for mod in modalities):
         mean = 0.545
@@ -144,11 +220,11 @@ def dino_transforms(
         std = 0.619
 
     prep = [
-        LoadImaged(keys=modalities, image_only=True, allow_missing_keys=True),
+        LoadImaged(keys=modalities, image_only=True, reader=ParallelNiftiReader(), allow_missing_keys=True),
         EnsureChannelFirstd(keys=modalities, allow_missing_keys=True),
-        Orientationd(keys=modalities, axcodes='PLI', allow_missing_keys=True),
         YeoJohnsond(keys=modalities, lmbda=0.5, allow_missing_keys=True),
-        ResampleToMatchFirstd(keys=modalities, mode=3, allow_missing_keys=True),
+        Orientationd(keys=modalities, axcodes='PLI', allow_missing_keys=True, lazy=True),
+        ResampleToMatchFirstd(keys=modalities, mode=3, allow_missing_keys=True, lazy=True),
         ConcatItemsd(keys=modalities, name='image', allow_missing_keys=True),
         CopyItemsd(keys='image', names='mask'),
         Lambdad(keys='mask', func=lambda x: x[:1]),
@@ -167,35 +243,35 @@ def dino_transforms(
             allow_smaller=False),
         SoftClipOutliersd(keys='image', scale_factor=3.5, channel_wise=True),
         NormalizeIntensityd(keys='image', channel_wise=True),
-        Spacingd(keys='image', pixdim=(1.5, 1.5, 1.5), mode=3),
-        PercentileSpatialCropd(
+        SpacingPercentileCropd(
             keys='image',
+            pixdim=(1.5, 1.5, 1.5),
             roi_center=(0.5, 0.3, 0.3),
             roi_size=(0.6, 0.5, 0.4),
-            min_size=(82, 82, 82)),
+            min_size=(82, 82, 82),
+            mode=3),
         SpatialPadd(keys='image', spatial_size=(72, 72, 72)),
         CenterSpatialCropd(keys='image', roi_size=(96, 96, 96)),
-        CopyItemsd(keys='image', times=4, names=['gv1','gv2','lv1','lv2']),
-        DeleteItemsd(keys=modalities + ['image','mask']),
-        EnsureTyped(keys=['gv1','gv2','lv1','lv2'], track_meta=False, device=device, dtype=torch.float),
-    ]
-
-    global_crop = [
-        RandSpatialCropd(keys=['gv1','gv2'], roi_size=global_crop_size, random_size=False)
+        DeleteItemsd(keys=modalities + ['mask']),
+        EnsureTyped(keys='image', track_meta=False, device=device, dtype=torch.float),
     ]
 
-    local_crop = [
-        RandSpatialCropd(keys=['lv1','lv2'], roi_size=local_crop_size, random_size=False)
+    # All views are cropped from the single cached image, all other augmentations only touch the crops.
+    crops = {'gv1': global_crop_size, 'gv2': global_crop_size}
+    crops.update({f'lv{i + 1}': local_crop_size for i in range(num_local_crops)})
+    views = list(crops)
+    crop = [
+        RandMultiCropd(keys='image', crops=crops)
     ]
 
     post = [
-        RandFlipd(keys=['gv1','gv2','lv1','lv2'], prob=0.5, spatial_axis=0),
-        RandFlipd(keys=['gv1','gv2','lv1','lv2'], prob=0.5, spatial_axis=1),
-        RandFlipd(keys=['gv1','gv2','lv1','lv2'], prob=0.5, spatial_axis=2),
-        RandRotate90d(keys=['gv1','gv2','lv1','lv2'], prob=0.5),
-        RandScaleIntensityd(keys=['gv1','gv2','lv1','lv2'], prob=1.0, factors=0.1, channel_wise=True),
-        RandShiftIntensityd(keys=['gv1','gv2','lv1','lv2'], prob=1.0, offsets=0.1, channel_wise=True),
-        RandSelectChanneld(keys=['gv1','gv2','lv1','lv2'], num_channels=1),
-        NormalizeIntensityd(keys=['gv1','gv2','lv1','lv2'], subtrahend=mean, divisor=std)
+        RandFlipd(keys=views, prob=0.5, spatial_axis=0),
+        RandFlipd(keys=views, prob=0.5, spatial_axis=1),
+        RandFlipd(keys=views, prob=0.5, spatial_axis=2),
+        RandRotate90d(keys=views, prob=0.5),
+        RandScaleIntensityd(keys=views, prob=1.0, factors=0.1, channel_wise=True),
+        RandShiftIntensityd(keys=views, prob=1.0, offsets=0.1, channel_wise=True),
+        RandSelectChanneld(keys=views, num_channels=1),
+        NormalizeIntensityd(keys=views, subtrahend=mean, divisor=std)
     ]
-    return Compose(prep + global_crop + local_crop + post)
\ No newline at end of file
+    return Compose(prep + crop + post, lazy=None, overrides=lazy_overrides(modalities))
\ No newline at end of file
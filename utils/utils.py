@@ -1,6 +1,9 @@
+from __future__ import annotations
+
 import torch
 import torch.nn as nn
 import numpy as np
+from typing import List
 
 def cancel_gradients_last_layer(
         model: nn.Module, 
@@ -21,6 +24,26 @@ def cancel_gradients_last_layer(
         if "last_layer" in n:
             p.grad = None
 
+@torch.no_grad()
+def update_ema(
+        ema_params: List[torch.Tensor],
+        params: List[torch.Tensor],
+        momentum: float
+    ) -> None:
+
+    '''
+    Exponential moving average update ema = momentum * ema + (1 - momentum) * param of all tensors at once. The
+    update is a fused multi-tensor scaling and addition, without temporary tensors per parameter.
+
+    Args:
+        ema_params (List[torch.Tensor]): Parameters of the moving average, e.g., the teacher's. Updated in place.
+        params (List[torch.Tensor]): Parameters to average, e.g., the student's.
+        momentum (float): Momentum of the moving average.
+    '''
+
+    torch._foreach_mul_(ema_params, momentum)
+    torch._foreach_add_(ema_params, params, alpha=1 - momentum)
+
 def cosine_scheduler(
         base_value: float, 
         final_value: float, 
@@ -112,3 +135,97 @@ def prep_batch(
 
 
 
+
+class FlatParameters:
+
+    '''
+    Repacks the parameters of a model into a single contiguous buffer, such that the parameters are views into it.
+    If grads is True, the gradients are views into a second buffer, such that norms, clipping, and copies of all
+    parameters or gradients are single tensor operations. The buffers have to be created after moving the model to
+    its device and before wrapping it with DistributedDataParallel.
+    '''
+
+    def __init__(
+            self,
+            model: nn.Module,
+            grads: bool = True
+        ) -> None:
+
+        '''
+        Args:
+            model (nn.Module): Pytorch module object. All parameters must have the same data type and device.
+            grads (bool): Boolean flag to also pack the gradients of the parameters that require them. Defaults to true.
+        '''
+
+        self.params = list(model.parameters())
+        if len(set((p.dtype, p.device) for p in self.params)) > 1:
+            raise ValueError('All parameters must have the same data type and device to be flattened.')
+        self.data = torch.cat([p.detach().reshape(-1) for p in self.params])
+        self.data_views = self.views(self.data)
+        for p, view in zip(self.params, self.data_views):
+            p.data = view
+        self.grad = torch.zeros_like(self.data) if grads else None
+        self.grad_views = self.views(self.grad) if grads else None
+        self.attach_grads()
+
+    def views(
+            self,
+            buffer: torch.Tensor
+        ) -> List[torch.Tensor]:
+
+        '''
+        Args:
+            buffer (torch.Tensor): Flat buffer with the size of all parameters.
+        '''
+
+        views, offset = [], 0
+        for p in self.params:
+            views.append(buffer[offset:offset + p.numel()].view_as(p))
+            offset += p.numel()
+        return views
+
+    def attach_grads(self) -> None:
+
+        '''
+        Zeros the gradient buffer and sets it as the gradients of the parameters that require them. Has to be called
+        after optimizer.zero_grad(set_to_none=True), as autograd otherwise allocates new gradients.
+        '''
+
+        if self.grad is None:
+            return
+        self.grad.zero_()
+        for p, view in zip(self.params, self.grad_views):
+            if p.requires_grad:
+                p.grad = view
+
+    @torch.no_grad()
+    def clip_grad_norm_(
+            self,
+            max_norm: float
+        ) -> torch.Tensor:
+
+        '''
+        Same as nn.utils.clip_grad_norm_ with the euclidean norm, on the gradient buffer.
+
+        Args:
+            max_norm (float): Maximum norm of all gradients.
+        '''
+
+        total_norm = torch.linalg.vector_norm(self.grad)
+        self.grad.mul_(torch.clamp(max_norm / (total_norm + 1e-6), max=1.0))
+        return total_norm
+
+    @torch.no_grad()
+    def copy_(
+            self,
+            other: FlatParameters
+        ) -> None:
+
+        '''
+        Copies all parameters of another model with the same architecture.
+
+        Args:
+            other (FlatParameters): Flat parameters of the model to copy.
+        '''
+
+        self.data.copy_(other.data)